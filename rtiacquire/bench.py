@@ -0,0 +1,476 @@
+#!/usr/bin/python
+
+"""Benchmark RTI preview and RTI capture.
+
+Stats -- times for each stage of a benchmark
+TimingCamera -- a camera backend which times calls to another backend
+bench_preview -- time an RTI preview
+bench_capture -- time an RTI capture
+compare -- print the change between two sets of results
+main -- run the benchmarks from the command line
+
+We run the same steps as MainWindow.rti_preview() and rti_capture(), but
+with no GUI, against a simulated camera (camsim.py) and dome (domesim.py),
+or against a recorded session (replay.py). The time for each stage of each
+frame is measured:
+
+    light -- change the lights and wait for the controller
+    settle -- the fixed waits, see camera.preview_settle and capture_settle
+    preview -- grab a preview frame
+    trigger -- fire the shutter
+    exposure -- wait for the camera to save the file
+    download -- fetch the file, this includes writing it without
+        write-behind
+    write, sync -- write and sync the file, with write-behind
+    delete -- delete the file from the camera
+
+Results are printed and saved as JSON, use --compare to see the change
+from an earlier run. For example:
+
+    $ python bench.py --profile laptop --output before.json
+    ... make changes ...
+    $ python bench.py --profile laptop --compare before.json
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import os
+import sys
+import time
+import json
+import platform
+import subprocess
+import shutil
+import tempfile
+import threading
+import optparse
+
+import camera
+import camsim
+import domesim
+import lights
+import ledmap
+import replay
+import writer
+
+# get the directory this source is in
+source_dir = os.path.dirname(os.path.abspath(__file__))
+
+# the camera calls we time, and the stage each is part of
+camera_stages = {
+    'gp_camera_capture_preview': 'preview',
+    'gp_camera_trigger_capture': 'trigger',
+    'gp_camera_wait_for_event': 'exposure',
+    'gp_camera_file_get': 'download',
+    'gp_camera_file_delete': 'delete'
+}
+
+# the order we print stages in
+stage_order = ['light', 'settle', 'preview', 'trigger', 'exposure',
+               'download', 'write', 'sync', 'delete']
+
+class Stats:
+
+    """Times for each stage of a benchmark.
+
+    Stages can be timed from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def add(self, stage, seconds):
+        self.lock.acquire()
+        try:
+            self.times.setdefault(stage, []).append(seconds)
+        finally:
+            self.lock.release()
+
+    def time(self, stage, func, *args):
+        """Call func, adding the time it takes to stage."""
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.add(stage, time.time() - start)
+
+    def summary(self):
+        """Return a dict of stage name to a dict of count, total, mean, min
+        and max seconds.
+        """
+        summary = {}
+        self.lock.acquire()
+        try:
+            for (stage, times) in self.times.items():
+                summary[stage] = {'count': len(times),
+                                  'total': sum(times),
+                                  'mean': sum(times) / len(times),
+                                  'min': min(times),
+                                  'max': max(times)}
+        finally:
+            self.lock.release()
+        return summary
+
+class TimingCamera:
+
+    """A camera backend which times the calls in camera_stages.
+
+    Times are added to stats, set it to None to stop timing.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = None
+
+    def __getattr__(self, name):
+        if not name.startswith('gp_'):
+            raise AttributeError(name)
+        func = getattr(self.backend, name)
+        if not name in camera_stages:
+            return func
+
+        stage = camera_stages[name]
+        def call(*args):
+            if self.stats == None:
+                return func(*args)
+            return self.stats.time(stage, func, *args)
+        return call
+
+def time_writer(output, stats):
+    # time the writes the writer thread makes
+    write_file = output.write_file
+    sync = output.sync
+    output.write_file = lambda *args: stats.time('write', write_file, *args)
+    output.sync = lambda: stats.time('sync', sync)
+
+def file_sizes(filenames):
+    return sum([os.path.getsize(filename) for filename in filenames])
+
+def summarise(stats, start, filenames, error = None):
+    wall = time.time() - start
+    frames = len(filenames)
+    size = file_sizes(filenames)
+    result = {'wall': wall,
+              'frames': frames,
+              'bytes': size,
+              'fps': frames / wall,
+              'mbps': size / (1000000.0 * wall),
+              'stages': stats.summary()}
+    if error:
+        result['error'] = error
+    return result
+
+def bench_preview(cam, lights_thread, triples, outdir, stats):
+    """Time an RTI preview: for each triple, set the lights, wait, and
+    save a preview frame to outdir. Return a dict of results.
+
+    Times are added to stats. Camera times are only there if the camera
+    backend is a TimingCamera which adds to stats too.
+    """
+    filenames = []
+    error = None
+    start = time.time()
+    cam.start_session()
+    try:
+        for (i, triple) in enumerate(triples):
+            stats.time('light',
+                       lambda: lights_thread.set_triple(triple).wait())
+            stats.time('settle', time.sleep, camera.preview_settle)
+
+            filename = os.path.join(outdir, 'rti_preview_%d.jpg' % i)
+            cam.preview_to_file(filename)
+            filenames.append(filename)
+    except (camera.Error, lights.Error) as e:
+        error = str(e)
+    finally:
+        cam.end_session()
+
+    return summarise(stats, start, filenames, error)
+
+def bench_capture(cam, lights_thread, triples, outdir, stats,
+                  write_behind = 0, defer_delete = False):
+    """Time an RTI capture: for each triple, set the lights and take a
+    photo into outdir. Return a dict of results.
+
+    write_behind -- write up to this many files in the background
+    defer_delete -- delete from the camera at the end
+
+    Times are added to stats, see bench_preview().
+    """
+    output = None
+    if write_behind > 0:
+        output = writer.Writer(write_behind)
+        time_writer(output, stats)
+
+    filenames = []
+    error = None
+    start = time.time()
+    cam.start_session()
+    cam.set_defer_delete(defer_delete)
+    try:
+        sequence = camera.Sequence(cam, output)
+        for (i, triple) in enumerate(triples):
+            stats.time('light',
+                       lambda: lights_thread.set_triple(triple).wait())
+            sequence.capture(os.path.join(outdir, '%d' % i))
+            stats.time('settle', time.sleep, camera.capture_settle)
+        filenames = sequence.finish()
+    except (camera.Error, lights.Error, writer.Error) as e:
+        error = str(e)
+    finally:
+        cam.set_defer_delete(False)
+        if output:
+            try:
+                output.close()
+            except writer.Error as e:
+                error = str(e)
+                cam.keep_pending()
+        cam.delete_pending()
+        cam.end_session()
+
+    return summarise(stats, start, filenames, error)
+
+def git_commit():
+    """Return the commit we are running, or None."""
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                   cwd = source_dir,
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE)
+        (out, err) = process.communicate()
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+    return out.strip()
+
+def machine():
+    """Return a dict describing this machine."""
+    info = {'node': platform.node(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'python': platform.python_version()}
+    try:
+        import multiprocessing
+        info['cpus'] = multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    return info
+
+def report(name, result, fp = sys.stdout):
+    """Print the results of a benchmark."""
+    fp.write('%s: %d frames in %.2fs, %.2f frames/s, %.2f MB/s\n' %
+             (name, result['frames'], result['wall'],
+              result['fps'], result['mbps']))
+    if 'error' in result:
+        fp.write('  stopped by error: %s\n' % result['error'])
+    stages = result['stages']
+    for stage in stage_order:
+        if stage in stages:
+            s = stages[stage]
+            fp.write('  %-10s %5d x %8.1fms = %7.2fs  %5.1f%%\n' %
+                     (stage, s['count'], 1000 * s['mean'], s['total'],
+                      100 * s['total'] / result['wall']))
+
+def compare(old, new, fp = sys.stdout):
+    """Print the change from one set of results to another."""
+    fp.write('change from %s (%s) to %s (%s)\n' %
+             (old.get('commit'), old.get('profile'),
+              new.get('commit'), new.get('profile')))
+    for (name, result) in new['benchmarks'].items():
+        if not name in old['benchmarks']:
+            continue
+        before = old['benchmarks'][name]
+        fp.write('%s: %.2f frames/s -> %.2f frames/s\n' %
+                 (name, before['fps'], result['fps']))
+        for stage in stage_order:
+            if stage in result['stages'] and stage in before['stages']:
+                a = before['stages'][stage]['mean']
+                b = result['stages'][stage]['mean']
+                change = 0.0
+                if a > 0:
+                    change = 100 * (b - a) / a
+                fp.write('  %-10s %8.1fms -> %8.1fms  %+6.1f%%\n' %
+                         (stage, 1000 * a, 1000 * b, change))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-d", "--debug",
+                    action = "store_true", dest = "verbose", default = False,
+                    help = "print debug messages")
+    parser.add_option("-b", "--benchmarks",
+                    dest = "benchmarks", default = "preview,capture",
+                    metavar = "LIST",
+                    help = "run the benchmarks in LIST")
+    parser.add_option("-m", "--map",
+                    dest = "map", default = "Dome main", metavar = "NAME",
+                    help = "use the lights in LED map NAME")
+    parser.add_option("-n", "--lights",
+                    type = "int", dest = "lights", default = 0,
+                    metavar = "N",
+                    help = "only use the first N lights")
+    parser.add_option("-w", "--write-behind",
+                    type = "int", dest = "write_behind", default = 0,
+                    metavar = "N",
+                    help = "write up to N captured files in the background")
+    parser.add_option("-x", "--defer-delete",
+                    action = "store_true", dest = "defer_delete",
+                    default = False,
+                    help = "delete captures from the camera at the end")
+    parser.add_option("-r", "--replay",
+                    dest = "replay", default = None, metavar = "DIR",
+                    help = "replay the session in DIR, not the simulators")
+    parser.add_option("-i", "--preview-image",
+                    dest = "preview_image", default = None, metavar = "FILE",
+                    help = "simulated preview frames are FILE")
+    parser.add_option("-I", "--capture-image",
+                    dest = "capture_image", default = None, metavar = "FILE",
+                    help = "simulated captures are FILE")
+    parser.add_option("-B", "--capture-bytes",
+                    type = "int", dest = "capture_bytes", default = 0,
+                    metavar = "N",
+                    help = "pad simulated captures to N bytes")
+    parser.add_option("-j", "--jitter",
+                    type = "float", dest = "jitter", default = 0.0,
+                    metavar = "F",
+                    help = "vary simulated camera times by up to F")
+    parser.add_option("-f", "--failure",
+                    type = "float", dest = "failure", default = 0.0,
+                    metavar = "P",
+                    help = "simulated camera calls fail with probability P")
+    parser.add_option("-s", "--seed",
+                    type = "int", dest = "seed", default = None,
+                    metavar = "N",
+                    help = "seed the camera simulator with N")
+    parser.add_option("-l", "--light-latency",
+                    type = "float", dest = "light_latency", default = 0.0,
+                    metavar = "SECONDS",
+                    help = "simulated lights take SECONDS to change")
+    parser.add_option("-t", "--tempdir",
+                    dest = "tempdir", default = None, metavar = "DIR",
+                    help = "write files to DIR, rather than a temporary "
+                        "directory")
+    parser.add_option("-P", "--profile",
+                    dest = "profile", default = platform.node(),
+                    metavar = "NAME",
+                    help = "call this machine profile NAME")
+    parser.add_option("-o", "--output",
+                    dest = "output", default = None, metavar = "FILE",
+                    help = "save results to FILE, rather than "
+                        "rtibench-PROFILE-DATE.json")
+    parser.add_option("-c", "--compare",
+                    dest = "compare", default = None, metavar = "FILE",
+                    help = "compare results with FILE")
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        logging.basicConfig(level = logging.DEBUG)
+
+    leds = ledmap.Ledmap(os.path.join(source_dir, 'data', 'led-maps.txt'))
+    if not options.map in leds.get_names():
+        sys.exit('no LED map called "%s"' % options.map)
+    triples = leds.get_bytes(options.map)
+    if options.lights > 0:
+        triples = triples[:options.lights]
+
+    outdir = options.tempdir
+    if outdir == None:
+        outdir = tempfile.mkdtemp(prefix = 'rtibench-')
+
+    settings = {'map': options.map,
+                'lights': len(triples),
+                'write_behind': options.write_behind,
+                'defer_delete': options.defer_delete,
+                'capture_settle': camera.capture_settle,
+                'preview_settle': camera.preview_settle}
+
+    dome = None
+    try:
+        if options.replay:
+            replay.replay(options.replay)
+            settings['replay'] = options.replay
+        else:
+            camera.set_backend(camsim.Simulator(
+                preview = options.preview_image,
+                capture = options.capture_image,
+                jitter = options.jitter,
+                failure = options.failure,
+                capture_bytes = options.capture_bytes,
+                seed = options.seed))
+            settings['camsim'] = {'timings': camsim.default_timings,
+                                  'jitter': options.jitter,
+                                  'failure': options.failure,
+                                  'capture_bytes': options.capture_bytes,
+                                  'seed': options.seed}
+
+            dome = domesim.Simulator(latency = options.light_latency,
+                                     link = os.path.join(outdir, 'dome'))
+            lights.serial_patterns = []
+            os.environ['RTIACQUIRE_PORTS'] = dome.get_portname()
+            settings['domesim'] = {'latency': options.light_latency}
+    except (camsim.Error, replay.Error) as e:
+        sys.exit(str(e))
+
+    timing = TimingCamera(camera.get_backend())
+    camera.set_backend(timing)
+    cam = camera.Camera()
+    lights_thread = lights.LightsThread(lights.Lights())
+
+    benchmarks = {}
+    try:
+        for name in options.benchmarks.split(','):
+            timing.stats = Stats()
+            if name == 'preview':
+                result = bench_preview(cam, lights_thread, triples, outdir,
+                                       timing.stats)
+            elif name == 'capture':
+                result = bench_capture(cam, lights_thread, triples, outdir,
+                                       timing.stats,
+                                       options.write_behind,
+                                       options.defer_delete)
+            else:
+                sys.exit('unknown benchmark "%s"' % name)
+            report(name, result)
+            benchmarks[name] = result
+    finally:
+        lights_thread.release()
+        cam.release()
+        if dome:
+            dome.close()
+        if options.tempdir == None:
+            shutil.rmtree(outdir, True)
+
+    results = {'profile': options.profile,
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'commit': git_commit(),
+               'machine': machine(),
+               'settings': settings,
+               'benchmarks': benchmarks}
+
+    output = options.output
+    if output == None:
+        output = 'rtibench-%s-%s.json' % \
+            (options.profile, time.strftime('%Y%m%d-%H%M%S'))
+    f = open(output, 'w')
+    try:
+        json.dump(results, f, indent = 2, sort_keys = True)
+        f.write('\n')
+    finally:
+        f.close()
+    print 'results saved to %s' % output
+
+    if options.compare:
+        f = open(options.compare, 'r')
+        try:
+            old = json.load(f)
+        finally:
+            f.close()
+        compare(old, results)
+
+# if we are run directly, run the benchmarks
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,13 @@
 """This module wraps up libgphoto2 in a nice interface.
 
 Camera -- a connection to a camera
+Sequence -- capture a series of photos, overlapping download and exposure
+Watcher -- watch a camera for settings changes
 Error -- the exception we can raise
 Widget -- a camera setting
+Setting -- a snapshot of a camera setting
 Config -- read and write camera settings
+set_backend -- talk to something other than libgphoto2
 
 Author: J.Cupitt
 Created as part of the AHRC RTI project in 2011
@@ -17,6 +21,8 @@ import os
 import sys
 import re
 import ctypes
+import ctypes.util
+import threading
 
 import finalize
 
@@ -87,6 +93,31 @@ GP_ERROR_IO_USB_CLEAR_HALT = -51 #Error
 GP_CAPTURE_IMAGE = 0
 # CameraFileType enum in 'gphoto2-file.h'
 GP_FILE_TYPE_NORMAL = 1
+# CameraEventType enum in 'gphoto2-camera.h'
+GP_EVENT_UNKNOWN = 0
+GP_EVENT_TIMEOUT = 1
+GP_EVENT_FILE_ADDED = 2
+GP_EVENT_FOLDER_ADDED = 3
+GP_EVENT_CAPTURE_COMPLETE = 4
+
+# how long to wait for the camera to save a triggered capture, in milliseconds
+event_timeout = 10000
+
+# try deferred deletes this many times before giving up, see delete_pending()
+delete_retries = 5
+
+# RTI capture waits this long after each shot, in seconds, it stops the
+# camera locking up
+capture_settle = 0.1
+
+# RTI preview waits this long after changing the lights, in seconds, to be
+# sure the next preview frame is lit properly
+preview_settle = 0.1
+
+# how long Watcher waits for each camera event, in milliseconds, and how
+# long it sleeps between polls, in seconds
+poll_timeout = 10
+watch_interval = 0.5
 
 """ gphoto2-port-log.h
 typedef enum {
@@ -105,13 +136,15 @@ GPLogLevel = {GP_LOG_ERROR: "error",
                 GP_LOG_DEBUG: "debug", 
                 GP_LOG_DATA: "data"}
 
-# Load library
-if sys.platform == "linux2":
-    gp = ctypes.CDLL('libgphoto2.so.6')
-elif sys.platform == "darwin":
-    gp = ctypes.CDLL('libgphoto2.dylib')
-else:
-    logging.error("unsupported platform")
+# everything below talks to the camera through gp, the backend ... normally
+# this is libgphoto2, but set_backend() can swap in anything with the same
+# functions, see camsim.py
+gp = None
+context = None
+log_id = None
+
+# event data from gp_camera_wait_for_event() must be released with free()
+libc = ctypes.CDLL(ctypes.util.find_library('c'))
 
 # gphoto2 log function
 #   void log(GPLogLevel level, const char *domain, 
@@ -150,10 +183,68 @@ def gplog(level, domain, fmt, args, data):
         last_detail = 'Non-specific error'
 gplog_func = LOGFUNC(gplog)
 
-gp.gp_context_new.restype = ctypes.c_void_p
-context = ctypes.c_void_p(gp.gp_context_new())
+def set_backend(backend):
+    """Send all camera calls to backend.
+
+    backend must have the gp_* functions from libgphoto2 that we use, with
+    the same arguments and return values. Set the backend before making any
+    Camera.
+    """
+    global gp
+    global context
+    global log_id
+
+    # the new backend may wrap the old one, so we must stop logging from it
+    # or we'll see everything twice
+    if gp != None:
+        gp.gp_log_remove_func(log_id)
+
+    gp = backend
+    context = ctypes.c_void_p(gp.gp_context_new())
+    log_id = gp.gp_log_add_func(GP_LOG_ERROR, gplog_func, None)
+
+def get_backend():
+    """Return the backend, see set_backend(). This method can raise
+    camera.Error.
+    """
+    if gp == None:
+        raise Error('Unable to connect to camera', 'libgphoto2 not found.')
+    return gp
+
+def load_gphoto2():
+    """Load libgphoto2 and make it the backend."""
+    if sys.platform.startswith("linux"):
+        name = 'libgphoto2.so.6'
+    elif sys.platform == "darwin":
+        name = 'libgphoto2.dylib'
+    else:
+        logging.error("unsupported platform")
+        return
 
-gp.gp_log_add_func(GP_LOG_ERROR, gplog_func, None)
+    try:
+        lib = ctypes.CDLL(name)
+    except OSError as e:
+        logging.error("unable to load %s: %s", name, str(e))
+        return
+    lib.gp_context_new.restype = ctypes.c_void_p
+    set_backend(lib)
+
+load_gphoto2()
+
+def locked(method):
+    """Decorate a Camera method so that it runs holding the camera lock.
+
+    libgphoto2 is not safe to call from more than one thread at once.
+    """
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.lock.release()
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
 
 class Camera:
 
@@ -164,8 +255,23 @@ class Camera:
         operation.
         """
         self.camera = None
+        self.lock = threading.RLock()
         self.preview_file = ctypes.c_void_p()
-        gp.gp_file_new(ctypes.byref(self.preview_file))
+        get_backend().gp_file_new(ctypes.byref(self.preview_file))
+
+        # while session_depth > 0, release() keeps the connection open, see
+        # start_session()
+        self.session_depth = 0
+
+        # number of times we've had to reconnect during the current session
+        self.reconnects = 0
+        self.session_connected = False
+
+        # with defer_delete set, files are not deleted from the camera after
+        # download, instead we queue [folder, name, attempts] here, see
+        # delete_pending()
+        self.defer_delete = False
+        self.pending_deletes = []
 
     def set_canon_capture(self, onoff):
         """Enable Canon preview mode.
@@ -183,6 +289,7 @@ class Camera:
         except:
             pass
 
+    @locked
     def connect(self):
         """Connect to the camera.
 
@@ -191,20 +298,60 @@ class Camera:
         """
         if self.camera == None:
             logging.debug('** camera init')
+            if self.session_depth > 0 and self.session_connected:
+                self.reconnects += 1
+                logging.debug('** camera reconnect %d in session', 
+                                self.reconnects)
             self.camera = ctypes.c_void_p()
             gp.gp_camera_new(ctypes.byref(self.camera))
             retval = gp.gp_camera_init(self.camera, context)
             if retval != GP_OK:
-                 self.release()
+                 self.drop()
                  raise Error('Unable to connect to camera')
             self.set_canon_capture(1)
+            if self.session_depth > 0:
+                self.session_connected = True
             logging.debug('** camera connected')
 
-    def release(self):
-        """Drop the camera connection. 
-        
-        Calling this method will force reconnection on the next camera
-        operation.
+    def start_session(self):
+        """Hold the camera connection open across a sequence of operations.
+
+        Until the matching end_session(), release() does nothing, so a series
+        of captures share a single connection. The connection is only dropped
+        and remade after a real error, see get_reconnects().
+
+        Sessions nest. 
+        """
+        if self.session_depth == 0:
+            logging.debug('** camera session start')
+            self.reconnects = 0
+            self.session_connected = self.camera != None
+        self.session_depth += 1
+
+    def end_session(self):
+        """End a session started with start_session().
+
+        The connection is released when the outermost session ends.
+        """
+        if self.session_depth > 0:
+            self.session_depth -= 1
+            if self.session_depth == 0:
+                logging.debug('** camera session end, %d reconnects', 
+                                self.reconnects)
+                self.release()
+
+    def get_reconnects(self):
+        """Return the number of reconnects during the current or most recent
+        session.
+        """
+        return self.reconnects
+
+    @locked
+    def drop(self):
+        """Drop the camera connection, even during a session.
+
+        Call this after a real camera error, the next operation will 
+        reconnect.
         """
         if self.camera != None:
             logging.debug('** camera shutdown')
@@ -212,6 +359,17 @@ class Camera:
             gp.gp_camera_unref(self.camera)
             self.camera = None
 
+    def release(self):
+        """Drop the camera connection. 
+        
+        Calling this method will force reconnection on the next camera
+        operation. During a session, see start_session(), the connection is
+        kept open.
+        """
+        if self.session_depth == 0:
+            self.drop()
+
+    @locked
     def capture_to_file(self, filename):
 
         """Connect and capture photo to filename. 
@@ -232,10 +390,93 @@ class Camera:
                         GP_CAPTURE_IMAGE, ctypes.byref(cam_path), context)
 
         if retval != GP_OK:
+            self.drop()
             raise Error('Unable to capture')
         else:
             logging.debug("Capture OK")
 
+        full_filename = self.download_to_file(cam_path, filename)
+
+        self.release()
+
+        return full_filename
+
+    @locked
+    def trigger_capture(self):
+        """Fire the shutter and return immediately.
+
+        The new file appears on the camera some time later, use 
+        wait_for_file() to find it. This method can raise camera.Error.
+        """
+
+        self.connect()
+
+        logging.debug('** camera trigger')
+        retval = gp.gp_camera_trigger_capture(self.camera, context)
+        if retval != GP_OK:
+            self.drop()
+            raise Error('Unable to trigger capture')
+
+    @locked
+    def wait_for_file(self, timeout=event_timeout):
+        """Wait for the camera to report a new file.
+
+        Drain camera events until a file appears, or until timeout
+        milliseconds pass with nothing happening. Return a CameraFilePath for
+        the new file. This method can raise camera.Error.
+        """
+
+        self.connect()
+
+        logging.debug('** camera wait for file')
+        while True:
+            evtype = ctypes.c_int()
+            evdata = ctypes.c_void_p()
+            retval = gp.gp_camera_wait_for_event(self.camera, timeout,
+                            ctypes.byref(evtype), ctypes.byref(evdata), 
+                            context)
+            if retval != GP_OK:
+                self.drop()
+                raise Error('Unable to read camera events')
+
+            if evtype.value == GP_EVENT_FILE_ADDED:
+                cam_path = CameraFilePath.from_buffer_copy(
+                                ctypes.string_at(evdata, 
+                                        ctypes.sizeof(CameraFilePath)))
+                libc.free(evdata)
+                logging.debug('new file "%s/%s"', 
+                                cam_path.folder, cam_path.name)
+                return cam_path
+
+            if evdata.value:
+                libc.free(evdata)
+
+            if evtype.value == GP_EVENT_TIMEOUT:
+                self.drop()
+                raise Error('Unable to capture', 
+                            'Timeout waiting for the camera to save a file.')
+
+    @locked
+    def download_to_file(self, cam_path, filename, writer=None):
+        """Download a file from the camera, then delete it from the camera.
+
+        cam_path -- a CameraFilePath, as made by capture or wait_for_file()
+        filename -- the file to write, without a suffix
+        writer -- optionally, a writer.Writer to save the file with
+
+        With a writer, the file is downloaded to memory and handed to the 
+        writer, so a slow disk does not hold up the camera. The file is not
+        safe on disc until the writer has synced it, so it's queued for
+        deletion as if deferred deletion were on: flush or close the writer,
+        then call delete_pending(), or keep_pending() if the writer failed.
+
+        Return the full filename we downloaded to, including the camera's
+        preferred filename suffix. This method can raise camera.Error, and
+        writer.Error for a failed background write.
+        """
+
+        self.connect()
+
         logging.debug('name = "%s"', cam_path.name)
         logging.debug('folder = "%s"', cam_path.folder)
 
@@ -250,31 +491,159 @@ class Camera:
         # Download and delete
         logging.debug('** camera download to %s', full_filename)
         cam_file = ctypes.c_void_p()
-        fd = os.open(full_filename, os.O_CREAT | os.O_WRONLY)
-        gp.gp_file_new_from_fd(ctypes.byref(cam_file), fd)
+        if writer:
+            gp.gp_file_new(ctypes.byref(cam_file))
+        else:
+            fd = os.open(full_filename, os.O_CREAT | os.O_WRONLY)
+            gp.gp_file_new_from_fd(ctypes.byref(cam_file), fd)
         retval = gp.gp_camera_file_get(self.camera, 
                         cam_path.folder, cam_path.name, GP_FILE_TYPE_NORMAL, 
                         cam_file, context)
 
         if retval != GP_OK:
             gp.gp_file_unref(cam_file)
+            self.drop()
             raise Error('Unable to download')
         else:
             logging.debug("Download complete")        
 
-        logging.debug('** camera delete')
-        retval = gp.gp_camera_file_delete(self.camera, 
-                        cam_path.folder, cam_path.name, context)
-        if retval != GP_OK:
-            logging.error('delete error')
+        if writer:
+            data = ctypes.c_void_p()
+            length = ctypes.c_ulong()
+            retval = gp.gp_file_get_data_and_size(cam_file, 
+                            ctypes.byref(data), ctypes.byref(length))
+            if retval != GP_OK or data.value == None:
+                gp.gp_file_unref(cam_file)
+                raise Error('Unable to download')
+            buf = ctypes.string_at(data, length.value)
+
+        # with a writer, this may still be the only copy
+        if self.defer_delete or writer:
+            logging.debug('** camera delete queued')
+            self.pending_deletes.append([cam_path.folder, cam_path.name, 0])
         else:
-            logging.debug("delete complete")
+            logging.debug('** camera delete')
+            retval = gp.gp_camera_file_delete(self.camera, 
+                            cam_path.folder, cam_path.name, context)
+            if retval != GP_OK:
+                logging.error('delete error')
+            else:
+                logging.debug("delete complete")
         gp.gp_file_unref(cam_file)
 
-        self.release()
+        if writer:
+            writer.write(full_filename, buf)
 
         return full_filename
 
+    def set_defer_delete(self, defer):
+        """Turn deferred deletion on and off.
+
+        While deferred deletion is on, downloaded files are left on the
+        camera and remembered. Call delete_pending() to remove them all in
+        one go, perhaps when a sequence ends or when the program is idle.
+        """
+        self.defer_delete = defer
+
+    def get_pending_deletes(self):
+        """Return the number of files waiting to be deleted from the 
+        camera.
+        """
+        return len(self.pending_deletes)
+
+    @locked
+    def keep_pending(self):
+        """Forget the files queued by deferred deletion, leaving them on the
+        camera. Use this if we're not sure the downloaded copies are safe.
+        """
+        if len(self.pending_deletes) > 0:
+            logging.error('keeping %d files on the camera', 
+                          len(self.pending_deletes))
+        self.pending_deletes = []
+
+    def delete_pending(self):
+        """Delete all the files queued by deferred deletion.
+
+        Failed deletes are logged and kept for another try on the next call,
+        up to delete_retries times. Camera errors are not raised. Return the
+        number of files still waiting.
+        """
+        if len(self.pending_deletes) == 0:
+            return 0
+
+        was_connected = self.camera != None
+        try:
+            self.connect()
+        except Error as e:
+            logging.error('unable to delete, %s', str(e))
+            return len(self.pending_deletes)
+
+        logging.debug('** camera delete %d files', len(self.pending_deletes))
+        remaining = []
+        for item in self.pending_deletes:
+            folder, name, attempts = item
+            retval = gp.gp_camera_file_delete(self.camera, 
+                            folder, name, context)
+            if retval == GP_OK:
+                continue
+
+            item[2] = attempts + 1
+            if item[2] < delete_retries:
+                logging.error('delete error for %s/%s, will retry', 
+                              folder, name)
+                remaining.append(item)
+            else:
+                logging.error('delete error for %s/%s, giving up', 
+                              folder, name)
+        self.pending_deletes = remaining
+
+        # leave the connection as we found it
+        if not was_connected:
+            self.release()
+
+        return len(self.pending_deletes)
+
+    @locked
+    def poll_events(self, timeout=poll_timeout):
+        """Drain any pending camera events.
+
+        Wait up to timeout milliseconds for each event. Return True if the
+        camera reported a settings change, False if not, or None if this
+        camera can't report events. 
+
+        We only look at events on an existing connection, and not during a 
+        session, since the session will want any new file events for itself.
+        """
+        if self.camera == None or self.session_depth > 0:
+            return False
+
+        changed = False
+        while True:
+            evtype = ctypes.c_int()
+            evdata = ctypes.c_void_p()
+            retval = gp.gp_camera_wait_for_event(self.camera, timeout,
+                            ctypes.byref(evtype), ctypes.byref(evdata), 
+                            context)
+            if retval == GP_ERROR_NOT_SUPPORTED:
+                return None
+            if retval != GP_OK:
+                return changed
+
+            # PTP cameras report settings changes as unknown events with
+            # text like "PTP Property d10d changed"
+            if evtype.value == GP_EVENT_UNKNOWN and evdata.value:
+                text = ctypes.string_at(evdata)
+                if 'changed' in text:
+                    logging.debug('camera event: %s', text)
+                    changed = True
+
+            if evdata.value:
+                libc.free(evdata)
+
+            if evtype.value == GP_EVENT_TIMEOUT:
+                return changed
+
+    @locked
     def preview(self):
 
         """Connect and capture a preview frame. 
@@ -309,6 +678,7 @@ class Camera:
 
         return(data, length)
 
+    @locked
     def preview_to_file(self, filename):
 
         """Capture a preview frame to a file.
@@ -335,6 +705,7 @@ class Camera:
         if retval != GP_OK:
             gp.gp_file_unref(cam_file)
             logging.error('preview capture error')
+            self.drop()
             raise Error('Unable to capture preview')
 
         retval = gp.gp_file_save(cam_file, filename)
@@ -345,6 +716,7 @@ class Camera:
 
         gp.gp_file_unref(cam_file)
 
+    @locked
     def config_debug(self):
         self.connect()
 
@@ -358,6 +730,110 @@ class Camera:
 
         gp.gp_widget_free(widget)
 
+class Sequence:
+
+    """Capture a series of photos, overlapping download with exposure.
+
+    Each call to capture() fires the shutter, waits for the camera to save the
+    new file, and only then returns, so it's safe to change the lights for the
+    next shot. The file itself is downloaded during the next call to 
+    capture(), after that shot has been triggered, so USB transfer overlaps
+    with the next exposure. Call finish() to download the final file. 
+
+    Files are downloaded in the order they were captured. Any error stops the
+    sequence: capture() and finish() raise camera.Error and the remaining 
+    files are left on the camera.
+
+    We assume the camera saves one file per shot, so don't shoot RAW+JPEG.
+
+    Pass a writer.Writer to save files from a background thread. You need to
+    flush or close the writer yourself after finish(), then delete the files
+    from the camera with Camera.delete_pending(), see 
+    Camera.download_to_file().
+    """
+
+    def __init__(self, camera, writer=None):
+        self.camera = camera
+        self.writer = writer
+
+        # the (cam_path, filename) of the shot waiting to be downloaded
+        self.pending = None
+
+        # full filenames we've downloaded, in capture order
+        self.filenames = []
+
+    def download_pending(self):
+        if self.pending != None:
+            cam_path, filename = self.pending
+            self.pending = None
+            full_filename = self.camera.download_to_file(cam_path, filename,
+                                                         self.writer)
+            self.filenames.append(full_filename)
+
+    def capture(self, filename):
+        """Take a photo which will be saved to filename. 
+
+        The camera's preferred suffix is added to filename. Returns when the
+        exposure is complete. This method can raise camera.Error.
+        """
+        self.camera.trigger_capture()
+
+        # fetch the previous shot while this one is exposing
+        self.download_pending()
+
+        cam_path = self.camera.wait_for_file()
+        self.pending = (cam_path, filename)
+
+    def finish(self):
+        """Download the last file and return the list of full filenames we
+        wrote, in capture order. This method can raise camera.Error.
+        """
+        self.download_pending()
+        return self.filenames
+
+class Watcher:
+
+    """Watch a camera for settings changes from a background thread.
+
+    The camera is polled every watch_interval seconds. When the camera 
+    reports that a setting has changed, perhaps because someone turned a 
+    knob on the body, changed_cb is called with no arguments. It is called
+    from the watcher thread, so use glib.idle_add() or similar to get back
+    to the GUI.
+    """
+
+    def __init__(self, camera, changed_cb):
+        self.camera = camera
+        self.changed_cb = changed_cb
+        self.stopping = threading.Event()
+        self.supported = True
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        logging.debug('** camera watcher start')
+        while not self.stopping.is_set():
+            changed = self.camera.poll_events()
+            if changed == None:
+                logging.debug('** camera cannot report events')
+                self.supported = False
+                break
+            if changed:
+                self.changed_cb()
+            self.stopping.wait(watch_interval)
+        logging.debug('** camera watcher stop')
+
+    def get_supported(self):
+        """Return False if the camera turned out not to report events."""
+        return self.supported
+
+    def stop(self):
+        """Stop the watcher thread and wait for it to exit."""
+        self.stopping.set()
+        self.thread.join()
+
 """
 /** 
  * \brief Type of the widget to be created.
@@ -493,13 +969,15 @@ class Widget:
         gp.gp_widget_get_label(self.widget, ctypes.byref(label))
         return label.value
 
-    def get_value(self):
+    def get_value(self, wtype=None):
         """Return the value of the widget.
 
         The value may be int for TOGGLE, float for RANGE, and a string for
-        TEXT, MENU or RADIO.
+        TEXT, MENU or RADIO. Pass wtype if you already know it to save a
+        call into libgphoto2.
         """
-        wtype = self.get_wtype()
+        if wtype == None:
+            wtype = self.get_wtype()
         if wtype == GP_WIDGET_TOGGLE:
             value = ctypes.c_int()
         elif wtype == GP_WIDGET_RANGE:
@@ -569,20 +1047,58 @@ class Widget:
         wchanged = ctypes.c_int(changed)
         gp.gp_widget_set_changed(self.widget, wchanged)
 
+class Setting:
+    """A snapshot of one camera setting.
+
+    See Config.get_table(). Everything is read from libgphoto2 once, when the
+    snapshot is made. Settings have:
+
+    widget -- the Widget this setting was read from
+    name, label, wtype, value, readonly -- as Widget
+    choices -- a list of strings for MENU and RADIO, or None
+    range -- a (min, max, inc) tuple for RANGE, or None
+    children -- a list of the names of the child settings
+    depth -- the number of parents of this setting
+    """
+
+    def __init__(self, widget, depth):
+        self.widget = widget
+        self.depth = depth
+        self.wtype = widget.get_wtype()
+        self.name = widget.get_name()
+        self.label = widget.get_label()
+        self.readonly = widget.get_readonly()
+        self.value = widget.get_value(self.wtype)
+
+        self.choices = None
+        if self.wtype in [GP_WIDGET_MENU, GP_WIDGET_RADIO]:
+            self.choices = widget.get_choices()
+
+        self.range = None
+        if self.wtype == GP_WIDGET_RANGE:
+            self.range = widget.get_range()
+
+        self.children = []
+
 class Config:
     """Load, modify and save camera configuration."""
     def free_config(self):
         if self.root_widget:
             gp.gp_widget_free(self.root_widget)
             self.root_widget = ctypes.c_void_p()
+        self.table = None
 
     def refresh(self):
-        self.camera.connect()
+        self.camera.lock.acquire()
+        try:
+            self.camera.connect()
 
-        self.free_config()
-        self.root_widget = ctypes.c_void_p()
-        retval = gp.gp_camera_get_config(self.camera.camera, 
-                ctypes.byref(self.root_widget), context)
+            self.free_config()
+            self.root_widget = ctypes.c_void_p()
+            retval = gp.gp_camera_get_config(self.camera.camera, 
+                    ctypes.byref(self.root_widget), context)
+        finally:
+            self.camera.lock.release()
         if retval != GP_OK:
             raise Error('Unable to get config')
 
@@ -591,10 +1107,98 @@ class Config:
         self.camera = camera
 
         self.root_widget = None
+
+        # a hash from setting name to Setting, built on first use
+        self.table = None
+        self.root_name = None
+
         finalize.track(self, self, self.free_config)
 
         self.refresh()
 
+    def add_setting(self, widget, depth):
+        setting = Setting(widget, depth)
+        self.table[setting.name] = setting
+        for child in widget.get_children():
+            setting.children.append(self.add_setting(child, depth + 1))
+        return setting.name
+
+    def get_table(self):
+        """Return a hash from setting name to Setting. 
+
+        The whole widget tree is read in a single pass the first time you call
+        this, and again after each refresh(). 
+        """
+        if self.table == None:
+            self.table = {}
+            self.root_name = self.add_setting(self.get_root_widget(), 0)
+        return self.table
+
+    def get_root(self):
+        """Return the Setting for the top of the tree."""
+        self.get_table()
+        return self.table[self.root_name]
+
+    def get_setting(self, name):
+        """Return the named Setting. This method can raise camera.Error."""
+        table = self.get_table()
+        if not name in table:
+            raise Error('Setting not found', 
+                    'Setting %s not in widget tree.' % name)
+        return table[name]
+
+    def get_values(self):
+        """Return a hash from setting name to value for every setting."""
+        values = {}
+        for name, setting in self.get_table().items():
+            values[name] = setting.value
+        return values
+
+    def changes(self, values):
+        """Given a hash from setting name to value, return a hash of just the
+        writeable settings whose value differs from the camera's.
+        """
+        table = self.get_table()
+        changes = {}
+        for name, value in values.items():
+            if name in table:
+                setting = table[name]
+                if not setting.readonly and \
+                    setting.value != None and \
+                    setting.value != value:
+                    changes[name] = value
+        return changes
+
+    def set_values(self, values):
+        """Apply a hash from setting name to value.
+
+        Only the settings which have changed are written, with a single 
+        set_config(). If the write fails, the widgets are restored to their
+        old values and camera.Error is raised.
+
+        Return a list of the names of the settings we changed.
+        """
+        changes = self.changes(values)
+        if len(changes) == 0:
+            return []
+
+        table = self.get_table()
+        for name, value in changes.items():
+            table[name].widget.set_value(value)
+        try:
+            self.set_config()
+        except Error:
+            for name in changes:
+                setting = table[name]
+                setting.widget.set_value(setting.value)
+                setting.widget.set_changed(False)
+            raise
+
+        for name, value in changes.items():
+            table[name].value = value
+
+        return changes.keys()
+
     def get_root_widget(self):
         """Get the root Widget for a Config. 
         
@@ -611,44 +1215,45 @@ class Config:
         This method can raise camera.Error.
         """
         logging.debug('writing camera config ...')
-        self.camera.connect()
-        retval = gp.gp_camera_set_config(self.camera.camera, 
-                self.root_widget, context)
+        self.camera.lock.acquire()
+        try:
+            self.camera.connect()
+            retval = gp.gp_camera_set_config(self.camera.camera, 
+                    self.root_widget, context)
+        finally:
+            self.camera.lock.release()
         if retval != GP_OK:
             raise Error('Unable to set config')
 
-    def prettyprint(self, fp, widget, indent=0):
+    def prettyprint(self, fp):
         """Prettyprint the camera settings to a File."""
-        wtype = widget.get_wtype()
-        label = widget.get_label()
-        name = widget.get_name()
+        self.prettyprint_setting(fp, self.get_root())
+
+    def prettyprint_setting(self, fp, setting):
+        wtype = setting.wtype
+        indent = 2 * setting.depth
 
         fp.write('%s%s (%s) - %s\n' % 
-                (' ' * indent, label, name, WidgetType[wtype]))
+                (' ' * indent, setting.label, setting.name, WidgetType[wtype]))
 
         if wtype == GP_WIDGET_RANGE:
-            value = widget.get_value()
-            wmin, wmax, winc = widget.get_range()
+            wmin, wmax, winc = setting.range
             fp.write('%s(value = %f, min = %f, max = %f, inc = %f)\n' %  
-                    (' ' * indent, value, wmin, wmax, winc))
+                    (' ' * indent, setting.value, wmin, wmax, winc))
 
         if wtype == GP_WIDGET_TOGGLE:
-            value = widget.get_value()
-            fp.write('%s(value = %d)\n' % (' ' * indent, value))
+            fp.write('%s(value = %d)\n' % (' ' * indent, setting.value))
 
         if wtype == GP_WIDGET_TEXT:
-            value = widget.get_value()
-            fp.write('%s(value = %s)\n' % (' ' * indent, value))
+            fp.write('%s(value = %s)\n' % (' ' * indent, setting.value))
 
         if wtype == GP_WIDGET_MENU or wtype == GP_WIDGET_RADIO:
-            value = widget.get_value()
-            choices = widget.get_choices()
             fp.write('%s(value = %s, choices = %s)\n' % 
-                    (' ' * indent, value, choices))
+                    (' ' * indent, setting.value, setting.choices))
 
         # ignore DATE, it's fiddly 
         # WINDOW is only for the top-level, BUTTON is never used
         # SECTION just encloses children
 
-        for child in widget.get_children():
-            self.prettyprint(fp, child, indent + 2)
+        for name in setting.children:
+            self.prettyprint_setting(fp, self.table[name])
@@ -0,0 +1,855 @@
+#!/usr/bin/python
+
+"""Simulate a camera in place of libgphoto2.
+
+Simulator -- a fake camera with the libgphoto2 functions camera.py uses
+Error -- the exception we can raise
+test_card -- make a jpeg test image
+pad_jpeg -- pad a jpeg to a size
+
+The simulator has the same gp_* functions as libgphoto2, with the same
+arguments and return values, so camera.Camera and camera.Config run on it
+unchanged. Plug it in with:
+
+    camera.set_backend(camsim.Simulator())
+
+It makes preview frames and full-size captures, takes about as long as a
+Nikon D800 on USB2 for each operation, with some jitter, and can fail at
+random. The settings tree is modelled on the D800's. With this we can run
+and profile the preview, RTI capture and the settings window without a
+camera.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import os
+import ctypes
+import ctypes.util
+import random
+import struct
+import threading
+import time
+
+import camera
+
+# how long each operation takes, in seconds ... download is seconds per
+# megabyte, exposure is the time from trigger to the file appearing on the
+# card
+default_timings = {
+    'init': 0.5,
+    'exit': 0.05,
+    'preview': 0.05,
+    'trigger': 0.1,
+    'exposure': 0.6,
+    'download': 0.05,
+    'delete': 0.05,
+    'get_config': 0.3,
+    'set_config': 0.1
+}
+
+# the size of preview frames and captures, as a D800
+preview_size = (640, 426)
+capture_size = (7360, 4912)
+
+# we cycle through this many different preview frames
+preview_frames = 8
+
+# where new files appear on the card
+card_folder = '/store_00010001/DCIM/100NCD800'
+
+# more gphoto constants
+GP_ERROR_MODEL_NOT_FOUND = -105
+GP_ERROR_FILE_NOT_FOUND = -108
+
+# event data must be allocated with malloc(), camera.py frees it
+libc = ctypes.CDLL(ctypes.util.find_library('c'))
+libc.malloc.restype = ctypes.c_void_p
+libc.malloc.argtypes = [ctypes.c_size_t]
+
+class Error(Exception):
+
+    """An error from the simulator.
+
+    message -- a high-level description of the error
+    detail -- a string with some detailed diagnostics
+    """
+
+    def __init__(self, message, detail):
+        self.message = message
+        self.detail = detail
+
+        logging.debug('camsim: %s', repr(self))
+
+    def __str__(self):
+        return '%s - %s' % (self.message, self.detail)
+
+def test_card(width, height, frame = 0):
+    """Make a jpeg test image, a chequerboard with a bar whose position
+    depends on frame. Return a string.
+
+    We need gtk to encode the jpeg. This method can raise camsim.Error.
+    """
+    try:
+        import gtk
+    except (ImportError, RuntimeError) as e:
+        raise Error('Unable to make test image', str(e))
+
+    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width, height)
+    pixbuf.fill(0x404040ff)
+
+    square = max(8, width / 16)
+    for y in range(0, height, square):
+        for x in range(0, width, square):
+            if (x / square + y / square) % 2 == 0:
+                w = min(square, width - x)
+                h = min(square, height - y)
+                pixbuf.subpixbuf(x, y, w, h).fill(0xc0c0c0ff)
+
+    # a bar that moves from frame to frame, so we can see the preview update
+    bar = max(1, width / 32)
+    x = (frame * bar * 2) % (width - bar)
+    pixbuf.subpixbuf(x, 0, bar, height).fill(0xff8000ff)
+
+    chunks = []
+    pixbuf.save_to_callback(lambda buf, *args: chunks.append(buf),
+                            'jpeg', {'quality': '90'})
+
+    return ''.join(chunks)
+
+def pad_jpeg(data, size):
+    """Pad a jpeg with comment segments to about size bytes."""
+    segments = []
+    need = size - len(data)
+    while need > 4:
+        n = min(need - 4, 65533)
+        segments.append('\xff\xfe' + struct.pack('>H', n + 2) + '\0' * n)
+        need -= n + 4
+
+    return data[:2] + ''.join(segments) + data[2:]
+
+def load_jpeg(filename):
+    try:
+        f = open(filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError as e:
+        raise Error('Unable to load test image', str(e))
+
+def handle_value(handle):
+    """Handles come to us as ints or as c_void_p."""
+    if isinstance(handle, ctypes.c_void_p):
+        return handle.value
+    return handle
+
+class Image:
+
+    """A jpeg, as a string and as a block of memory we can hand out."""
+
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+        self.buffer = ctypes.create_string_buffer(data, self.length)
+
+class File:
+
+    """A CameraFile ... in memory, or writing to an fd."""
+
+    def __init__(self, fd = None):
+        self.fd = fd
+        self.image = None
+
+class Widget:
+
+    """A CameraWidget."""
+
+    def __init__(self, name, label, wtype, value = None, readonly = False,
+                 choices = None, wrange = None, children = None):
+        self.name = name
+        self.label = label
+        self.wtype = wtype
+        self.value = value
+        self.readonly = readonly
+        self.choices = choices or []
+        self.range = wrange
+        self.children = children or []
+        self.changed = False
+
+    def copy(self, values):
+        """Copy the tree, taking values from a dict."""
+        return Widget(self.name, self.label, self.wtype,
+                      values.get(self.name, self.value), self.readonly,
+                      self.choices, self.range,
+                      [child.copy(values) for child in self.children])
+
+    def find(self, name):
+        for child in self.children:
+            if child.name == name:
+                return child
+            widget = child.find(name)
+            if widget:
+                return widget
+        return None
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            for widget in child.walk():
+                yield widget
+
+def section(name, label, children):
+    return Widget(name, label, camera.GP_WIDGET_SECTION, children = children)
+
+def text(name, label, value, readonly = True):
+    return Widget(name, label, camera.GP_WIDGET_TEXT, value, readonly)
+
+def toggle(name, label, value, readonly = False):
+    return Widget(name, label, camera.GP_WIDGET_TOGGLE, value, readonly)
+
+def menu(name, label, value, choices, readonly = False):
+    return Widget(name, label, camera.GP_WIDGET_RADIO, value, readonly,
+                  choices)
+
+def slider(name, label, value, wrange, readonly = False):
+    return Widget(name, label, camera.GP_WIDGET_RANGE, value, readonly,
+                  wrange = wrange)
+
+def settings_tree():
+    """Make a settings tree like a Nikon D800's."""
+    speeds = ['1/8000', '1/6400', '1/5000', '1/4000', '1/3200', '1/2500',
+              '1/2000', '1/1600', '1/1250', '1/1000', '1/800', '1/640',
+              '1/500', '1/400', '1/320', '1/250', '1/200', '1/160', '1/125',
+              '1/100', '1/80', '1/60', '1/50', '1/40', '1/30', '1/25',
+              '1/20', '1/15', '1/13', '1/10', '1/8', '1/6', '1/5', '1/4',
+              '1/3', '10/25', '1/2', '10/16', '10/13', '1', '13/10',
+              '16/10', '2', '25/10', '3', '4', '5', '6', '8', '10', '13',
+              '15', '20', '25', '30', 'Bulb']
+    apertures = ['f/2.8', 'f/3.2', 'f/3.5', 'f/4', 'f/4.5', 'f/5', 'f/5.6',
+                 'f/6.3', 'f/7.1', 'f/8', 'f/9', 'f/10', 'f/11', 'f/13',
+                 'f/14', 'f/16', 'f/18', 'f/20', 'f/22']
+    isos = ['100', '125', '160', '200', '250', '320', '400', '500', '640',
+            '800', '1000', '1250', '1600', '2000', '2500', '3200', '4000',
+            '5000', '6400']
+
+    return Widget('main', 'Camera and Driver Configuration',
+                  camera.GP_WIDGET_WINDOW, children = [
+        section('actions', 'Camera Actions', [
+            toggle('autofocusdrive', 'Drive Nikon DSLR Autofocus', 0),
+            slider('manualfocusdrive', 'Drive Nikon DSLR Manual focus',
+                   0.0, (-32767.0, 32767.0, 1.0)),
+            toggle('viewfinder', 'Nikon Viewfinder', 0)]),
+        section('settings', 'Camera Settings', [
+            menu('capturetarget', 'Capture Target', 'Internal RAM',
+                 ['Internal RAM', 'Memory card']),
+            menu('recordingmedia', 'Recording Media', 'Card',
+                 ['Card', 'SDRAM']),
+            text('fastfs', 'Fast Filesystem', '1', False)]),
+        section('status', 'Camera Status Information', [
+            text('serialnumber', 'Serial Number', '6012345'),
+            text('manufacturer', 'Camera Manufacturer', 'Nikon Corporation'),
+            text('cameramodel', 'Camera Model', 'D800'),
+            text('deviceversion', 'Device Version', 'V1.10'),
+            text('batterylevel', 'Battery Level', '100%'),
+            slider('lightmeter', 'Light Meter', 0.0, (-8.0, 8.0, 0.1),
+                   True)]),
+        section('imgsettings', 'Image Settings', [
+            menu('imagequality', 'Image Quality', 'JPEG Fine',
+                 ['JPEG Basic', 'JPEG Normal', 'JPEG Fine', 'NEF (Raw)',
+                  'NEF+Basic', 'NEF+Normal', 'NEF+Fine', 'TIFF (RGB)']),
+            menu('imagesize', 'Image Size', '7360x4912',
+                 ['7360x4912', '5520x3680', '3680x2456']),
+            menu('iso', 'ISO Speed', '100', isos),
+            toggle('autoiso', 'Auto ISO', 0),
+            menu('whitebalance', 'WhiteBalance', 'Flash',
+                 ['Automatic', 'Daylight', 'Fluorescent', 'Tungsten',
+                  'Flash', 'Cloudy', 'Shade', 'Color Temperature',
+                  'Preset']),
+            menu('colorspace', 'Color Space', 'sRGB', ['sRGB', 'AdobeRGB'])]),
+        section('capturesettings', 'Capture Settings', [
+            menu('f-number', 'F-Number', 'f/8', apertures),
+            slider('focallength', 'Focal Length', 60.0, (60.0, 60.0, 1.0),
+                   True),
+            menu('focusmode', 'Focus Mode', 'Manual',
+                 ['Manual', 'AF-S', 'AF-C', 'AF-A']),
+            menu('exposurecompensation', 'Exposure Compensation', '0',
+                 ['-3', '-2.667', '-2.333', '-2', '-1.667', '-1.333', '-1',
+                  '-0.667', '-0.333', '0', '0.333', '0.667', '1', '1.333',
+                  '1.667', '2', '2.333', '2.667', '3']),
+            menu('expprogram', 'Exposure Program', 'M',
+                 ['M', 'P', 'A', 'S'], True),
+            menu('shutterspeed', 'Shutter Speed', '1/125', speeds),
+            menu('exposuremetermode', 'Exposure Metering Mode',
+                 'Center Weighted', ['Multi Spot', 'Center Weighted',
+                                     'Spot']),
+            menu('capturemode', 'Still Capture Mode', 'Single Shot',
+                 ['Single Shot', 'Burst', 'Timer', 'Quiet Release']),
+            toggle('longexpnr', 'Long Exp Noise Reduction', 0),
+            toggle('flashmode', 'Flash Mode', 0)])])
+
+class Simulator:
+
+    """A fake camera which looks like libgphoto2.
+
+    preview -- a jpeg file for preview frames, or None for test cards
+    capture -- a jpeg file for captures, or None for a test card
+    timings -- a dict of operation name to time, overriding
+        default_timings
+    jitter -- randomly vary each time by up to this fraction, 0 - 1
+    failure -- the chance that each operation fails, 0 - 1, or a dict of
+        operation name to chance
+    capture_bytes -- pad captures to about this many bytes, a D800 fine
+        jpeg is around 20MB
+    seed -- seed the random number generator with this, for repeatable
+        runs
+
+    All handles are small integers. Handles for things which are freed are
+    forgotten, so using them again is an error, as it would be with
+    libgphoto2.
+
+    Test cards need gtk, so they are only made on the first preview or
+    download. If that fails, the call logs the error and fails, as the
+    camera would.
+
+    This method can raise camsim.Error if a jpeg file can't be loaded.
+    """
+
+    def __init__(self, preview = None, capture = None, timings = None,
+                 jitter = 0.0, failure = 0.0, capture_bytes = 0,
+                 seed = None):
+        self.timings = dict(default_timings)
+        if timings:
+            self.timings.update(timings)
+        self.jitter = jitter
+        self.failure = failure
+        self.random = random.Random(seed)
+
+        # None until we make test cards, see get_previews() and 
+        # get_capture()
+        self.capture_bytes = capture_bytes
+        self.previews = None
+        self.capture = None
+        if preview:
+            self.previews = [Image(load_jpeg(preview))]
+        if capture:
+            self.capture = self.make_capture(load_jpeg(capture))
+
+        self.lock = threading.Lock()
+        self.handles = {}
+        self.next_handle = 1
+
+        self.tree = settings_tree()
+        self.values = {}
+        for widget in self.tree.walk():
+            self.values[widget.name] = widget.value
+
+        self.plugged = True
+        self.inited = set()
+        self.frame = 0
+        self.shots = 0
+
+        # the card, a dict of name to Image, or None for the capture image
+        # if we've not made it yet ... triggered shots wait in pending as 
+        # (time, name) until they are saved
+        self.card = {}
+        self.pending = []
+
+        # the text of unreported settings changes
+        self.events = []
+
+    def make_capture(self, data):
+        if self.capture_bytes > len(data):
+            data = pad_jpeg(data, self.capture_bytes)
+        return Image(data)
+
+    # these make test cards the first time they are called, so they can raise
+    # camsim.Error ... call holding the lock
+    def get_previews(self):
+        if self.previews == None:
+            self.previews = [Image(test_card(preview_size[0],
+                                             preview_size[1], i))
+                             for i in range(0, preview_frames)]
+        return self.previews
+
+    def get_capture(self):
+        if self.capture == None:
+            self.capture = self.make_capture(test_card(capture_size[0],
+                                                       capture_size[1]))
+        return self.capture
+
+    def new_handle(self, item):
+        self.lock.acquire()
+        try:
+            handle = self.next_handle
+            self.next_handle += 1
+            self.handles[handle] = item
+            return handle
+        finally:
+            self.lock.release()
+
+    def lookup(self, handle):
+        return self.handles.get(handle_value(handle))
+
+    def forget(self, handle):
+        handle = handle_value(handle)
+        self.lock.acquire()
+        try:
+            return self.handles.pop(handle, None)
+        finally:
+            self.lock.release()
+
+    def delay(self, operation, scale = 1.0):
+        seconds = self.timings[operation] * scale
+        if self.jitter > 0:
+            seconds *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def fails(self, operation):
+        if isinstance(self.failure, dict):
+            chance = self.failure.get(operation, 0.0)
+        else:
+            chance = self.failure
+        return chance > 0 and self.random.random() < chance
+
+    def log(self, domain, fmt):
+        funcs = [item for item in self.handles.values()
+                 if isinstance(item, camera.LOGFUNC)]
+        for func in funcs:
+            func(camera.GP_LOG_ERROR, domain, fmt, camera.VaList(), None)
+
+    # the libgphoto2 interface
+
+    def gp_context_new(self):
+        return self.new_handle('context')
+
+    def gp_log_add_func(self, level, func, data):
+        return self.new_handle(func)
+
+    def gp_log_remove_func(self, log_id):
+        self.forget(log_id)
+        return camera.GP_OK
+
+    def gp_camera_new(self, camera_ref):
+        camera_ref._obj.value = self.new_handle('camera')
+        return camera.GP_OK
+
+    def gp_camera_init(self, handle, context):
+        if self.lookup(handle) == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        if not self.plugged:
+            self.log('gphoto2-camera', 'Could not detect any camera')
+            return GP_ERROR_MODEL_NOT_FOUND
+        self.delay('init')
+        if self.fails('init'):
+            self.log('gphoto2-port-usb', 'Could not claim the USB device')
+            return camera.GP_ERROR_IO_INIT
+        self.inited.add(handle_value(handle))
+        return camera.GP_OK
+
+    def gp_camera_exit(self, handle, context):
+        if handle_value(handle) in self.inited:
+            self.delay('exit')
+            self.inited.discard(handle_value(handle))
+        return camera.GP_OK
+
+    def gp_camera_unref(self, handle):
+        self.forget(handle)
+        self.inited.discard(handle_value(handle))
+        return camera.GP_OK
+
+    def connected(self, handle):
+        if not self.plugged or not handle_value(handle) in self.inited:
+            self.log('gphoto2-port-usb', 'Camera not connected')
+            return False
+        return True
+
+    def shoot(self):
+        self.lock.acquire()
+        try:
+            self.shots += 1
+            return 'DSC_%04d.JPG' % (self.shots % 10000)
+        finally:
+            self.lock.release()
+
+    def save(self, name):
+        self.lock.acquire()
+        try:
+            self.card[name] = self.capture
+        finally:
+            self.lock.release()
+
+    def gp_camera_capture(self, handle, capture_type, path_ref, context):
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        self.delay('trigger')
+        if self.fails('trigger'):
+            self.log('ptp2/nikon_capture', 'Nikon Capture failed')
+            return camera.GP_ERROR
+        self.delay('exposure')
+        name = self.shoot()
+        self.save(name)
+        path_ref._obj.folder = card_folder
+        path_ref._obj.name = name
+        return camera.GP_OK
+
+    def gp_camera_trigger_capture(self, handle, context):
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        self.delay('trigger')
+        if self.fails('trigger'):
+            self.log('ptp2/nikon_capture', 'Nikon Capture failed')
+            return camera.GP_ERROR
+
+        exposure = self.timings['exposure']
+        if self.jitter > 0:
+            exposure *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        name = self.shoot()
+        self.lock.acquire()
+        try:
+            self.pending.append((time.time() + exposure, name))
+        finally:
+            self.lock.release()
+        return camera.GP_OK
+
+    def gp_camera_wait_for_event(self, handle, timeout, type_ref, data_ref,
+                                 context):
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+
+        now = time.time()
+        deadline = now + timeout / 1000.0
+        self.lock.acquire()
+        try:
+            text = None
+            name = None
+            if len(self.events) > 0:
+                text = self.events.pop(0)
+            elif len(self.pending) > 0 and self.pending[0][0] <= deadline:
+                (when, name) = self.pending.pop(0)
+        finally:
+            self.lock.release()
+
+        if text != None:
+            data = libc.malloc(len(text) + 1)
+            ctypes.memmove(data, text, len(text) + 1)
+            type_ref._obj.value = camera.GP_EVENT_UNKNOWN
+            data_ref._obj.value = data
+        elif name != None:
+            if when > now:
+                time.sleep(when - now)
+            self.save(name)
+            path = camera.CameraFilePath()
+            path.folder = card_folder
+            path.name = name
+            data = libc.malloc(ctypes.sizeof(path))
+            ctypes.memmove(data, ctypes.addressof(path), ctypes.sizeof(path))
+            type_ref._obj.value = camera.GP_EVENT_FILE_ADDED
+            data_ref._obj.value = data
+        else:
+            time.sleep(deadline - now)
+            type_ref._obj.value = camera.GP_EVENT_TIMEOUT
+            data_ref._obj.value = None
+
+        return camera.GP_OK
+
+    def gp_camera_capture_preview(self, handle, file_handle, context):
+        cam_file = self.lookup(file_handle)
+        if cam_file == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        self.delay('preview')
+        if self.fails('preview'):
+            # what a Nikon says when it's too busy to send a frame
+            self.log('ptp2/usb_getresp',
+                     'request code 0x%04x getting resp error 0x%04x')
+            return camera.GP_ERROR_IO_READ
+        self.lock.acquire()
+        try:
+            previews = self.get_previews()
+            cam_file.image = previews[self.frame % len(previews)]
+            self.frame += 1
+        except Error as e:
+            self.log('camsim', str(e).replace('%', '%%'))
+            return camera.GP_ERROR
+        finally:
+            self.lock.release()
+        return camera.GP_OK
+
+    def gp_camera_file_get(self, handle, folder, name, file_type,
+                           file_handle, context):
+        cam_file = self.lookup(file_handle)
+        if cam_file == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        self.lock.acquire()
+        try:
+            found = folder == card_folder and name in self.card
+            if found and self.card[name] == None:
+                self.card[name] = self.get_capture()
+            image = self.card.get(name)
+        except Error as e:
+            self.log('camsim', str(e).replace('%', '%%'))
+            return camera.GP_ERROR
+        finally:
+            self.lock.release()
+        if not found:
+            self.log('gphoto2-filesys', 'File not found')
+            return GP_ERROR_FILE_NOT_FOUND
+        self.delay('download', image.length / 1000000.0)
+        if self.fails('download'):
+            self.log('ptp2/usb_getdata', 'PTP I/O error')
+            return camera.GP_ERROR_IO_READ
+
+        cam_file.image = image
+        if cam_file.fd != None:
+            try:
+                offset = 0
+                while offset < image.length:
+                    offset += os.write(cam_file.fd, image.data[offset:])
+            except OSError as e:
+                self.log('gphoto2-file', str(e))
+                return camera.GP_ERROR_IO_WRITE
+        return camera.GP_OK
+
+    def gp_camera_file_delete(self, handle, folder, name, context):
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        if folder != card_folder or not name in self.card:
+            self.log('gphoto2-filesys', 'File not found')
+            return GP_ERROR_FILE_NOT_FOUND
+        self.delay('delete')
+        if self.fails('delete'):
+            self.log('ptp2', 'Device busy')
+            return camera.GP_ERROR
+        self.lock.acquire()
+        try:
+            del self.card[name]
+        finally:
+            self.lock.release()
+        return camera.GP_OK
+
+    def gp_file_new(self, file_ref):
+        file_ref._obj.value = self.new_handle(File())
+        return camera.GP_OK
+
+    def gp_file_new_from_fd(self, file_ref, fd):
+        file_ref._obj.value = self.new_handle(File(fd))
+        return camera.GP_OK
+
+    def gp_file_unref(self, file_handle):
+        cam_file = self.forget(file_handle)
+        if cam_file != None and cam_file.fd != None:
+            # libgphoto2 closes the fd when the file is freed
+            os.close(cam_file.fd)
+        return camera.GP_OK
+
+    def gp_file_get_data_and_size(self, file_handle, data_ref, length_ref):
+        cam_file = self.lookup(file_handle)
+        if cam_file == None or cam_file.fd != None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        if cam_file.image == None:
+            data_ref._obj.value = None
+            length_ref._obj.value = 0
+        else:
+            data_ref._obj.value = ctypes.addressof(cam_file.image.buffer)
+            length_ref._obj.value = cam_file.image.length
+        return camera.GP_OK
+
+    def gp_file_save(self, file_handle, filename):
+        cam_file = self.lookup(file_handle)
+        if cam_file == None or cam_file.image == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        try:
+            f = open(filename, 'wb')
+            try:
+                f.write(cam_file.image.data)
+            finally:
+                f.close()
+        except IOError as e:
+            self.log('gphoto2-file', str(e))
+            return camera.GP_ERROR_IO
+        return camera.GP_OK
+
+    def gp_camera_get_config(self, handle, widget_ref, context):
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        self.delay('get_config')
+        if self.fails('get_config'):
+            self.log('ptp2', 'PTP General Error')
+            return camera.GP_ERROR
+
+        self.lock.acquire()
+        try:
+            root = self.tree.copy(self.values)
+        finally:
+            self.lock.release()
+        for widget in root.walk():
+            widget.handle = self.new_handle(widget)
+        widget_ref._obj.value = root.handle
+        return camera.GP_OK
+
+    def gp_camera_set_config(self, handle, widget_handle, context):
+        root = self.lookup(widget_handle)
+        if root == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        if not self.connected(handle):
+            return camera.GP_ERROR_IO
+        self.delay('set_config')
+        if self.fails('set_config'):
+            self.log('ptp2', 'PTP Device Busy')
+            return camera.GP_ERROR
+
+        changed = [widget for widget in root.walk() if widget.changed]
+        for widget in changed:
+            if widget.readonly:
+                self.log('ptp2', 'Property %s is read only' % widget.name)
+                return camera.GP_ERROR_NOT_SUPPORTED
+            if widget.choices and not widget.value in widget.choices:
+                self.log('ptp2', 'Bad value for %s' % widget.name)
+                return camera.GP_ERROR_BAD_PARAMETERS
+
+        self.lock.acquire()
+        try:
+            for widget in changed:
+                self.values[widget.name] = widget.value
+                widget.changed = False
+        finally:
+            self.lock.release()
+        return camera.GP_OK
+
+    def gp_widget_free(self, widget_handle):
+        root = self.lookup(widget_handle)
+        if root != None:
+            for widget in root.walk():
+                self.forget(widget.handle)
+        return camera.GP_OK
+
+    def gp_widget_count_children(self, widget_handle):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        return len(widget.children)
+
+    def gp_widget_get_child(self, widget_handle, i, child_ref):
+        widget = self.lookup(widget_handle)
+        if widget == None or i < 0 or i >= len(widget.children):
+            return camera.GP_ERROR_BAD_PARAMETERS
+        child_ref._obj.value = widget.children[i].handle
+        return camera.GP_OK
+
+    def gp_widget_get_child_by_name(self, widget_handle, name, child_ref):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        child = widget.find(name)
+        if child == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        child_ref._obj.value = child.handle
+        return camera.GP_OK
+
+    def widget_get(self, widget_handle, ref, field):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        ref._obj.value = getattr(widget, field)
+        return camera.GP_OK
+
+    def gp_widget_get_type(self, widget_handle, wtype_ref):
+        return self.widget_get(widget_handle, wtype_ref, 'wtype')
+
+    def gp_widget_get_name(self, widget_handle, name_ref):
+        return self.widget_get(widget_handle, name_ref, 'name')
+
+    def gp_widget_get_label(self, widget_handle, label_ref):
+        return self.widget_get(widget_handle, label_ref, 'label')
+
+    def gp_widget_get_value(self, widget_handle, value_ref):
+        return self.widget_get(widget_handle, value_ref, 'value')
+
+    def gp_widget_get_readonly(self, widget_handle, readonly_ref):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        readonly_ref._obj.value = int(widget.readonly)
+        return camera.GP_OK
+
+    def gp_widget_count_choices(self, widget_handle):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        return len(widget.choices)
+
+    def gp_widget_get_choice(self, widget_handle, i, choice_ref):
+        widget = self.lookup(widget_handle)
+        if widget == None or i < 0 or i >= len(widget.choices):
+            return camera.GP_ERROR_BAD_PARAMETERS
+        choice_ref._obj.value = widget.choices[i]
+        return camera.GP_OK
+
+    def gp_widget_get_range(self, widget_handle, min_ref, max_ref, inc_ref):
+        widget = self.lookup(widget_handle)
+        if widget == None or widget.range == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        (min_ref._obj.value, max_ref._obj.value, inc_ref._obj.value) = \
+            widget.range
+        return camera.GP_OK
+
+    def gp_widget_set_value(self, widget_handle, value):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        # int and float are passed by reference, strings as a char *
+        if hasattr(value, '_obj'):
+            value = value._obj
+        widget.value = value.value
+        widget.changed = True
+        return camera.GP_OK
+
+    def gp_widget_set_changed(self, widget_handle, changed):
+        widget = self.lookup(widget_handle)
+        if widget == None:
+            return camera.GP_ERROR_BAD_PARAMETERS
+        widget.changed = changed.value != 0
+        return camera.GP_OK
+
+    # control the simulation
+
+    def unplug(self):
+        """Disconnect the camera. All operations fail until plug()."""
+        logging.debug('camsim: unplugged')
+        self.plugged = False
+        self.inited.clear()
+
+    def plug(self):
+        """Reconnect the camera."""
+        logging.debug('camsim: plugged')
+        self.plugged = True
+
+    def turn_knob(self, name, value):
+        """Change a setting as if on the camera body. The next camera event
+        reports it.
+        """
+        self.lock.acquire()
+        try:
+            self.values[name] = value
+            self.events.append('PTP Property %s changed' % name)
+        finally:
+            self.lock.release()
+
+    def get_card(self):
+        """Return the names of the files on the card."""
+        self.lock.acquire()
+        try:
+            return sorted(self.card.keys())
+        finally:
+            self.lock.release()
+
+    def get_shots(self):
+        """Return the number of photos taken so far."""
+        return self.shots
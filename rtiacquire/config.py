@@ -26,6 +26,9 @@ class Config(gtk.Window):
     """Display and edit the camera config."""
 
     def destroy_cb(self, widget, data = None):
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
         if self.refresh_timeout:
             glib.source_remove(self.refresh_timeout)
             self.refresh_timeout = 0
@@ -44,13 +47,13 @@ class Config(gtk.Window):
 
         return hb
 
-    def widget_set(self, widget, item, value):
+    def widget_set(self, widget, setting, value):
         if isinstance(widget, gtk.Scale):
             widget.set_value(value)
         elif isinstance(widget, gtk.Entry):
             widget.set_text(value)
         elif isinstance(widget, gtk.ComboBox):
-            choices = item.get_choices()
+            choices = setting.choices
             if value in choices:
                 widget.set_active(choices.index(value))
         elif isinstance(widget, gtk.CheckButton):
@@ -58,63 +61,82 @@ class Config(gtk.Window):
         else:
             logging.error('unknown widget type')
 
-    def widget_get(self, widget, item):
+    def widget_get(self, widget, setting):
         if isinstance(widget, gtk.Scale):
             return widget.get_value()
         elif isinstance(widget, gtk.Entry):
             return widget.get_text()
         elif isinstance(widget, gtk.ComboBox):
-            return item.get_choices()[widget.get_active()]
+            return setting.choices[widget.get_active()]
         elif isinstance(widget, gtk.CheckButton):
             return widget.get_active()
         else:
             logging.error('unknown widget type')
             return None
 
-    def get_settings(self, item):
-        """Get the settings from a tree of items as a hash."""
-        settings = {}
-        settings[item.get_name()] = item.get_value()
-        for child in item.get_children():
-            settings.update(self.get_settings(child))
-        return settings
+    def get_settings(self):
+        """Get the current camera settings as a hash."""
+        return self.config.get_values()
 
     def set_settings(self, settings):
-        """Apply a set of settings."""
-        root_widget = self.config.get_root_widget()
-        for name in settings:
-            item = root_widget.get_child_by_name(name)
-            # we can't set readonly items
-            if not item.get_readonly():
-                item.set_value(settings[name])
+        """Apply a set of settings.
+
+        Only settings which differ from the camera are sent.
+        """
         try:
-            self.config.set_config()
+            self.config.set_values(settings)
         except camera.Error as e:
             logging.error('unable to set settings, %s', repr(e))
         self.refresh()
 
-    def refresh_item(self, item):
-        name = item.get_name()
-        # not all camera settings will have GUI widgets
-        if name in self.widget_table:
-            widget = self.widget_table[name]
-            self.widget_set(widget, item, item.get_value())
-            widget.set_sensitive(not item.get_readonly())
-        for child in item.get_children():
-            self.refresh_item(child)
+    def refresh_item(self, setting):
+        widget = self.widget_table[setting.name]
+        self.widget_set(widget, setting, setting.value)
+        widget.set_sensitive(not setting.readonly)
 
     def refresh(self):
-        """Update the GUI from the camera."""
+        """Update the GUI from the camera.
+
+        Only widgets whose setting has changed are updated.
+        """
+        old_table = self.config.get_table()
         self.config.refresh() 
-        self.refresh_item(self.config.get_root_widget()) 
+        table = self.config.get_table()
+
+        # not all camera settings will have GUI widgets
+        for name in self.widget_table:
+            if not name in table:
+                continue
+            setting = table[name]
+            if name in old_table:
+                old_setting = old_table[name]
+                if old_setting.value == setting.value and \
+                    old_setting.readonly == setting.readonly:
+                    continue
+            self.refresh_item(setting)
 
     def refresh_cb(self, widget, data = None):
         self.refresh() 
 
     def refresh_queue_cb(self):
+        self.refresh_timeout = 0
         self.refresh() 
         return False
 
+    # called from the watcher thread
+    def camera_changed_cb(self):
+        glib.idle_add(self.camera_changed_idle_cb)
+
+    def camera_changed_idle_cb(self):
+        # we may have been closed since the event arrived
+        if self.watcher:
+            # this refresh covers any we queued after a change
+            if self.refresh_timeout:
+                glib.source_remove(self.refresh_timeout)
+                self.refresh_timeout = 0
+            self.refresh()
+        return False
+
     def refresh_queue(self):
         if self.refresh_timeout:
             glib.source_remove(self.refresh_timeout)
@@ -176,7 +198,7 @@ class Config(gtk.Window):
     def add_cb(self, widget, data = None):
         name = 'preset-%d' % self.preset_number
         self.preset_number += 1
-        settings = self.get_settings(self.config.get_root_widget()) 
+        settings = self.get_settings() 
         self.preset_add(name, settings)
 
     def remove_cb(self, widget, data = None):
@@ -186,28 +208,26 @@ class Config(gtk.Window):
             self.preset_remove(name)
 
     def update_item_cb(self, widget, name):
-        item = self.config.get_root_widget().get_child_by_name(name)
-        new_value = self.widget_get(widget, item)
-        old_value = item.get_value()
+        setting = self.config.get_setting(name)
+        new_value = self.widget_get(widget, setting)
+        old_value = setting.value
         logging.debug('update_item_cb: %s, new = %s, old = %s', 
                 name, str(new_value), str(old_value))
         if new_value != old_value:
-            item.set_value(new_value)
             try:
-                self.config.set_config()
+                self.config.set_values({name: new_value})
             except camera.Error as e:
                 logging.debug('set error, restoring old value, %s', str(e))
-                item.set_value(old_value)
-                # we've restored the old value, so next time we update the
-                # camera we don't need to resend this setting
-                item.set_changed(False)
                 # restore the old widget setting 
                 # this will cause us to be triggered again, but the new!=old
                 # test above will prevent looping
-                self.widget_set(widget, item, old_value)
+                self.widget_set(widget, setting, old_value)
             else:
                 # successful change ... changing one setting may change many
-                # others, so we have to refresh the GUI from the camera
+                # others, so we have to refresh the GUI from the camera ...
+                # the watcher will see the camera's change events and
+                # refresh early, but not all cameras send them, even if 
+                # they can report events
                 self.refresh_queue()
 
                 # we've changed a value, so we can no longer be showing one of
@@ -217,11 +237,12 @@ class Config(gtk.Window):
     def build_page(self, section, vb): 
         sg = gtk.SizeGroup(gtk.SIZE_GROUP_HORIZONTAL)
 
-        for item in section.get_children():
-            wtype = item.get_wtype()
-            name = item.get_name()
-            label = item.get_label()
-            value = item.get_value()
+        table = self.config.get_table()
+        for name in section.children:
+            item = table[name]
+            wtype = item.wtype
+            label = item.label
+            value = item.value
 
             if value == None:
                 continue
@@ -244,7 +265,7 @@ class Config(gtk.Window):
                 b.show()
 
             if wtype in [camera.GP_WIDGET_MENU, camera.GP_WIDGET_RADIO]:
-                choices = item.get_choices()
+                choices = item.choices
                 widget = self.align_label(sg, label)
                 b = gtk.combo_box_new_text()
                 self.widget_table[name] = b
@@ -257,7 +278,7 @@ class Config(gtk.Window):
                 b.show()
 
             if wtype == camera.GP_WIDGET_RANGE:
-                wmin, wmax, winc = item.get_range()
+                wmin, wmax, winc = item.range
                 if wmin == wmax:
                     continue
                 widget = self.align_label(sg, label)
@@ -272,7 +293,7 @@ class Config(gtk.Window):
 
             if widget != None:
                 widget.show()
-                widget.set_sensitive(not item.get_readonly())
+                widget.set_sensitive(not item.readonly)
                 vb.pack_start(widget, False);
 
     def __init__(self, options, cam):
@@ -284,6 +305,7 @@ class Config(gtk.Window):
         self.config = camera.Config(self.camera)
 
         self.refresh_timeout = 0
+        self.watcher = None
 
         # a hash from item name to the widget that displays it
         self.widget_table = {}
@@ -298,7 +320,8 @@ class Config(gtk.Window):
 
         self.presets_load(os.path.join(self.options.tempdir, 'settings'))
 
-        self.set_title(self.config.get_root_widget().get_label())
+        root = self.config.get_root()
+        self.set_title(root.label)
 
         self.set_default_size(-1, 300)
 
@@ -311,7 +334,8 @@ class Config(gtk.Window):
         vbox.pack_start(book, True)
         book.show()
 
-        for section in self.config.get_root_widget().get_children():
+        for name in root.children:
+            section = self.config.get_setting(name)
             page = gtk.ScrolledWindow()
             page.show()
 
@@ -322,7 +346,7 @@ class Config(gtk.Window):
 
             self.build_page(section, vb)
 
-            label = gtk.Label (section.get_label())
+            label = gtk.Label (section.label)
             label.show()
 
             book.append_page(page, label)
@@ -382,6 +406,8 @@ class Config(gtk.Window):
         button.show()
 
         # make a preset for what we had at startup
-        settings = self.get_settings(self.config.get_root_widget()) 
+        settings = self.get_settings() 
         self.preset_add('startup', settings)
 
+        # pick up changes made on the camera body
+        self.watcher = camera.Watcher(self.camera, self.camera_changed_cb)
@@ -6,6 +6,15 @@ This module makes use of a small C library built from dejpeg.c. See comments
 in there for build instructions.
 
 bufjpeg2pixbuf -- decompress a jpeg from a memory area to a gtk.gdk.Pixbuf
+filejpeg2pixbuf -- decompress a jpeg file to a gtk.gdk.Pixbuf, eg. a thumbnail
+batchjpeg2pixbuf -- decompress many jpegs at once, one thread per CPU
+FramePool -- decompress jpegs into a set of reusable gtk.gdk.Pixbufs
+bufjpeg2array -- decompress a jpeg from a memory area to a numpy array
+pixbuf2array -- make a numpy array that shares pixels with a gtk.gdk.Pixbuf
+array2pixbuf -- get a gtk.gdk.Pixbuf for a numpy array
+
+The numpy functions need numpy, the rest of the module works without it.
+
 Author: J.Cupitt
 Created as part of the AHRC RTI project in 2011
 GNU LESSER GENERAL PUBLIC LICENSE
@@ -14,6 +23,7 @@ GNU LESSER GENERAL PUBLIC LICENSE
 import logging
 import ctypes
 import os
+import threading
 
 import pygtk
 pygtk.require('2.0')
@@ -21,33 +31,103 @@ import gtk
 
 import finalize
 
+# numpy is optional, it's only needed for the array interface
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # get the directory this source is in
 source_dir = os.path.dirname(__file__)
 
 # Load library
 decompress = ctypes.CDLL(os.path.join(source_dir, 'dejpeg.so'))
 
+# we need to find the pixels inside a Pixbuf ourselves, pygtk only gives us
+# a copy ... this looks inside a Python object, so it must hold the GIL, load
+# it again with PyDLL
+decompress_py = ctypes.PyDLL(os.path.join(source_dir, 'dejpeg.so'))
+decompress_py.pixbuf_pixels.restype = ctypes.c_void_p
+decompress_py.pixbuf_pixels.argtypes = [ctypes.py_object]
+
+# the number of spare frames a FramePool keeps
+pool_size = 4
+
 class Image(ctypes.Structure):
     _fields_ = [('width', ctypes.c_int),
                 ('height', ctypes.c_int),
                 ('pixels', ctypes.c_void_p)]
 
+class Options(ctypes.Structure):
+    _fields_ = [('shrink', ctypes.c_int),
+                ('fast', ctypes.c_int),
+                ('crop_left', ctypes.c_int),
+                ('crop_top', ctypes.c_int),
+                ('crop_width', ctypes.c_int),
+                ('crop_height', ctypes.c_int)]
+
+class Job(ctypes.Structure):
+    _fields_ = [('filename', ctypes.c_char_p),
+                ('buf', ctypes.c_void_p),
+                ('len', ctypes.c_size_t),
+                ('out', Image),
+                ('rowstride', ctypes.c_int),
+                ('max_width', ctypes.c_int),
+                ('max_height', ctypes.c_int),
+                ('status', ctypes.c_int)]
+
+def make_options(shrink, fast, crop = None):
+    """Make an Options for decompress.
+
+    shrink -- 1, 2, 4 or 8, shrink during decode
+    fast -- True for a faster, slightly lower quality decode
+    crop -- None, or a (left, top, width, height) tuple to decode just that
+        area, in pixels after shrink
+    """
+    if crop == None:
+        crop = (0, 0, 0, 0)
+    (left, top, width, height) = crop
+    return Options(shrink, int(fast), left, top, width, height)
+
+def pixbuf_pixels(pixbuf):
+    """Return the address of the pixels in a gtk.gdk.Pixbuf.
+
+    This function can raise TypeError.
+    """
+    # dejpeg.c gets the GObject with the pygobject headers, we must not 
+    # guess the layout of the wrapper
+    if not isinstance(pixbuf, gtk.gdk.Pixbuf):
+        raise TypeError('not a gtk.gdk.Pixbuf')
+    pixels = decompress_py.pixbuf_pixels(pixbuf)
+    if not pixels:
+        raise TypeError('unable to find Pixbuf pixels')
+    return pixels
+
 def finalize_image(image):
     logging.debug('finalizing image %s', repr(image))
     decompress.image_free(ctypes.byref(image))
 
-def bufjpeg2pixbuf(data, length):
+def bufjpeg2pixbuf(data, length, shrink = 1, fast = False, crop = None):
 
     """Decompress to a Pixbuf.
 
     Decompress the jpeg held in the memory area indicated by(data, length),
     construct a gtk.gdk.Pixbuf, and return it.
 
+    shrink -- 1, 2, 4 or 8, shrink by this factor during decode
+    fast -- True for a faster, slightly lower quality decode
+    crop -- None, or (left, top, width, height) to decode just that area
+
+    Shrinking and cropping during decode are much faster than doing them 
+    afterwards.
     """
 
     logging.debug('decompress: starting ...')
     image = Image()
-    retval = decompress.decompress(data, length, ctypes.byref(image))
+    options = make_options(shrink, fast, crop)
+    retval = decompress.decompress_options(data, length, 
+                                           ctypes.byref(image), 
+                                           ctypes.byref(options))
     if retval != 0:
         logging.error('decompress failed')
         finalize_image(image)
@@ -66,3 +146,277 @@ def bufjpeg2pixbuf(data, length):
 
     return pixbuf
 
+def filejpeg2pixbuf(filename, shrink = 8, fast = True):
+
+    """Decompress a jpeg file to a Pixbuf.
+
+    By default, decode at 1/8th size with the fast decoder. This is handy
+    for making thumbnails of full-res captures. Return None on error.
+    """
+
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    return bufjpeg2pixbuf(data, len(data), shrink, fast)
+
+def batchjpeg2pixbuf(sources, shrink = 1, fast = False, frames = None, 
+                     threads = 0):
+
+    """Decompress a list of jpegs to Pixbufs.
+
+    sources -- a list of filenames or (data, length) pairs
+    shrink -- 1, 2, 4 or 8, shrink by this factor during decode
+    fast -- True for a faster, slightly lower quality decode
+    frames -- None, or a list of Pixbufs to decompress into, one per source
+    threads -- the number of threads to use, 0 means one per CPU
+
+    The jpegs are decoded in parallel by a set of native threads. The GIL is
+    released for the whole batch.
+
+    Return a list with a Pixbuf for each source, or None for sources which
+    could not be read or decoded, or which did not fit their frame. With 
+    frames, images are decompressed into the frames with no copy, and 
+    frames may be larger than the image.
+    """
+
+    logging.debug('decompress: starting batch of %d ...', len(sources))
+    jobs = (Job * len(sources))()
+    for i in range(0, len(sources)):
+        job = jobs[i]
+        source = sources[i]
+        if isinstance(source, str):
+            job.filename = source
+        else:
+            (data, length) = source
+            # we must keep the python string alive during the decode, the 
+            # caller's sources list does that for us
+            if isinstance(data, str):
+                data = ctypes.c_char_p(data)
+            if isinstance(length, ctypes.c_ulong):
+                length = length.value
+            job.buf = ctypes.cast(data, ctypes.c_void_p)
+            job.len = length
+
+        if frames:
+            frame = frames[i]
+            job.out.pixels = pixbuf_pixels(frame)
+            job.rowstride = frame.get_rowstride()
+            job.max_width = frame.get_width()
+            job.max_height = frame.get_height()
+
+    options = make_options(shrink, fast)
+    failed = decompress.decompress_batch(jobs, len(sources), 
+                                         ctypes.byref(options), threads)
+    logging.debug('decompress: batch done, %d failed', failed)
+
+    result = []
+    for i in range(0, len(sources)):
+        job = jobs[i]
+        if job.status != 0:
+            logging.error('decompress of item %d failed', i)
+            pixbuf = None
+            if not frames:
+                finalize_image(job.out)
+        elif frames:
+            pixbuf = frames[i]
+            if job.out.width != pixbuf.get_width() or \
+                job.out.height != pixbuf.get_height():
+                pixbuf = pixbuf.subpixbuf(0, 0, 
+                                          job.out.width, job.out.height)
+        else:
+            string = ctypes.string_at(job.out.pixels, 
+                                      job.out.width * job.out.height * 3)
+            finalize_image(job.out)
+            pixbuf = gtk.gdk.pixbuf_new_from_data(string, 
+                        gtk.gdk.COLORSPACE_RGB, False, 8, 
+                        job.out.width, job.out.height, job.out.width * 3)
+        result.append(pixbuf)
+
+    return result
+
+def bufjpeg2array(data, length, shrink = 1, fast = False, crop = None):
+
+    """Decompress to a numpy array.
+
+    Decompress the jpeg held in the memory area indicated by (data, length)
+    and return a height x width x 3 uint8 numpy array, or None on error. See
+    bufjpeg2pixbuf() for the options.
+
+    The array uses the decompressed pixels directly, they are freed when
+    the array, and any views of it, are garbage collected.
+    """
+
+    if numpy == None:
+        logging.error('decompress: numpy not available')
+        return None
+
+    logging.debug('decompress: starting ...')
+    image = Image()
+    options = make_options(shrink, fast, crop)
+    retval = decompress.decompress_options(data, length, 
+                                           ctypes.byref(image), 
+                                           ctypes.byref(options))
+    if retval != 0:
+        logging.error('decompress failed')
+        finalize_image(image)
+        return None
+    logging.debug('decompress: done')
+
+    size = image.width * image.height * 3
+    pixels = (ctypes.c_uint8 * size).from_address(image.pixels)
+    finalize.track(pixels, image, finalize_image)
+
+    # the array holds a ref to pixels, so pixels lives as long as the array
+    return numpy.ndarray((image.height, image.width, 3), numpy.uint8, pixels)
+
+def pixbuf2array(pixbuf):
+    """Return a height x width x 3 numpy array of the pixels in a Pixbuf.
+
+    There's no copy, changing the array changes the Pixbuf. The array keeps
+    the Pixbuf alive. The Pixbuf must be 8-bit RGB with no alpha. Return
+    None if numpy is not available.
+    """
+    if numpy == None:
+        logging.error('decompress: numpy not available')
+        return None
+
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    rowstride = pixbuf.get_rowstride()
+
+    # the final line is not padded out to rowstride
+    size = rowstride * (height - 1) + width * 3
+    pixels = (ctypes.c_uint8 * size).from_address(pixbuf_pixels(pixbuf))
+    pixels.pixbuf = pixbuf
+
+    return numpy.ndarray((height, width, 3), numpy.uint8, pixels,
+                         strides = (rowstride, 3, 1))
+
+def array2pixbuf(array):
+    """Return a Pixbuf for a height x width x 3 uint8 numpy array.
+
+    If the array came from pixbuf2array(), this is just the original 
+    Pixbuf, otherwise the array is copied to a new Pixbuf. Return None if
+    numpy is not available.
+    """
+    if numpy == None:
+        logging.error('decompress: numpy not available')
+        return None
+
+    (height, width, bands) = array.shape
+
+    base = array
+    while isinstance(base, numpy.ndarray):
+        base = base.base
+    pixbuf = getattr(base, 'pixbuf', None)
+    if pixbuf != None and \
+        pixbuf.get_width() == width and \
+        pixbuf.get_height() == height and \
+        array.strides == (pixbuf.get_rowstride(), 3, 1) and \
+        array.ctypes.data == pixbuf_pixels(pixbuf):
+        return pixbuf
+
+    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width, height)
+    pixbuf2array(pixbuf)[:] = array
+
+    return pixbuf
+
+class FramePool:
+
+    """Decompress jpegs into a set of reusable Pixbufs.
+
+    Frames are decompressed directly into the pixels of a gtk.gdk.Pixbuf
+    taken from the pool, with no intermediate buffer or copy. Hand frames
+    back with release() once they are no longer displayed so they can be
+    reused.
+
+    The pool starts at 640x426 and resizes itself if the camera sends frames
+    of a different size. acquire(), release() and decompress() can be called
+    from any thread.
+    """
+
+    def __init__(self, width = 640, height = 426, shrink = 1, fast = False):
+        self.lock = threading.Lock()
+        self.width = width
+        self.height = height
+        self.free = []
+        self.options = make_options(shrink, fast)
+
+    def set_options(self, shrink, fast, crop = None):
+        """Set the decode options, see bufjpeg2pixbuf().
+
+        Frames shrink and crop on decode, the pool will resize itself on the
+        next frame.
+        """
+        self.options = make_options(shrink, fast, crop)
+
+    def acquire(self):
+        """Get a frame from the pool, making a new one if necessary."""
+        self.lock.acquire()
+        try:
+            if len(self.free) > 0:
+                return self.free.pop()
+            width = self.width
+            height = self.height
+        finally:
+            self.lock.release()
+
+        logging.debug('decompress: new %d x %d pool frame', width, height)
+        return gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, width, height)
+
+    def release(self, pixbuf):
+        """Return a frame to the pool."""
+        self.lock.acquire()
+        try:
+            if pixbuf.get_width() == self.width and \
+                pixbuf.get_height() == self.height and \
+                not pixbuf.get_has_alpha() and \
+                len(self.free) < pool_size:
+                self.free.append(pixbuf)
+        finally:
+            self.lock.release()
+
+    def resize(self, width, height):
+        self.lock.acquire()
+        try:
+            logging.debug('decompress: pool resize to %d x %d', width, height)
+            self.width = width
+            self.height = height
+            self.free = []
+        finally:
+            self.lock.release()
+
+    def decompress(self, data, length):
+        """Decompress the jpeg in (data, length) into a frame from the pool.
+
+        Return the Pixbuf, or None on error.
+        """
+        logging.debug('decompress: starting ...')
+
+        # we may need a second try if the frame size changes
+        for i in range(0, 2):
+            pixbuf = self.acquire()
+            image = Image()
+            image.pixels = pixbuf_pixels(pixbuf)
+            retval = decompress.decompress_into(data, length, 
+                            ctypes.byref(image), pixbuf.get_rowstride(),
+                            pixbuf.get_width(), pixbuf.get_height(),
+                            ctypes.byref(self.options))
+            if retval == 0 and \
+                image.width == pixbuf.get_width() and \
+                image.height == pixbuf.get_height():
+                logging.debug('decompress: done')
+                return pixbuf
+
+            if retval == -1:
+                break
+
+            self.resize(image.width, image.height)
+
+        logging.error('decompress failed')
+        self.release(pixbuf)
+
+        return None
@@ -4,31 +4,59 @@
  *
  * on linux, compile with
  
-  	gcc -c -Wall -shared -fPIC dejpeg.c 
- 	ld -shared dejpeg.o -o dejpeg.so -ljpeg
-
- * it needs the jpeg headers to compile --- if they are not installed, get
- * them with
+  	gcc -c -Wall -shared -fPIC dejpeg.c \
+		`python-config --includes` \
+		`pkg-config --cflags pygobject-2.0 gdk-pixbuf-2.0`
+ 	ld -shared dejpeg.o -o dejpeg.so -ljpeg -lpthread \
+		`pkg-config --libs gdk-pixbuf-2.0`
+
+ * it needs the jpeg, python and pygobject headers to compile --- if they 
+ * are not installed, get them with
  *
- * 	sudo apt-get install libjpeg62-dev
+ * 	sudo apt-get install libjpeg62-dev python-dev python-gobject-dev \
+ * 		libgdk-pixbuf2.0-dev
  */
 
 /*
  * 3/5/11
  * 	- hacked from libvips sources
+ * 18/10/26
+ * 	- add decompress_into() to write to a caller's buffer
+ * 	- add Options for shrink-on-load and fast decode
+ * 	- add crop to Options, decode just a region
+ * 	- add decompress_batch() to decode many images on a set of threads
+ * 	- add pixbuf_pixels() to find the pixels in a pygtk Pixbuf
  */
 
 /*
 #define DEBUG
  */
 
+/* Python.h must come first.
+ */
+#include <Python.h>
+#include <pygobject.h>
+#include <gdk-pixbuf/gdk-pixbuf.h>
+
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <setjmp.h>
+#include <unistd.h>
+#include <pthread.h>
 
 #include <jpeglib.h>
 #include <jerror.h>
 
+/* libjpeg-turbo 1.5 and later can skip whole scanlines and decode just part
+ * of each line. With other libjpegs we have to decode everything and throw
+ * most of it away.
+ */
+#if defined( LIBJPEG_TURBO_VERSION_NUMBER ) && \
+	LIBJPEG_TURBO_VERSION_NUMBER >= 1005000
+#define HAVE_CROP
+#endif
+
 /* A decompressed image.
  */
 typedef struct _Image {
@@ -37,13 +65,62 @@ typedef struct _Image {
 	void *pixels;
 } Image;
 
+/* Decode options. Pass NULL for full size, accurate decode.
+ */
+typedef struct _Options {
+	/* Shrink by 1, 2, 4 or 8 during decode. Shrinking happens in the DCT
+	 * domain, so it's much faster than decoding at full size.
+	 */
+	int shrink;
+
+	/* Non-zero for a fast, slightly lower quality decode: integer IDCT and
+	 * simple chroma upsampling.
+	 */
+	int fast;
+
+	/* Decode just this rectangle, in output (after shrink) pixels. A 
+	 * crop_width or crop_height of zero means the whole image. The 
+	 * rectangle is clipped against the image.
+	 */
+	int crop_left;
+	int crop_top;
+	int crop_width;
+	int crop_height;
+} Options;
+
+/* One item for decompress_batch(). 
+ */
+typedef struct _Job {
+	/* Load from this file, or if filename is NULL, from this memory area.
+	 */
+	const char *filename;
+	void *buf;
+	size_t len;
+
+	/* Write here. If out.pixels is NULL we allocate, free with 
+	 * image_free(), otherwise we decompress into out.pixels, see 
+	 * decompress_into().
+	 */
+	Image out;
+	int rowstride;
+	int max_width;
+	int max_height;
+
+	/* Set to the decompress_into() result, or -3 if the file could not be
+	 * read.
+	 */
+	int status;
+} Job;
+
 /* Called from Python on finalize.
  */
 void
 image_free( Image *image )
 {
-	if( image->pixels )
+	if( image->pixels ) {
 		free( image->pixels );
+		image->pixels = NULL;
+	}
 }
 
 /* Define a new error handler for when we bomb out.
@@ -166,22 +243,24 @@ init_source (j_decompress_ptr cinfo)
 static boolean
 fill_input_buffer (j_decompress_ptr cinfo)
 {
+  /* Don't write the fake EOI into the caller's buffer, it may be a
+   * read-only Python string.
+   */
+  static const JOCTET eoi[2] = { (JOCTET) 0xFF, (JOCTET) JPEG_EOI };
+
   InputBuffer *src = (InputBuffer *) cinfo->src;
-  size_t nbytes;
 
   if (src->start_of_file) {
-    nbytes = src->len;
+    src->pub.next_input_byte = src->buf;
+    src->pub.bytes_in_buffer = src->len;
   }
   else {
     WARNMS(cinfo, JWRN_JPEG_EOF);
     /* Insert a fake EOI marker */
-    src->buf[0] = (JOCTET) 0xFF;
-    src->buf[1] = (JOCTET) JPEG_EOI;
-    nbytes = 2;
+    src->pub.next_input_byte = eoi;
+    src->pub.bytes_in_buffer = 2;
   }
 
-  src->pub.next_input_byte = src->buf;
-  src->pub.bytes_in_buffer = nbytes;
   src->start_of_file = 0;
 
   return TRUE;
@@ -271,32 +350,118 @@ buf_source (j_decompress_ptr cinfo, void *buf, size_t len)
   src->pub.next_input_byte = NULL; /* until buffer loaded */
 }
 
-/**
- * im_bufjpeg2vips:
- * @buf: memory area to load
- * @len: size of memory area
- * @out: image to write
- * @header_only: set to just read the header
- *
- * Read a JPEG-formatted memory block into a VIPS image. It can read most 
- * 8-bit JPEG images, including CMYK and YCbCr.
- *
- * This function is handy for processing JPEG image thumbnails.
+/* Clip the crop rectangle in options against the image. Returns non-zero if
+ * there's a crop to do.
+ */
+static int
+clip_crop( struct jpeg_decompress_struct *cinfo, Options *options,
+	int *left, int *top, int *width, int *height )
+{
+	int right;
+	int bottom;
+
+	if( !options ||
+		options->crop_width <= 0 ||
+		options->crop_height <= 0 )
+		return( 0 );
+
+	*left = options->crop_left < 0 ? 0 : options->crop_left;
+	*top = options->crop_top < 0 ? 0 : options->crop_top;
+	right = options->crop_left + options->crop_width;
+	bottom = options->crop_top + options->crop_height;
+	if( right > (int) cinfo->output_width )
+		right = cinfo->output_width;
+	if( bottom > (int) cinfo->output_height )
+		bottom = cinfo->output_height;
+	*width = right - *left;
+	*height = bottom - *top;
+
+	/* A crop entirely outside the image ... just decode a single pixel,
+	 * we don't want to fail.
+	 */
+	if( *width <= 0 || *height <= 0 ) {
+		*left = 0;
+		*top = 0;
+		*width = 1;
+		*height = 1;
+	}
+
+	return( 1 );
+}
+
+/* Decompress a left/top/out->width/out->height rectangle to out. 
  *
- * See also: #VipsFormat, im_jpeg2vips().
+ * With libjpeg-turbo we skip the lines above the rectangle without 
+ * decoding them, and only decode the iMCU columns the rectangle touches. We
+ * stop as soon as we have the last line we need.
+ */
+static void
+read_crop( struct jpeg_decompress_struct *cinfo, Image *out, 
+	int rowstride, int left, int top )
+{
+	JDIMENSION xoffset;
+	JSAMPARRAY row;
+	int y;
+
+#ifdef HAVE_CROP
+	JDIMENSION width;
+
+	/* Ask for an extra pixel on each side, if we can, so chroma 
+	 * upsampling at the edges of the rectangle sees the same neighbours 
+	 * as a full decode would.
+	 */
+	xoffset = left > 0 ? left - 1 : 0;
+	width = left + out->width - xoffset;
+	if( xoffset + width < cinfo->output_width )
+		width += 1;
+
+	/* This will move xoffset left and make width larger to align to an 
+	 * iMCU boundary. output_width becomes the new width.
+	 */
+	jpeg_crop_scanline( cinfo, &xoffset, &width );
+	if( top > 0 )
+		jpeg_skip_scanlines( cinfo, top );
+#else
+	xoffset = 0;
+#endif /*HAVE_CROP*/
+
+	row = (*cinfo->mem->alloc_sarray)( (j_common_ptr) cinfo, 
+		JPOOL_IMAGE, cinfo->output_width * 3, 1 );
+
+#ifndef HAVE_CROP
+	while( (int) cinfo->output_scanline < top ) 
+		jpeg_read_scanlines( cinfo, row, 1 );
+#endif /*!HAVE_CROP*/
+
+	for( y = 0; y < out->height; y++ ) {
+		char *p;
+
+		p = ((char *) out->pixels) + y * rowstride;
+		jpeg_read_scanlines( cinfo, row, 1 );
+		memcpy( p, row[0] + (left - xoffset) * 3, out->width * 3 );
+	}
+}
+
+/* Decompress to out. If out->pixels is NULL, we allocate a buffer of exactly
+ * the right size, otherwise we write to out->pixels, which must have room 
+ * for max_height lines of rowstride bytes.
  *
- * Returns: 0 on success, -1 on error.
+ * Returns: 0 on success, -1 on error, -2 if the image won't fit.
  */
-int
-decompress( void *buf, size_t len, Image *out )
+static int
+read_jpeg( void *buf, size_t len, Image *out, 
+	int rowstride, int max_width, int max_height, Options *options )
 {
 	struct jpeg_decompress_struct cinfo;
 	ErrorManager eman;
+	int allocate = out->pixels == NULL;
+	int crop;
+	int left;
+	int top;
 	int y;
 
 	out->width = -1;
 	out->height = -1;
-	out->pixels = NULL;
 
 	/* Make jpeg dcompression object.
  	 */
@@ -308,7 +473,8 @@ decompress( void *buf, size_t len, Image *out )
 		/* Here for longjmp() from new_error_exit().
 		 */
 		jpeg_destroy_decompress( &cinfo );
-		image_free( out );
+		if( allocate )
+			image_free( out );
 
 		return( -1 );
 	}
@@ -322,23 +488,53 @@ decompress( void *buf, size_t len, Image *out )
 	 * for YUV YCCK etc.
 	 */
 	jpeg_read_header( &cinfo, TRUE );
+	if( options ) {
+		if( options->shrink == 2 || 
+			options->shrink == 4 || 
+			options->shrink == 8 ) {
+			cinfo.scale_num = 1;
+			cinfo.scale_denom = options->shrink;
+		}
+
+		if( options->fast ) {
+			cinfo.dct_method = JDCT_IFAST;
+			cinfo.do_fancy_upsampling = FALSE;
+			cinfo.do_block_smoothing = FALSE;
+		}
+	}
 	jpeg_calc_output_dimensions( &cinfo );
 
 	if( cinfo.out_color_space != JCS_RGB ) {
-		/* We should use the libjpeg error reporter to fix this leak.
-		 */
 		printf( "decompress: RGB jpeg only\n" );
+		jpeg_destroy_decompress( &cinfo );
 
 		return( -1 );
 	}
 
-	out->width = cinfo.output_width;
-	out->height = cinfo.output_height;
-	if( !(out->pixels = malloc( out->width * out->height * 3 )) ) {
-		/* We should use the libjpeg error reporter to fix this leak.
-		 */
-		image_free( out );
-		return( -1 );
+	if( (crop = clip_crop( &cinfo, options, 
+		&left, &top, &out->width, &out->height )) ) {
+#ifdef DEBUG
+		printf( "read_jpeg: crop %d x %d at %d, %d\n",
+			out->width, out->height, left, top );
+#endif /*DEBUG*/
+	}
+	else {
+		out->width = cinfo.output_width;
+		out->height = cinfo.output_height;
+	}
+
+	if( allocate ) {
+		rowstride = out->width * 3;
+		if( !(out->pixels = malloc( rowstride * out->height )) ) {
+			jpeg_destroy_decompress( &cinfo );
+			return( -1 );
+		}
+	}
+	else if( out->width > max_width ||
+		out->height > max_height ||
+		out->width * 3 > rowstride ) {
+		jpeg_destroy_decompress( &cinfo );
+		return( -2 );
 	}
 
 	/* Start up decompressor.
@@ -347,24 +543,282 @@ decompress( void *buf, size_t len, Image *out )
 
 	/* Process image.
 	 */
-	for( y = 0; y < out->height; y++ ) {
-		char *p;
+	if( crop ) 
+		/* We don't read to the end, so we can't finish_decompress(),
+		 * destroy will free everything.
+		 */
+		read_crop( &cinfo, out, rowstride, left, top );
+	else {
+		for( y = 0; y < out->height; y++ ) {
+			char *p;
+
+			p = ((char *) out->pixels) + y * rowstride;
 
-		p = ((char *) out->pixels) + y * out->width * 3;
+			/* We set an error handler that longjmps() out, so I 
+			 * don't think this can fail.
+			 */
+			jpeg_read_scanlines( &cinfo, (JSAMPARRAY) &p, 1 );
+		}
 
-		/* We set an error handler that longjmps() out, so I don't
-		 * think this can fail.
+		/* Stop decompressor.
 		 */
-		jpeg_read_scanlines( &cinfo, (JSAMPARRAY) &p, 1 );
+		jpeg_finish_decompress( &cinfo );
 	}
 
-	/* Stop decompressor.
-	 */
-	jpeg_finish_decompress( &cinfo );
-
 	/* Close and tidy.
 	 */
 	jpeg_destroy_decompress( &cinfo );
 
 	return( 0 );
 }
+
+/**
+ * decompress:
+ * @buf: memory area to load
+ * @len: size of memory area
+ * @out: image to write
+ *
+ * Read a JPEG-formatted memory block into a freshly allocated RGB buffer. 
+ * Free the pixels with image_free().
+ *
+ * Returns: 0 on success, -1 on error.
+ */
+int
+decompress( void *buf, size_t len, Image *out )
+{
+	out->pixels = NULL;
+
+	return( read_jpeg( buf, len, out, 0, 0, 0, NULL ) );
+}
+
+/**
+ * decompress_options:
+ * @buf: memory area to load
+ * @len: size of memory area
+ * @out: image to write
+ * @options: shrink, crop and quality settings, or NULL
+ *
+ * As decompress(), but optionally shrink, crop and use a faster decode. 
+ *
+ * Returns: 0 on success, -1 on error.
+ */
+int
+decompress_options( void *buf, size_t len, Image *out, Options *options )
+{
+	out->pixels = NULL;
+
+	return( read_jpeg( buf, len, out, 0, 0, 0, options ) );
+}
+
+/**
+ * decompress_into:
+ * @buf: memory area to load
+ * @len: size of memory area
+ * @out: image to write, out->pixels must point to the output buffer
+ * @rowstride: bytes between lines in the output buffer
+ * @max_width: buffer width in pixels
+ * @max_height: buffer height in lines
+ * @options: shrink, crop and quality settings, or NULL
+ *
+ * Read a JPEG-formatted memory block into a buffer supplied by the caller,
+ * for example the pixels of a GdkPixbuf, with no intermediate copy.
+ *
+ * If the image will not fit, out->width and out->height are set to the
+ * image size and nothing is decompressed, so the caller can make a larger 
+ * buffer and try again.
+ *
+ * Returns: 0 on success, -1 on error, -2 if the image is too large.
+ */
+int
+decompress_into( void *buf, size_t len, Image *out, 
+	int rowstride, int max_width, int max_height, Options *options )
+{
+	if( !out->pixels )
+		return( -1 );
+
+	return( read_jpeg( buf, len, out, 
+		rowstride, max_width, max_height, options ) );
+}
+
+/* Read a file into memory. 
+ */
+static void *
+read_file( const char *filename, size_t *len )
+{
+	FILE *fp;
+	long size;
+	void *buf;
+
+	if( !(fp = fopen( filename, "rb" )) )
+		return( NULL );
+
+	if( fseek( fp, 0, SEEK_END ) ||
+		(size = ftell( fp )) <= 0 ||
+		fseek( fp, 0, SEEK_SET ) ||
+		!(buf = malloc( size )) ) {
+		fclose( fp );
+		return( NULL );
+	}
+
+	if( fread( buf, 1, size, fp ) != (size_t) size ) {
+		free( buf );
+		fclose( fp );
+		return( NULL );
+	}
+
+	fclose( fp );
+	*len = size;
+
+	return( buf );
+}
+
+static void
+run_job( Job *job, Options *options )
+{
+	void *buf;
+	size_t len;
+
+	if( job->filename ) {
+		if( !(buf = read_file( job->filename, &len )) ) {
+			job->status = -3;
+			return;
+		}
+	}
+	else {
+		buf = job->buf;
+		len = job->len;
+	}
+
+	job->status = read_jpeg( buf, len, &job->out, 
+		job->rowstride, job->max_width, job->max_height, options );
+
+	if( job->filename )
+		free( buf );
+}
+
+/* State shared by the batch worker threads. 
+ */
+typedef struct _Batch {
+	Job *jobs;
+	int n;
+	Options *options;
+
+	/* The next job to start, protected by lock.
+	 */
+	pthread_mutex_t lock;
+	int next;
+} Batch;
+
+static void *
+batch_worker( void *a )
+{
+	Batch *batch = (Batch *) a;
+
+	for(;;) {
+		int i;
+
+		pthread_mutex_lock( &batch->lock );
+		i = batch->next++;
+		pthread_mutex_unlock( &batch->lock );
+
+		if( i >= batch->n )
+			break;
+
+		run_job( &batch->jobs[i], batch->options );
+	}
+
+	return( NULL );
+}
+
+/**
+ * decompress_batch:
+ * @jobs: array of things to decompress
+ * @n: number of jobs
+ * @options: shrink, crop and quality settings, or NULL
+ * @n_threads: number of threads to use, or 0 for one per CPU
+ *
+ * Decompress a set of JPEG files or memory areas, with each thread taking 
+ * the next job as soon as it finishes the last. ctypes releases the GIL 
+ * while we run, so Python threads carry on in the background.
+ *
+ * Each job gets its own status, see #Job. 
+ *
+ * Returns: the number of jobs which failed.
+ */
+int
+decompress_batch( Job *jobs, int n, Options *options, int n_threads )
+{
+	Batch batch;
+	pthread_t *threads;
+	int n_started;
+	int n_failed;
+	int i;
+
+	if( n_threads <= 0 )
+		n_threads = sysconf( _SC_NPROCESSORS_ONLN );
+	if( n_threads > n )
+		n_threads = n;
+	if( n_threads < 1 )
+		n_threads = 1;
+
+	batch.jobs = jobs;
+	batch.n = n;
+	batch.options = options;
+	batch.next = 0;
+	pthread_mutex_init( &batch.lock, NULL );
+
+	/* If we can't make threads, the calling thread does all the work in
+	 * batch_worker() below.
+	 */
+	n_started = 0;
+	if( (threads = malloc( n_threads * sizeof( pthread_t ) )) ) 
+		for( i = 0; i < n_threads - 1; i++ ) {
+			if( pthread_create( &threads[i], NULL, 
+				batch_worker, &batch ) )
+				break;
+			n_started += 1;
+		}
+
+	batch_worker( &batch );
+
+	for( i = 0; i < n_started; i++ )
+		pthread_join( threads[i], NULL );
+	free( threads );
+	pthread_mutex_destroy( &batch.lock );
+
+	n_failed = 0;
+	for( i = 0; i < n; i++ ) 
+		if( jobs[i].status != 0 )
+			n_failed += 1;
+
+#ifdef DEBUG
+	printf( "decompress_batch: %d jobs, %d threads, %d failed\n",
+		n, n_started + 1, n_failed );
+#endif /*DEBUG*/
+
+	return( n_failed );
+}
+
+/**
+ * pixbuf_pixels:
+ * @obj: a pygtk gtk.gdk.Pixbuf
+ *
+ * pygtk only gives Python a copy of the pixels in a Pixbuf. Find the real
+ * ones, so we can decompress straight into them. We get the GObject with
+ * the pygobject headers, so we don't depend on the layout of the Python
+ * wrapper, and check that it really is a GdkPixbuf.
+ *
+ * Returns: the address of the pixels, or NULL on error.
+ */
+void *
+pixbuf_pixels( PyObject *obj )
+{
+	GObject *gobject;
+
+	if( !obj ||
+		!(gobject = pygobject_get( obj )) ||
+		!GDK_IS_PIXBUF( gobject ) )
+		return( NULL );
+
+	return( gdk_pixbuf_get_pixels( GDK_PIXBUF( gobject ) ) );
+}
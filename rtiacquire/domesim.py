@@ -0,0 +1,257 @@
+#!/usr/bin/python
+
+"""Simulate the dome's light controller on a pseudo-terminal.
+
+Simulator -- a fake USB I/O 24R1 light controller
+main -- run a simulator from the command line
+
+The simulator speaks the same protocol as the real box:
+
+    ?       answer with the banner, lights.banner
+    !p n    set the direction of port p (A, B or C) to byte n
+    p n     set the outputs of port p (A, B or C) to byte n
+
+It can add latency, drop bytes and disconnect now and then, so we can test
+and benchmark the lights module without the hardware. The pty is linked to
+a fixed name, set RTIACQUIRE_PORTS to that name and lights.scanserial() will
+find it. For example:
+
+    $ python domesim.py --link /tmp/dome0 &
+    $ RTIACQUIRE_PORTS=/tmp/dome0 python rtiacquire.py
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import os
+import pty
+import tty
+import random
+import threading
+import time
+import optparse
+import select
+
+import lights
+
+# the default name we link the pty to
+default_link = '/tmp/rtiacquire-dome'
+
+class Simulator:
+
+    """A fake light controller on a pseudo-terminal.
+
+    latency -- seconds to wait before acting on each command
+    drop -- the chance that each byte we receive is lost, 0 - 1
+    disconnect -- the chance that each command unplugs the controller, 0 - 1
+    boot -- after plugging in, seconds before we answer '?'
+    replug -- seconds before a disconnected controller comes back
+    ack -- None, or a string to send after each A, B or C command ... the
+        real firmware is silent
+    link -- the name to link the pty to, or None
+
+    Each change of the outputs is logged with the time it happened, see
+    get_history().
+    """
+
+    def __init__(self, latency = 0.0, drop = 0.0, disconnect = 0.0,
+                 boot = 0.0, replug = 1.0, ack = None, link = default_link):
+        self.latency = latency
+        self.drop = drop
+        self.disconnect = disconnect
+        self.boot = boot
+        self.replug = replug
+        self.ack = ack
+        self.link = link
+
+        self.lock = threading.Lock()
+        self.outputs = {'A': 0, 'B': 0, 'C': 0}
+        self.directions = {'A': 0, 'B': 0, 'C': 0}
+        self.history = []
+        self.disconnects = 0
+        self.dropped = 0
+
+        self.stopping = threading.Event()
+        self.master = None
+        self.slave = None
+        self.plug()
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def plug(self):
+        (self.master, self.slave) = pty.openpty()
+
+        # no echo or newline translation ... we keep the slave open so reads
+        # on the master don't fail when the client closes the port
+        tty.setraw(self.slave)
+        self.portname = os.ttyname(self.slave)
+        self.connected = time.time()
+
+        if self.link:
+            if os.path.lexists(self.link):
+                os.unlink(self.link)
+            os.symlink(self.portname, self.link)
+
+        logging.debug('domesim: controller on %s', self.get_portname())
+
+    def unplug(self):
+        if self.master == None:
+            return
+        logging.debug('domesim: disconnecting')
+        self.disconnects += 1
+        if self.link and os.path.lexists(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+        self.master = None
+        self.slave = None
+
+    def read_byte(self):
+        while True:
+            # poll, so we notice close()
+            try:
+                (readable, writeable, error) = \
+                    select.select([self.master], [], [], 0.1)
+                if self.stopping.is_set():
+                    return None
+                if readable == []:
+                    continue
+                c = os.read(self.master, 1)
+            except (OSError, select.error):
+                return None
+            if c == '':
+                return None
+            if self.drop > 0 and random.random() < self.drop:
+                self.dropped += 1
+                continue
+            return c
+
+    def write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.stopping.is_set():
+            command = self.read_byte()
+            if command == None:
+                break
+
+            if command == '?':
+                args = ''
+            elif command == '!':
+                args = (self.read_byte() or '') + (self.read_byte() or '')
+            elif command in 'ABC':
+                args = self.read_byte() or ''
+            else:
+                logging.debug('domesim: unknown command %s', repr(command))
+                continue
+
+            if self.latency > 0:
+                time.sleep(self.latency)
+
+            self.execute(command, args)
+
+            if self.disconnect > 0 and random.random() < self.disconnect:
+                self.unplug()
+                if self.stopping.wait(self.replug):
+                    break
+                self.plug()
+
+    def execute(self, command, args):
+        if command == '?':
+            if time.time() - self.connected >= self.boot:
+                self.write(lights.banner)
+        elif command == '!':
+            if len(args) == 2 and args[0] in 'ABC':
+                self.directions[args[0]] = ord(args[1])
+        elif len(args) == 1:
+            self.lock.acquire()
+            try:
+                self.outputs[command] = ord(args)
+                self.history.append((time.time(), self.get_triple()))
+            finally:
+                self.lock.release()
+            if self.ack != None:
+                self.write(self.ack)
+
+    def get_portname(self):
+        """Return the name to open to talk to the simulator."""
+        if self.link:
+            return self.link
+        return self.portname
+
+    def get_triple(self):
+        """Return the current outputs as [a, b, c]."""
+        return [self.outputs['A'], self.outputs['B'], self.outputs['C']]
+
+    def get_history(self):
+        """Return a list of (time, [a, b, c]) for every change of output."""
+        self.lock.acquire()
+        try:
+            return list(self.history)
+        finally:
+            self.lock.release()
+
+    def get_disconnects(self):
+        """Return the number of simulated disconnects so far."""
+        return self.disconnects
+
+    def close(self):
+        """Shut the simulator down."""
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+            self.unplug()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-d", "--debug",
+                    action = "store_true", dest = "verbose", default = False,
+                    help = "print debug messages")
+    parser.add_option("-k", "--link",
+                    dest = "link", default = default_link, metavar = "NAME",
+                    help = "link the controller's pty to NAME")
+    parser.add_option("-l", "--latency",
+                    type = "float", dest = "latency", default = 0.0,
+                    metavar = "SECONDS",
+                    help = "wait SECONDS before acting on each command")
+    parser.add_option("-p", "--drop",
+                    type = "float", dest = "drop", default = 0.0,
+                    metavar = "P",
+                    help = "drop each received byte with probability P")
+    parser.add_option("-c", "--disconnect",
+                    type = "float", dest = "disconnect", default = 0.0,
+                    metavar = "P",
+                    help = "disconnect after each command with probability P")
+    parser.add_option("-b", "--boot",
+                    type = "float", dest = "boot", default = 0.0,
+                    metavar = "SECONDS",
+                    help = "ignore '?' for SECONDS after connecting")
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        logging.basicConfig(level = logging.DEBUG)
+
+    simulator = Simulator(latency = options.latency, drop = options.drop,
+                          disconnect = options.disconnect,
+                          boot = options.boot, link = options.link)
+    print 'controller on %s, set RTIACQUIRE_PORTS=%s' % \
+        (simulator.portname, simulator.get_portname())
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    simulator.close()
+
+# if we are run directly, start a simulator
+if __name__ == '__main__':
+    main()
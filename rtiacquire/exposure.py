@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+"""Measure exposure on preview frames.
+
+supported -- True if we can measure exposure
+Exposure -- a histogram and clipping map built up over several frames
+
+The frames are the height x width x 3 uint8 numpy arrays made by
+decompress.pixbuf2array(). This module needs numpy.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import time
+
+# numpy is optional, we just turn exposure measurement off without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# sample every grid_step pixels across and down
+grid_step = 4
+
+# the time we may spend on each frame, in seconds ... if we run out, we
+# carry on from the same place on the next frame
+frame_budget = 0.003
+
+# the number of grid lines we do between checks of the clock
+band_lines = 8
+
+# a sample is blown if any band is at or above highlight_level, crushed if
+# all bands are at or below shadow_level
+highlight_level = 250
+shadow_level = 5
+
+# the overlay colours
+blown_colour = (255, 0, 255)
+crushed_colour = (0, 0, 255)
+
+# overlay marks are this many pixels across
+mark_size = 2
+
+# values in the clipping map
+OK = 0
+BLOWN = 1
+CRUSHED = 2
+
+def supported():
+    """Return True if exposure measurement is available."""
+    return numpy != None
+
+class Exposure:
+
+    """A histogram and clipping map built up over several frames.
+
+    Pass each new frame to frame(). We sample the frame on a grid and work
+    down it in bands until we run out of time, then carry on from that band
+    on the next frame. When we reach the bottom, the histogram and clipped
+    fractions are updated and we start again at the top.
+
+    Each band also updates a map of blown and crushed samples. overlay()
+    paints the map onto a frame.
+
+    The results are read with get_histogram() and get_clipped(), which
+    can be called from any thread.
+    """
+
+    def __init__(self, step = grid_step, budget = frame_budget):
+        self.step = step
+        self.budget = budget
+
+        # the clipping map, one value per grid point
+        self.map = None
+
+        # the results of the last complete pass
+        self.histogram = None
+        self.clipped = None
+
+        self.reset()
+
+    def reset(self):
+        # the partial results for the pass we're working on
+        self.line = 0
+        self.counts = numpy.zeros(256, numpy.int64)
+        self.blown = 0
+        self.crushed = 0
+        self.samples = 0
+
+    def band(self, grid, line, lines):
+        rgb = grid[line : line + lines].astype(numpy.int32)
+
+        # a cheap luminance, weights sum to 256
+        luma = (77 * rgb[:, :, 0] + 150 * rgb[:, :, 1] +
+                29 * rgb[:, :, 2]) >> 8
+        self.counts += numpy.bincount(luma.ravel(), minlength = 256)
+
+        brightest = rgb.max(axis = 2)
+        blown = brightest >= highlight_level
+        crushed = brightest <= shadow_level
+        self.blown += int(blown.sum())
+        self.crushed += int(crushed.sum())
+        self.samples += luma.size
+
+        clip = self.map[line : line + lines]
+        clip[:] = OK
+        clip[blown] = BLOWN
+        clip[crushed] = CRUSHED
+
+    def frame(self, array):
+        """Measure some more of a frame, stopping when we run out of time."""
+        grid = array[::self.step, ::self.step]
+        (height, width) = grid.shape[:2]
+
+        # the frame size has changed, start again
+        if self.map is None or self.map.shape != (height, width):
+            self.map = numpy.zeros((height, width), numpy.uint8)
+            self.reset()
+
+        # always do at least one band, so we get there eventually
+        start = time.time()
+        while self.line < height:
+            lines = min(band_lines, height - self.line)
+            self.band(grid, self.line, lines)
+            self.line += lines
+            if time.time() - start > self.budget:
+                break
+
+        if self.line >= height:
+            self.histogram = self.counts
+            self.clipped = (float(self.blown) / self.samples,
+                            float(self.crushed) / self.samples)
+            self.reset()
+
+    def overlay(self, array):
+        """Paint blown samples in blown_colour and crushed samples in
+        crushed_colour, changing array in place.
+        """
+        if self.map is None:
+            return
+
+        blown = self.map == BLOWN
+        crushed = self.map == CRUSHED
+        for y in range(0, mark_size):
+            for x in range(0, mark_size):
+                grid = array[y::self.step, x::self.step]
+                # the offset grid can be a little smaller than the map
+                (height, width) = grid.shape[:2]
+                grid[blown[:height, :width]] = blown_colour
+                grid[crushed[:height, :width]] = crushed_colour
+
+    def get_histogram(self):
+        """Return a 256-element numpy array of luminance counts from the
+        last complete pass, or None.
+        """
+        return self.histogram
+
+    def get_clipped(self):
+        """Return the fraction of samples which are (blown, crushed) from
+        the last complete pass, or None.
+        """
+        return self.clipped
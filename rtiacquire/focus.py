@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+"""Measure focus on preview frames.
+
+supported -- True if we can measure focus
+laplacian -- the Laplacian of an image
+sharpness -- a single number for how sharp an image is
+peak -- highlight in-focus edges
+
+The functions here work on the height x width x 3 uint8 numpy arrays made by
+decompress.pixbuf2array(), and need numpy.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+# numpy is optional, we just turn focus measurement off without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# pixels where the Laplacian is larger than this are in-focus edges
+peak_threshold = 40
+
+# and are painted this colour
+peak_colour = (255, 0, 0)
+
+def supported():
+    """Return True if focus measurement is available."""
+    return numpy != None
+
+def laplacian(array):
+    """Return the Laplacian of the green channel of an image.
+
+    Green is a good, cheap stand-in for luminance. The result is an int16
+    array two pixels smaller than the image in each direction.
+    """
+    g = array[:, :, 1].astype(numpy.int16)
+
+    return 4 * g[1:-1, 1:-1] - g[:-2, 1:-1] - g[2:, 1:-1] - \
+        g[1:-1, :-2] - g[1:-1, 2:]
+
+def sharpness(array, lap = None):
+    """Return the variance of the Laplacian of an image.
+
+    This gets larger as the image gets sharper, but depends on the
+    subject, so it's only useful for comparing frames of the same scene.
+    Pass lap if you've already computed the Laplacian.
+    """
+    if array.shape[0] < 3 or array.shape[1] < 3:
+        return 0.0
+    if lap is None:
+        lap = laplacian(array)
+
+    return float(lap.var())
+
+def peak(array, lap = None):
+    """Paint in-focus edges in peak_colour, changing array in place."""
+    if array.shape[0] < 3 or array.shape[1] < 3:
+        return
+    if lap is None:
+        lap = laplacian(array)
+
+    mask = numpy.abs(lap) > peak_threshold
+    array[1:-1, 1:-1][mask] = peak_colour
@@ -3,7 +3,13 @@
 """This module wraps up communication with the light controller.
 
 Lights -- a connection to the light controller
+LightsThread -- drive a Lights from a background thread
+Request -- a light change sent to a LightsThread
 Error -- the exception we can raise
+scanserial -- list the serial ports a controller might be on
+set_backend -- do serial I/O with something other than pyserial
+probe_port -- open a port and check for a light controller
+find_controller -- probe a set of ports at once
 
 Author: J.Cupitt
 Created as part of the AHRC RTI project in 2011
@@ -15,6 +21,46 @@ import os
 import serial
 import time
 import logging
+import threading
+
+# the errors a port can raise ... termios errors can escape pyserial on unix,
+# and pyserial's ioctls raise IOError, not OSError, when the port goes away
+try:
+    import termios
+    port_errors = (serial.SerialException, EnvironmentError, termios.error)
+except ImportError:
+    port_errors = (serial.SerialException, EnvironmentError)
+
+# how long to wait for the controller to answer a command, in seconds ... 
+# some firmware never answers, once we've seen that we stop waiting
+ack_timeout = 0.1
+
+# how often to look for an answer, in seconds
+ack_poll = 0.002
+
+# the controller's answer to '?'
+banner = 'USB I/O 24R1\r\n'
+
+# the controller may reset when the port is opened ... keep asking for this
+# long before we give up on a port, in seconds
+probe_timeout = 2.0
+
+# how long Request.wait() waits for the lights thread, in seconds ... long
+# enough to find the controller, short enough that a stuck thread can't hang
+# the GUI for good
+request_timeout = 10.0
+
+# the port the controller was last found on, tried first next time
+last_port = None
+
+# scanserial() looks for ports matching these patterns, plus any in the
+# RTIACQUIRE_PORTS environment variable, separated by colons ... see 
+# domesim.py
+serial_patterns = ['/dev/ttyUSB*', '/dev/ttyACM*', '/dev/tty.*', '/dev/cu.*', 
+                   '/dev/rfcomm*']
+
+# None for pyserial, or the serial backend, see set_backend()
+backend = None
 
 class Error(Exception):
 
@@ -47,80 +93,232 @@ def scanserial():
         except:
             pass
 
-    for g in ['/dev/ttyUSB*', '/dev/ttyACM*', "/dev/tty.*", "/dev/cu.*", "/dev/rfcomm*"]:
+    patterns = list(serial_patterns)
+    if 'RTIACQUIRE_PORTS' in os.environ:
+        patterns += os.environ['RTIACQUIRE_PORTS'].split(':')
+
+    for g in patterns:
         baselist += [x for x in glob.glob(g) 
                      if not "Bluetooth" in x and not "FireFly" in x]
 
     return baselist
 
-light_ports = scanserial()
+def set_backend(new_backend):
+    """Do serial I/O with new_backend rather than pyserial.
+
+    new_backend must have scan(), returning a list of port names, and
+    open(portname, baudrate, timeout), returning an open port with the
+    methods of serial.Serial that we use. Pass None to go back to pyserial.
+    See replay.py.
+    """
+    global backend
+
+    backend = new_backend
+
+def list_ports():
+    if backend != None:
+        return backend.scan()
+    return scanserial()
+
+def open_port(portname, baudrate, timeout):
+    if backend != None:
+        return backend.open(portname, baudrate, timeout)
+    return serial.Serial(portname, baudrate, timeout = timeout)
+
+def probe_port(portname, timeout = probe_timeout):
+    """Open portname and check there's a light controller on it.
+
+    Rather than wait a fixed time for the controller to start up, we keep 
+    asking until it answers or timeout seconds pass. Return the open port. 
+    This function can raise Error.
+    """
+    logging.debug('** trying port %s', portname) 
+
+    try:
+        port = open_port(portname, 38400, 0.1)
+    except port_errors as e:
+        raise Error('Unable to connect to lights', str(e))
+
+    resp = ''
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            port.write('?')
+            # this waits for up to the port timeout
+            resp = port.readline()
+            if resp == banner:
+                break
+    except port_errors as e:
+        port.close()
+        raise Error('Unable to connect to lights', str(e))
+
+    if resp != banner:
+        port.close()
+        raise Error('Unable to connect to lights', 
+            'Bad response received - %s' % resp)
+
+    # there may be more answers on the way, command() will discard them
+
+    return port
+
+def find_controller(portnames, timeout = probe_timeout):
+    """Probe a list of ports at once, see probe_port().
+
+    Return (portname, port) for the first port to answer, or None. We 
+    don't wait for the other ports to finish.
+    """
+    condition = threading.Condition()
+    state = {'remaining': len(portnames), 'found': None}
+
+    def probe(portname):
+        try:
+            port = probe_port(portname, timeout)
+        except Error as e:
+            logging.debug('** error on %s, %s', portname, str(e)) 
+            port = None
+
+        condition.acquire()
+        try:
+            state['remaining'] -= 1
+            if port != None and state['found'] == None:
+                state['found'] = (portname, port)
+            elif port != None:
+                port.close()
+            condition.notify_all()
+        finally:
+            condition.release()
+
+    for portname in portnames:
+        thread = threading.Thread(target = probe, args = (portname,))
+        thread.daemon = True
+        thread.start()
+
+    condition.acquire()
+    try:
+        while state['found'] == None and state['remaining'] > 0:
+            condition.wait(timeout)
+        return state['found']
+    finally:
+        condition.release()
 
 class Lights:
-    def __init__(self):
+    def __init__(self, cache = None):
         """Startup.
 
         The connection to the light controller is made automatically on the
         first call to the set_triple() method.
+
+        cache -- None, or a file to remember the controller's port in
         """
         self.port = None
+        self.cache = cache
+
+        # True if the controller answers commands, None if we don't know yet
+        self.replies = None
+
+    def read_reply(self, port, timeout):
+        # read whatever the controller sends back, stopping at the end of a
+        # line or after timeout seconds
+        reply = ''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            waiting = port.inWaiting()
+            if waiting > 0:
+                reply += port.read(waiting)
+                if reply.endswith('\n'):
+                    break
+            else:
+                time.sleep(ack_poll)
 
-    def try_port(self, portname):
-        logging.debug('** trying port %s', portname) 
-
-        try:
-            port = serial.Serial(portname, 38400, timeout = 0.1)
-        except serial.SerialException as e:
-            raise Error('Unable to connect to lights', str(e))
+        return reply
 
-        time.sleep(1)
+    def command(self, port, frame):
+        # send a command as a single write, then wait for any answer
         port.flushInput()
-        port.write('?')
-        resp = port.readline()
-        if resp != 'USB I/O 24R1\r\n':
-            port.close()
-            raise Error('Unable to connect to lights', 
-                'Bad response received - %s' % resp)
-
-        # init ports
-        port.write("!")
-        port.write("A")
-        port.write(chr(0))
-        port.write("!")
-        port.write("B")
-        port.write(chr(0))
-        port.write("!")
-        port.write("C")
-        port.write(chr(0))
-
-        logging.debug('** successful connection to lights on port %s', 
-                        portname) 
-
-        return port
-
-    # open the connection
+        port.write(frame)
+
+        if self.replies != False:
+            reply = self.read_reply(port, ack_timeout)
+            if self.replies == None:
+                self.replies = reply != ''
+                logging.debug('** lights controller replies: %s', 
+                              self.replies)
+            logging.debug('** lights reply %s', repr(reply))
+
+    def cached_port(self):
+        if last_port == None and self.cache != None:
+            try:
+                f = open(self.cache, 'r')
+                try:
+                    return f.read().strip()
+                finally:
+                    f.close()
+            except IOError:
+                pass
+
+        return last_port
+
+    def cache_port(self, portname):
+        global last_port
+
+        last_port = portname
+        if self.cache != None:
+            try:
+                f = open(self.cache, 'w')
+                try:
+                    f.write(portname + '\n')
+                finally:
+                    f.close()
+            except IOError as e:
+                logging.debug('** unable to save lights port, %s', str(e))
+
+    def init_port(self, port):
+        self.command(port, '!A' + chr(0) + '!B' + chr(0) + '!C' + chr(0))
+
+    # open the connection ... try the port the controller was on last time,
+    # then all the others at once
     def connect(self):
         if self.port == None:
             logging.debug('** lights init')
-            for portname in light_ports:
+            portnames = list_ports()
+            found = None
+
+            cached = self.cached_port()
+            if cached in portnames:
+                portnames.remove(cached)
                 try:
-                    port = self.try_port(portname)
-                except Exception as e:
-                    logging.debug('** error on %s, %s', portname, str(e)) 
-                else:
-                    logging.debug('** lights found on %s', portname)
-                    break
-            else:
+                    found = (cached, probe_port(cached))
+                except Error as e:
+                    logging.debug('** error on %s, %s', cached, str(e)) 
+
+            if found == None and len(portnames) > 0:
+                found = find_controller(portnames)
+
+            if found == None:
                 raise Error('No lights found', 
                     'No light controller found on any port')
 
+            (portname, port) = found
+            logging.debug('** lights found on %s', portname)
+            try:
+                self.init_port(port)
+            except port_errors as e:
+                port.close()
+                raise Error('Unable to connect to lights', str(e))
+
+            self.cache_port(portname)
             self.port = port
 
     def release(self):
         if self.port != None:
             logging.debug('** lights shutdown')
-            self.set_triple([0, 0, 0])
-            self.port.close()
-            self.port = None
+            try:
+                self.set_triple([0, 0, 0])
+            except Error:
+                pass
+            if self.port != None:
+                self.port.close()
+                self.port = None
 
     def set_triple(self, triple):
         """Send a triple to the light contoller.
@@ -138,10 +336,174 @@ class Lights:
         logging.debug('** lights A = %s, B = %s, C = %s', 
                         hex(A), hex(B), hex(C))
 
-        self.port.write("A")
-        self.port.write(chr(A))
-        self.port.write("B")
-        self.port.write(chr(B))
-        self.port.write("C")
-        self.port.write(chr(C))
-	logging.debug(self.port.readlines())
+        try:
+            self.command(self.port, 
+                         'A' + chr(A) + 'B' + chr(B) + 'C' + chr(C))
+        except port_errors as e:
+            # we'll try to reconnect next time
+            self.port.close()
+            self.port = None
+            raise Error('Unable to set lights', str(e))
+
+class Request:
+
+    """A light change sent to a LightsThread.
+
+    Call wait() to block until the lights have changed.
+    """
+
+    def __init__(self, triple):
+        self.triple = triple
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error = None):
+        self.error = error
+        self.done.set()
+
+    def is_done(self):
+        """Return True if the request has completed."""
+        return self.done.is_set()
+
+    def wait(self, timeout = request_timeout):
+        """Wait for the lights to change.
+
+        Return True if the request completed. If a later request replaced 
+        this one before it was sent, this returns when the later one has been
+        sent.
+
+        This method can raise Error if the change failed, or if it does not
+        complete within timeout seconds.
+        """
+        if not self.done.wait(timeout):
+            raise Error('Unable to set lights', 
+                        'Timed out waiting for the light controller')
+        if self.error:
+            raise self.error
+        return True
+
+class LightsThread:
+
+    """Drive a Lights from a background thread.
+
+    The thread owns the Lights and does all the serial I/O, so set_triple() 
+    never blocks. If several changes are made before the thread gets to 
+    them, only the latest is sent. Changes which would leave the lights as 
+    they are already are not sent at all, unless the change is forced, or the
+    Lights has to reconnect to send it.
+
+    set_triple() returns a Request, wait on this to be sure the light has 
+    changed.
+    """
+
+    def __init__(self, lights):
+        self.lights = lights
+
+        # the latest triple we've been asked for, and the requests waiting 
+        # for it
+        self.condition = threading.Condition()
+        self.triple = None
+        self.force = False
+        self.waiting = []
+        self.stopping = False
+
+        # what we think the hardware is showing, None if we don't know
+        self.current = None
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, triple, force):
+        # the controller may have been reset or replugged without a port 
+        # error, so a user can force a resend ... and a new connection means
+        # we know nothing about the hardware
+        if self.lights.port == None:
+            self.current = None
+
+        if triple == self.current and not force:
+            logging.debug('** lights already %s', str(triple))
+            return None
+
+        try:
+            self.lights.set_triple(triple)
+        except Error as e:
+            # we don't know what state the hardware is in now
+            self.current = None
+            return e
+        except Exception as e:
+            # a bad triple, or something pyserial didn't wrap ... the 
+            # thread must keep going, or waiting requests never finish
+            logging.debug('** lights unexpected error', exc_info = True)
+            self.current = None
+            return Error('Unable to set lights', str(e))
+
+        self.current = triple
+        return None
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while self.triple == None and not self.stopping:
+                    self.condition.wait()
+                triple = self.triple
+                force = self.force
+                waiting = self.waiting
+                self.triple = None
+                self.force = False
+                self.waiting = []
+            finally:
+                self.condition.release()
+
+            # finish any work before we stop
+            if triple == None:
+                break
+
+            error = None
+            try:
+                error = self.send(triple, force)
+                if error:
+                    logging.error('lights: %s', str(error))
+            finally:
+                for request in waiting:
+                    request.finish(error)
+
+        self.lights.release()
+        self.current = None
+
+    def set_triple(self, triple, force = False):
+        """Queue a triple for the light controller, see Lights.set_triple().
+
+        force -- send the triple even if we think the lights are showing it
+
+        Return a Request you can wait on.
+        """
+        request = Request(list(triple))
+
+        self.condition.acquire()
+        try:
+            if self.stopping:
+                request.finish(Error('Unable to set lights', 
+                                     'Lights have been shut down'))
+            else:
+                self.triple = request.triple
+                self.force = self.force or force
+                self.waiting.append(request)
+                self.condition.notify()
+        finally:
+            self.condition.release()
+
+        return request
+
+    def release(self):
+        """Send any queued change, turn the lights off and stop the thread."""
+        if self.thread:
+            self.condition.acquire()
+            try:
+                self.stopping = True
+                self.condition.notify()
+            finally:
+                self.condition.release()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,514 @@
+#!/usr/bin/python
+
+"""Micro-benchmarks for the hot paths, with regression thresholds.
+
+Skip -- raised by a case which can't run here
+FakePort -- a light controller port in memory
+FakeSerial -- a serial backend with a single FakePort
+time_case -- time a function, timeit-style
+check -- compare results with a baseline
+main -- run the benchmarks from the command line
+
+Each case times one call of a small piece of code we run a lot:
+
+    decompress-preview -- FramePool.decompress() of a preview frame
+    decompress-capture-8, -4, -1 -- FramePool.decompress() of a full
+        capture, shrinking by 8, 4 and 1 on decode
+    bufjpeg2pixbuf -- bufjpeg2pixbuf() of a preview frame
+    ledmap -- parse led-maps.txt
+    config-table -- rebuild the Config table from the Widget tree, then
+        Config.get_values(), as Config.get_settings() does
+    config-prettyprint -- Config.prettyprint()
+    rect-which-corner -- Rect.which_corner() for a sweep of motion events
+        over a selection
+    lights-set-triple -- Lights.set_triple() on a silent port, like the
+        real firmware
+    lights-set-triple-ack -- Lights.set_triple() on a port which answers
+
+The camera cases use camsim.py with all delays set to zero, they never
+take a preview, so they need no images or gtk. The decompress cases need gtk
+and dejpeg.so. Cases which can't run are skipped.
+
+We report the best time per call over several repeats, it's the least
+noisy, and the spread of the repeats, our measure of the noise. Save a
+baseline on a machine, then check later runs against it:
+
+    $ python microbench.py --save
+    ... make changes ...
+    $ python microbench.py
+
+A case more than --threshold slower than the baseline is a regression, and
+we exit with status 1. Noisy cases get a wider limit, noise_factor times the
+larger spread of the baseline and this run. A case which ran for the baseline but is skipped now
+fails too, so a broken build can't pass. Baselines are per-machine, they are
+named after --profile.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import os
+import sys
+import time
+import json
+import platform
+import StringIO
+import optparse
+
+import camera
+import camsim
+import lights
+import ledmap
+import rect
+import bench
+
+# get the directory this source is in
+source_dir = os.path.dirname(os.path.abspath(__file__))
+
+# each repeat runs for at least this long, in seconds
+min_time = 0.5
+
+# the number of repeats, we keep the best
+repeats = 9
+
+# a case this much slower than the baseline is a regression, 0.5 is 50% ...
+# run to run noise on a loaded machine can be 50% or more, so this is a
+# floor, see noise_factor
+default_threshold = 0.5
+
+# the limit for a case is at least this many times its spread, the gap
+# between the best and the upper quartile repeat, in the baseline or now
+noise_factor = 4
+
+# some cases are noisier than others, they get their own threshold
+thresholds = {
+    'lights-set-triple': 0.75,
+    'lights-set-triple-ack': 0.75
+}
+
+# the corner size for rect-which-corner, as preview.select_corner
+corner_size = 15
+
+# the order we run and print cases in
+case_order = ['decompress-preview', 'decompress-capture-8',
+              'decompress-capture-4', 'decompress-capture-1',
+              'bufjpeg2pixbuf', 'ledmap', 'config-table',
+              'config-prettyprint', 'rect-which-corner',
+              'lights-set-triple', 'lights-set-triple-ack']
+
+class Skip(Exception):
+
+    """A case can't run here.
+
+    reason -- why not
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return self.reason
+
+class FakePort:
+
+    """A light controller port in memory.
+
+    ack -- None, or a string to answer each command with ... the real
+        firmware is silent
+
+    We answer '?' with the banner, like the controller.
+    """
+
+    def __init__(self, ack = None):
+        self.ack = ack
+        self.waiting = ''
+
+    def write(self, data):
+        if data == '?':
+            self.waiting += lights.banner
+        elif self.ack != None:
+            self.waiting += self.ack
+
+    def read(self, size = 1):
+        data = self.waiting[:size]
+        self.waiting = self.waiting[size:]
+        return data
+
+    def readline(self):
+        n = self.waiting.find('\n') + 1
+        if n == 0:
+            n = len(self.waiting)
+        return self.read(n)
+
+    def inWaiting(self):
+        return len(self.waiting)
+
+    def flushInput(self):
+        self.waiting = ''
+
+    def close(self):
+        pass
+
+class FakeSerial:
+
+    """A serial backend with a single FakePort, see lights.set_backend()."""
+
+    def __init__(self, ack = None):
+        self.ack = ack
+
+    def scan(self):
+        return ['fake']
+
+    def open(self, portname, baudrate, timeout):
+        return FakePort(self.ack)
+
+def time_case(func):
+    """Time func, timeit-style.
+
+    We pick a number of calls that takes at least min_time, then time that
+    many calls repeats times. Return a dict with the best and median time per
+    call, in seconds, and the spread, the upper quartile over the best, 
+    less one.
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed > 0 and elapsed * 10 >= min_time else 10
+
+    times = [elapsed / number]
+    for i in range(1, repeats):
+        start = time.time()
+        for i in xrange(number):
+            func()
+        times.append((time.time() - start) / number)
+    times.sort()
+
+    return {'best': times[0],
+            'median': times[len(times) / 2],
+            'spread': times[len(times) * 3 / 4] / times[0] - 1,
+            'number': number,
+            'repeats': repeats}
+
+def load_jpeg(filename, width, height):
+    # the jpeg in filename, or a camsim test card
+    try:
+        if filename:
+            return camsim.load_jpeg(filename)
+        return camsim.test_card(width, height)
+    except camsim.Error as e:
+        raise Skip(str(e))
+
+def import_decompress():
+    # needs gtk and dejpeg.so
+    try:
+        import decompress
+    except (ImportError, RuntimeError, OSError) as e:
+        raise Skip(str(e))
+    return decompress
+
+# each setup function returns (func, cleanup), cleanup can be None ... they
+# can raise Skip
+
+def setup_decompress(filename, width, height, shrink):
+    decompress = import_decompress()
+    data = load_jpeg(filename, width, height)
+    pool = decompress.FramePool(width / shrink, height / shrink, shrink)
+
+    def run():
+        pixbuf = pool.decompress(data, len(data))
+        if pixbuf == None:
+            raise Skip('unable to decompress')
+        pool.release(pixbuf)
+
+    return (run, None)
+
+def setup_bufjpeg2pixbuf(options):
+    decompress = import_decompress()
+    data = load_jpeg(options.preview_image,
+                     camsim.preview_size[0], camsim.preview_size[1])
+
+    def run():
+        if decompress.bufjpeg2pixbuf(data, len(data)) == None:
+            raise Skip('unable to decompress')
+
+    return (run, None)
+
+def setup_ledmap(options):
+    filename = os.path.join(source_dir, 'data', 'led-maps.txt')
+
+    def run():
+        ledmap.Ledmap(filename)
+
+    return (run, None)
+
+def restore_backend(old_backend):
+    # there may have been no libgphoto2, leave the simulator in place
+    if old_backend != None:
+        camera.set_backend(old_backend)
+
+def setup_config(options):
+    timings = dict((name, 0.0) for name in camsim.default_timings)
+    simulator = camsim.Simulator(timings = timings)
+    old_backend = camera.gp
+    camera.set_backend(simulator)
+    cam = camera.Camera()
+    try:
+        config = camera.Config(cam)
+    except camera.Error as e:
+        cam.release()
+        restore_backend(old_backend)
+        raise Skip(str(e))
+
+    def cleanup():
+        config.free_config()
+        cam.release()
+        restore_backend(old_backend)
+
+    return (config, cleanup)
+
+def setup_config_table(options):
+    (config, cleanup) = setup_config(options)
+
+    def run():
+        config.table = None
+        config.get_values()
+
+    return (run, cleanup)
+
+def setup_config_prettyprint(options):
+    (config, cleanup) = setup_config(options)
+
+    def run():
+        config.prettyprint(StringIO.StringIO())
+
+    return (run, cleanup)
+
+def setup_rect_which_corner(options):
+    # a selection on a preview frame, and a sweep of the pointer over
+    # the whole frame, so we hit every corner and edge, and nothing
+    select = rect.Rect(100, 80, 400, 250)
+    (width, height) = camsim.preview_size
+    points = [(x, y) for y in range(0, height, 16)
+                     for x in range(0, width, 16)]
+
+    def run():
+        for (x, y) in points:
+            select.which_corner(corner_size, x, y)
+
+    return (run, None)
+
+def setup_lights(ack):
+    old_backend = lights.backend
+    old_last_port = lights.last_port
+    lights.set_backend(FakeSerial(ack))
+    lamps = lights.Lights()
+
+    # connect, and find out if the controller answers
+    lamps.set_triple([0, 0, 0])
+
+    def cleanup():
+        lamps.release()
+        lights.set_backend(old_backend)
+        lights.last_port = old_last_port
+
+    def run():
+        lamps.set_triple([0x12, 0x34, 0x56])
+
+    return (run, cleanup)
+
+def setup_lights_set_triple(options):
+    return setup_lights(None)
+
+def setup_lights_set_triple_ack(options):
+    return setup_lights('\r\n')
+
+def setup(name, options):
+    """Make the function for the named case. This can raise Skip."""
+    (width, height) = camsim.capture_size
+    if name == 'decompress-preview':
+        return setup_decompress(options.preview_image,
+                                camsim.preview_size[0],
+                                camsim.preview_size[1], 1)
+    elif name.startswith('decompress-capture-'):
+        shrink = int(name[len('decompress-capture-'):])
+        return setup_decompress(options.capture_image,
+                                width, height, shrink)
+
+    cases = {'bufjpeg2pixbuf': setup_bufjpeg2pixbuf,
+             'ledmap': setup_ledmap,
+             'config-table': setup_config_table,
+             'config-prettyprint': setup_config_prettyprint,
+             'rect-which-corner': setup_rect_which_corner,
+             'lights-set-triple': setup_lights_set_triple,
+             'lights-set-triple-ack': setup_lights_set_triple_ack}
+    return cases[name](options)
+
+def run_case(name, options):
+    """Run the named case. Return a result dict."""
+    try:
+        (func, cleanup) = setup(name, options)
+    except Skip as e:
+        return {'skipped': e.reason}
+
+    try:
+        return time_case(func)
+    except Skip as e:
+        return {'skipped': e.reason}
+    finally:
+        if cleanup:
+            cleanup()
+
+def format_time(seconds):
+    if seconds >= 1:
+        return '%.3fs' % seconds
+    if seconds >= 1e-3:
+        return '%.3fms' % (seconds * 1e3)
+    return '%.3fus' % (seconds * 1e6)
+
+def check(baseline, results, threshold, fp = sys.stdout):
+    """Compare results with a baseline.
+
+    Print a table and return a list of the names of the cases which are
+    more than threshold slower than the baseline, or which ran for the 
+    baseline but were skipped this time. Cases in the thresholds dict use 
+    their own threshold. The limit widens to noise_factor times the spread
+    of the baseline or of this run, whichever is larger.
+    """
+    regressions = []
+    old = baseline['cases']
+    fp.write('%-24s %12s %12s %8s\n' % ('case', 'baseline', 'now', 'change'))
+    for name in case_order:
+        if not name in results['cases']:
+            continue
+        result = results['cases'][name]
+        if 'skipped' in result:
+            verdict = ''
+            if name in old and not 'skipped' in old[name]:
+                verdict = '  REGRESSION, ran for the baseline'
+                regressions.append(name)
+            fp.write('%-24s skipped: %s%s\n' % 
+                     (name, result['skipped'], verdict))
+            continue
+        if not name in old or 'skipped' in old[name]:
+            fp.write('%-24s %12s %12s\n' %
+                     (name, '-', format_time(result['best'])))
+            continue
+
+        # older baselines have no spread
+        spread = max(old[name].get('spread', 0), result['spread'])
+        limit = max(thresholds.get(name, threshold), noise_factor * spread)
+        change = result['best'] / old[name]['best'] - 1
+        verdict = ''
+        if change > limit:
+            verdict = '  REGRESSION, limit %+.0f%%' % (limit * 100)
+            regressions.append(name)
+        fp.write('%-24s %12s %12s %+7.1f%%%s\n' %
+                 (name, format_time(old[name]['best']),
+                  format_time(result['best']), change * 100, verdict))
+
+    return regressions
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-d", "--debug",
+                    action = "store_true", dest = "verbose", default = False,
+                    help = "print debug messages")
+    parser.add_option("-k", "--cases",
+                    dest = "cases", default = ','.join(case_order),
+                    metavar = "LIST",
+                    help = "run the cases in LIST")
+    parser.add_option("-i", "--preview-image",
+                    dest = "preview_image", default = None, metavar = "FILE",
+                    help = "preview frames are FILE, not a test card")
+    parser.add_option("-I", "--capture-image",
+                    dest = "capture_image", default = None, metavar = "FILE",
+                    help = "captures are FILE, not a test card")
+    parser.add_option("-P", "--profile",
+                    dest = "profile", default = platform.node(),
+                    metavar = "NAME",
+                    help = "call this machine profile NAME")
+    parser.add_option("-b", "--baseline",
+                    dest = "baseline", default = None, metavar = "FILE",
+                    help = "check against FILE, rather than "
+                        "microbench-PROFILE.json")
+    parser.add_option("-s", "--save",
+                    action = "store_true", dest = "save", default = False,
+                    help = "save the results as the new baseline")
+    parser.add_option("-t", "--threshold",
+                    type = "float", dest = "threshold",
+                    default = default_threshold, metavar = "F",
+                    help = "a case more than F slower than the baseline is "
+                        "a regression, 0.5 is 50%, noisy cases get more")
+    options, args = parser.parse_args()
+
+    if options.verbose:
+        logging.basicConfig(level = logging.DEBUG)
+
+    names = options.cases.split(',')
+    for name in names:
+        if not name in case_order:
+            sys.exit('unknown case "%s"' % name)
+
+    cases = {}
+    for name in case_order:
+        if name in names:
+            result = run_case(name, options)
+            if 'skipped' in result:
+                print '%-24s skipped: %s' % (name, result['skipped'])
+            else:
+                print '%-24s %12s  (%d calls x %d)' % \
+                    (name, format_time(result['best']),
+                     result['number'], result['repeats'])
+            cases[name] = result
+
+    results = {'profile': options.profile,
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'commit': bench.git_commit(),
+               'machine': bench.machine(),
+               'settings': {'preview_image': options.preview_image,
+                            'capture_image': options.capture_image},
+               'cases': cases}
+
+    baseline = options.baseline
+    if baseline == None:
+        baseline = 'microbench-%s.json' % options.profile
+
+    if options.save:
+        f = open(baseline, 'w')
+        try:
+            json.dump(results, f, indent = 2, sort_keys = True)
+            f.write('\n')
+        finally:
+            f.close()
+        print 'baseline saved to %s' % baseline
+        return
+
+    if not os.path.exists(baseline):
+        print 'no baseline %s, use --save to make one' % baseline
+        return
+
+    f = open(baseline, 'r')
+    try:
+        old = json.load(f)
+    finally:
+        f.close()
+    if old['settings'] != results['settings']:
+        logging.warning('baseline %s was made with different images',
+                        baseline)
+
+    print
+    regressions = check(old, results, options.threshold)
+    if len(regressions) > 0:
+        print '%d regressions: %s' % (len(regressions), ', '.join(regressions))
+        sys.exit(1)
+
+# if we are run directly, run the benchmarks
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+"""Pick the live preview frame rate.
+
+Pacer -- decide how long to wait between preview frames
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import os
+import time
+
+# the frame rate we aim for ... 20 fps is fine for manual focussing
+target_fps = 20
+
+# the fraction of one CPU the whole program may use during preview ... a
+# laptop will usually hit target_fps well within this, a Pi will not
+cpu_budget = 0.6
+
+# limits on the wait between frames, in seconds
+min_interval = 0.005
+max_interval = 0.5
+
+# how quickly the timing averages follow new measurements, 0 - 1
+smoothing = 0.2
+
+# how often we sample CPU use, in seconds
+cpu_period = 1.0
+
+class Pacer:
+
+    """Decide how long to wait between preview frames.
+
+    Call frame() after each frame with the time spent fetching it from the
+    camera and decoding it, then wait get_interval() seconds before fetching
+    the next one.
+
+    The wait is chosen to hit target_fps, given how fast the camera is
+    delivering frames and how long decode takes. If the process uses more
+    than cpu_budget of a CPU, the wait is stretched until it doesn't.
+
+    get_status() returns the current measurements and decisions.
+    """
+
+    def __init__(self, fps=target_fps, budget=cpu_budget):
+        self.fps = fps
+        self.budget = budget
+
+        # smoothed per-frame times, in seconds
+        self.grab_time = 0.0
+        self.decode_time = 0.0
+
+        # the extra wait we add to stay within the CPU budget
+        self.cpu_interval = 0.0
+
+        self.interval = 1.0 / fps
+        self.limit = 'fps'
+
+        self.cpu = 0.0
+        self.cpu_start = os.times()
+        self.wall_start = time.time()
+
+    def average(self, old, new):
+        return old + smoothing * (new - old)
+
+    def sample_cpu(self):
+        now = time.time()
+        elapsed = now - self.wall_start
+        if elapsed < cpu_period:
+            return False
+
+        times = os.times()
+        used = (times[0] - self.cpu_start[0]) + (times[1] - self.cpu_start[1])
+        self.cpu = used / elapsed
+        self.cpu_start = times
+        self.wall_start = now
+
+        return True
+
+    def frame(self, grab_time, decode_time):
+        """Record the timing for a frame and update the interval.
+
+        grab_time -- seconds spent fetching the frame from the camera
+        decode_time -- seconds spent decompressing it
+        """
+        self.grab_time = self.average(self.grab_time, grab_time)
+        self.decode_time = self.average(self.decode_time, decode_time)
+
+        # the wait that would give us target fps
+        fps_interval = 1.0 / self.fps - (self.grab_time + self.decode_time)
+
+        # adjust the CPU wait once per sample period ... grow quickly if
+        # we're over, shrink slowly if we're well under ... never past 
+        # max_interval, or we'd take ages to recover once the load goes
+        if self.sample_cpu():
+            if self.cpu > self.budget:
+                self.cpu_interval = min(max(self.cpu_interval * 1.5,
+                                            self.interval * 1.2, 
+                                            min_interval), 
+                                        max_interval)
+            elif self.cpu < 0.8 * self.budget:
+                self.cpu_interval *= 0.8
+
+        if self.cpu_interval > max(fps_interval, min_interval):
+            interval = self.cpu_interval
+            self.limit = 'cpu'
+        elif fps_interval <= min_interval:
+            interval = fps_interval
+            self.limit = 'camera'
+        else:
+            interval = fps_interval
+            self.limit = 'fps'
+
+        self.interval = min(max(interval, min_interval), max_interval)
+
+    def get_interval(self):
+        """Return the number of seconds to wait before the next frame."""
+        return self.interval
+
+    def get_status(self):
+        """Return a hash of the current measurements and decisions.
+
+        fps -- the frame rate we are aiming for
+        grab_ms -- average time to fetch a frame from the camera
+        decode_ms -- average time to decode a frame
+        cpu -- fraction of a CPU used by the whole process
+        interval_ms -- the current wait between frames
+        limit -- what's setting the interval: 'fps' if we're hitting the
+            target, 'camera' if the camera or decode can't keep up, 'cpu' if
+            we're holding back to stay within the CPU budget
+        """
+        return {'fps': self.fps,
+                'grab_ms': 1000 * self.grab_time,
+                'decode_ms': 1000 * self.decode_time,
+                'cpu': self.cpu,
+                'interval_ms': 1000 * self.interval,
+                'limit': self.limit}
@@ -9,6 +9,9 @@ GNU LESSER GENERAL PUBLIC LICENSE
 """
 
 import logging
+import threading
+import time
+import ctypes
 
 import pygtk
 pygtk.require('2.0')
@@ -17,11 +20,13 @@ import glib
 
 import decompress 
 import rect 
+import pacer 
+import focus
+import exposure
 
-# inter-frame delay, in milliseconds
-# 50 gives around 20 fps and doesn't overload the machine too badly
-# 150 works on a raspberry Pi. 50 is too fast.
-frame_timeout = 50
+# after a camera error, the grab thread waits this long before retrying, in
+# milliseconds
+error_timeout = 1000
 
 # width of selection box border
 select_width = 2
@@ -29,6 +34,15 @@ select_width = 2
 # size of corner resize boxes
 select_corner = 15
 
+# size of the histogram display, in pixels ... 256 levels are shown as
+# histogram_width bars
+histogram_width = 128
+histogram_height = 64
+
+# with no selection, the loupe shows this fraction of the frame width and
+# height, from the centre
+loupe_default = 0.25
+
 # we have a small state machine for manipulating the select box
 def enum(**enums):
     return type('Enum', (), enums)
@@ -60,6 +74,13 @@ class Preview(gtk.EventBox):
     get_live -- return True if the preview is currently live
     set_live -- turn the live preview on and off
     get_selection -- get the currently selected rect.Rect (if any)
+    set_loupe -- show just the selected area, magnified
+    set_peaking -- highlight in-focus edges and show a sharpness score
+    set_exposure -- show a histogram and mark clipped highlights and shadows
+    add_sink -- also send the camera's preview jpegs somewhere else
+    remove_sink -- stop sending jpegs to a sink
+    get_dropped -- count frames which were decoded but never shown
+    get_pacing -- describe the current frame pacing
     """
 
     def draw_rect(self, gc, rect, margin):
@@ -86,17 +107,65 @@ class Preview(gtk.EventBox):
                               margin * 2,
                               max(0, rect.height - margin * 2))
 
+    def draw_score(self, widget, score):
+        window = self.image.get_window()
+        layout = widget.create_pango_layout('Sharpness %.1f' % score)
+        (width, height) = layout.get_pixel_size()
+        window.draw_rectangle(widget.get_style().black_gc, True,
+                              0, 0, width + 10, height + 6)
+        window.draw_layout(widget.get_style().white_gc, 5, 3, layout)
+
+    def draw_histogram(self, widget, histogram, clipped):
+        window = self.image.get_window()
+        image_width = self.image.get_allocation().width
+        image_height = self.image.get_allocation().height
+        layout = widget.create_pango_layout('Blown %.1f%%, crushed %.1f%%' % 
+                                            (100 * clipped[0], 
+                                             100 * clipped[1]))
+        (text_width, text_height) = layout.get_pixel_size()
+        width = max(histogram_width, text_width) + 10
+        height = histogram_height + text_height + 9
+        left = image_width - width
+        top = image_height - height
+
+        window.draw_rectangle(widget.get_style().black_gc, True,
+                              left, top, width, height)
+        window.draw_layout(widget.get_style().white_gc, 
+                           left + 5, top + 3, layout)
+
+        bars = histogram.reshape(histogram_width, -1).sum(axis = 1)
+        biggest = max(1, bars.max())
+        bottom = top + height - 3
+        for x in range(0, histogram_width):
+            bar = int(histogram_height * bars[x] / biggest)
+            if bar > 0:
+                window.draw_line(widget.get_style().white_gc,
+                                 left + 5 + x, bottom - bar,
+                                 left + 5 + x, bottom)
+
     # expose on our gtk.Image
     def expose_event(self, widget, event):
-        if self.select_visible:
+        if self.select_visible and self.loupe_crop == None:
             self.draw_rect(widget.get_style().white_gc, 
                            self.select_area, select_width)
             self.draw_rect(widget.get_style().black_gc, 
                            self.select_area, select_width - 1)
 
+        if self.peaking and self.sharpness != None:
+            self.draw_score(widget, self.sharpness)
+
+        meter = self.exposure
+        if meter and meter.get_histogram() is not None:
+            self.draw_histogram(widget, 
+                                meter.get_histogram(), meter.get_clipped())
+
         return False
 
     def button_press_event(self, widget, event):
+        # the display is magnified, so we can't edit the selection
+        if self.loupe_crop != None:
+            return
+
         x = int(event.x)
         y = int(event.y)
         direction = self.select_area.which_corner(select_corner, x, y)
@@ -198,6 +267,12 @@ class Preview(gtk.EventBox):
     def button_release_event(self, widget, event):
         self.select_state = SelectState.WAIT
 
+        # the grab thread measures focus in the selection
+        if self.select_visible:
+            self.focus_crop = self.selection_crop()
+        else:
+            self.focus_crop = None
+
     def __init__(self, camera):
         """
         Startup.
@@ -221,9 +296,47 @@ class Preview(gtk.EventBox):
         self.image.set_from_pixbuf(self.pixbuf)
         self.image.set_app_paintable(True)
 
-        self.preview_timeout = 0
         self.camera = camera
         self.frame = 0
+        self.fps_timeout = 0
+
+        # the grab thread fetches and decodes frames, and leaves the most
+        # recent one in latest_pixbuf for the GUI thread to pick up ... if
+        # the GUI doesn't get to a frame before the next arrives, the old one
+        # is dropped
+        self.grab_thread = None
+        self.stopping = threading.Event()
+        self.latest_lock = threading.Lock()
+        self.latest_pixbuf = None
+        self.show_queued = False
+        self.dropped = 0
+
+        # frames are decompressed into a set of reusable pixbufs
+        self.pool = decompress.FramePool()
+
+        # in loupe mode, we decode just the (left, top, width, height) area
+        # of the frame in loupe_crop into loupe_pool, then magnify that into
+        # a frame from the main pool for display
+        self.loupe_crop = None
+        self.loupe_pool = decompress.FramePool(1, 1)
+        self.fast = False
+
+        # with peaking on, the grab thread measures sharpness in the 
+        # focus_crop area of each frame, or the whole frame if that's None,
+        # and leaves the score in sharpness
+        self.peaking = False
+        self.focus_crop = None
+        self.sharpness = None
+
+        # the exposure meter, if it's on
+        self.exposure = None
+
+        # the camera's jpegs are also sent to these, see add_sink() 
+        self.sinks = []
+
+        # the inter-frame delay adapts to the camera and the machine we're
+        # running on
+        self.pacer = pacer.Pacer()
         self.select_visible = False
         self.select_area = rect.Rect(10, 10, 100, 100)
         self.select_state = SelectState.WAIT
@@ -239,22 +352,167 @@ class Preview(gtk.EventBox):
 
     def grab_frame(self):
         logging.debug('grabbing frame ..')
+        start = time.time()
         frame = self.camera.preview()
         if frame == None:
-            return
+            return None
         (data, length) = frame
         if length.value == 0:
+            return None
+        grabbed = time.time()
+
+        # send the jpeg on before we decode, so sinks don't depend on
+        # loupe or overlays ... one copy is shared by all the sinks
+        sinks = self.sinks
+        if len(sinks) > 0:
+            jpeg = ctypes.string_at(data, length.value)
+            for sink in sinks:
+                sink.add(jpeg, grabbed)
+
+        # the data pointer is only valid until the next preview(), so we must
+        # decode before we grab again
+        if self.loupe_crop != None:
+            pixbuf = self.loupe_frame(data, length)
+        else:
+            pixbuf = self.pool.decompress(data, length)
+            if pixbuf != None:
+                self.analyse(pixbuf, self.focus_crop)
+        self.pacer.frame(grabbed - start, time.time() - grabbed)
+
+        return pixbuf
+
+    # measure exposure, and score and highlight focus in the (left, top,
+    # width, height) crop area of a frame ... overlays are drawn into the
+    # frame
+    def analyse(self, pixbuf, crop):
+        meter = self.exposure
+        peaking = self.peaking
+        if not meter and not peaking:
             return
 
-        pixbuf = decompress.bufjpeg2pixbuf(data, length)
-        if pixbuf != None:
+        array = decompress.pixbuf2array(pixbuf)
+        if array is None:
+            return
+
+        # measure before we draw any overlays
+        if meter:
+            meter.frame(array)
+
+        if peaking:
+            area = array
+            if crop != None:
+                (left, top, width, height) = crop
+                area = array[top : top + height, left : left + width]
+            lap = focus.laplacian(area)
+            self.sharpness = focus.sharpness(area, lap)
+            focus.peak(area, lap)
+
+        if meter:
+            meter.overlay(array)
+
+    # decode just the loupe area and magnify it by an integer factor to fill
+    # a display frame ... nearest neighbour, so each preview pixel stays a
+    # sharp square
+    def loupe_frame(self, data, length):
+        area = self.loupe_pool.decompress(data, length)
+        if area == None:
+            return None
+        self.analyse(area, None)
+
+        pixbuf = self.pool.acquire()
+        frame_width = pixbuf.get_width()
+        frame_height = pixbuf.get_height()
+        area_width = area.get_width()
+        area_height = area.get_height()
+        scale = max(1, min(frame_width / area_width, 
+                           frame_height / area_height))
+        width = min(frame_width, area_width * scale)
+        height = min(frame_height, area_height * scale)
+        x = (frame_width - width) / 2
+        y = (frame_height - height) / 2
+
+        pixbuf.fill(0)
+        area.scale(pixbuf, x, y, width, height, x, y, scale, scale, 
+                   gtk.gdk.INTERP_NEAREST)
+        self.loupe_pool.release(area)
+
+        return pixbuf
+
+    def publish(self, pixbuf):
+        self.latest_lock.acquire()
+        try:
+            if self.latest_pixbuf != None:
+                self.dropped += 1
+                self.pool.release(self.latest_pixbuf)
+            self.latest_pixbuf = pixbuf
+            queue = not self.show_queued
+            self.show_queued = True
+        finally:
+            self.latest_lock.release()
+
+        if queue:
+            glib.idle_add(self.show_cb)
+
+    # run by the GUI thread to display the most recent frame
+    def show_cb(self):
+        self.latest_lock.acquire()
+        try:
+            pixbuf = self.latest_pixbuf
+            self.latest_pixbuf = None
+            self.show_queued = False
+        finally:
+            self.latest_lock.release()
+
+        if pixbuf != None and self.grab_thread != None:
+            # the frame we were showing can be reused once it's off screen
+            old_pixbuf = self.pixbuf
             self.pixbuf = pixbuf
             self.image.set_from_pixbuf(pixbuf)
+            self.pool.release(old_pixbuf)
             self.frame += 1
+        elif pixbuf != None:
+            self.pool.release(pixbuf)
+
+        return False
+
+    # the body of the grab thread
+    def grab_loop(self):
+        logging.debug('preview: grab thread start')
+        while not self.stopping.is_set():
+            try:
+                pixbuf = self.grab_frame()
+            except Exception as e:
+                logging.error('preview: %s', str(e))
+                self.stopping.wait(error_timeout / 1000.0)
+                continue
+
+            if pixbuf != None:
+                self.publish(pixbuf)
+
+            self.stopping.wait(self.pacer.get_interval())
+        logging.debug('preview: grab thread stop')
+
+    def get_dropped(self):
+        """Return the number of decoded frames that were never displayed."""
+        return self.dropped
+
+    def set_fast_decode(self, fast):
+        """Use the fast, slightly lower quality jpeg decoder for preview 
+        frames. Handy on slow machines like the Pi.
+        """
+        self.fast = fast
+        self.pool.set_options(1, fast)
+        self.loupe_pool.set_options(1, fast, self.loupe_crop)
+
+    def get_pacing(self):
+        """Return a hash describing the current frame pacing, see 
+        pacer.Pacer.get_status().
+        """
+        return self.pacer.get_status()
 
     def get_live(self):
         """Return True if the display is currently live."""
-        return self.preview_timeout != 0
+        return self.grab_thread != None
 
     def get_selection(self):
         """Return a rect.Rect for the selection, or None if no selection
@@ -270,12 +528,127 @@ class Preview(gtk.EventBox):
                          1000 * self.select_area.width / image_width,
                          1000 * self.select_area.height / image_height)
 
-    def live_cb(self):
-        self.grab_frame()
-        return True
+    def get_loupe(self):
+        """Return True if the loupe is on."""
+        return self.loupe_crop != None
+
+    def selection_crop(self):
+        # the selection as (left, top, width, height) in frame pixels
+        frame_width = self.pool.width
+        frame_height = self.pool.height
+        image_width = self.image.get_allocation().width
+        image_height = self.image.get_allocation().height
+        area = rect.Rect(
+            frame_width * self.select_area.left / image_width,
+            frame_height * self.select_area.top / image_height,
+            frame_width * self.select_area.width / image_width,
+            frame_height * self.select_area.height / image_height)
+
+        return (area.left, area.top, max(1, area.width), max(1, area.height))
+
+    def set_loupe(self, loupe):
+        """Turn the focus loupe on and off.
+
+        loupe -- True means show just the selected area, magnified
+
+        Only the selected area is decoded, so the loupe is much cheaper than
+        the full preview and can run at a higher frame rate. With no 
+        selection, the loupe shows the centre of the frame. 
+        """
+        if loupe and self.select_visible:
+            crop = self.selection_crop()
+        elif loupe:
+            frame_width = self.pool.width
+            frame_height = self.pool.height
+            width = int(frame_width * loupe_default)
+            height = int(frame_height * loupe_default)
+            crop = ((frame_width - width) / 2, (frame_height - height) / 2,
+                    width, height)
+        else:
+            crop = None
+
+        logging.debug('preview: loupe %s', str(crop))
+        self.loupe_pool.set_options(1, self.fast, crop)
+        self.loupe_crop = crop
+        self.queue_draw()
+
+    def get_peaking(self):
+        """Return True if focus peaking is on."""
+        return self.peaking
+
+    def set_peaking(self, peaking):
+        """Turn focus peaking on and off.
+
+        peaking -- True means highlight in-focus edges and show a sharpness 
+            score
+
+        The score is the variance of the Laplacian over the selection, or 
+        the whole frame if there's no selection. Bigger is sharper. Peaking
+        needs numpy, see focus.supported().
+        """
+        if peaking and not focus.supported():
+            logging.error('preview: focus peaking needs numpy')
+            return
+
+        self.sharpness = None
+        self.peaking = peaking
+        self.queue_draw()
+
+    def get_exposure(self):
+        """Return True if the exposure display is on."""
+        return self.exposure != None
+
+    def set_exposure(self, on):
+        """Turn the exposure display on and off.
+
+        on -- True means show a histogram and mark blown highlights and 
+            crushed shadows
+
+        The frame is sampled on a grid, and each frame gets a fixed time 
+        budget, so the histogram can take a few frames to update on a slow
+        machine. See exposure.Exposure. This needs numpy.
+        """
+        if on and not exposure.supported():
+            logging.error('preview: exposure display needs numpy')
+            return
+
+        if on and self.exposure == None:
+            self.exposure = exposure.Exposure()
+        elif not on:
+            self.exposure = None
+        self.queue_draw()
+
+    def add_sink(self, sink):
+        """Send each new preview jpeg to sink.
+
+        sink.add(jpeg, timestamp) is called from the grab thread with a 
+        string containing the camera's jpeg and the time it was grabbed. It
+        must be quick, see recorder.Recorder and streamer.Streamer.
+        """
+        # the grab thread reads sinks without a lock, so make a new list
+        self.sinks = self.sinks + [sink]
+
+    def remove_sink(self, sink):
+        """Stop sending jpegs to sink."""
+        self.sinks = [x for x in self.sinks if x != sink]
+
+    def get_histogram(self):
+        """Return a 256-element numpy array of luminance counts and a 
+        (blown, crushed) pair of fractions, or None.
+        """
+        meter = self.exposure
+        if not meter or meter.get_histogram() is None:
+            return None
+
+        return (meter.get_histogram(), meter.get_clipped())
+
+    def get_sharpness(self):
+        """Return the sharpness of the last frame, or None."""
+        return self.sharpness
 
     def fps_cb(self):
-        logging.debug('fps = %d', self.frame)
+        logging.debug('fps = %d, %d dropped', self.frame, self.dropped)
+        logging.debug('pacing = %s', self.pacer.get_status())
         self.frame = 0
         return True
 
@@ -283,21 +656,22 @@ class Preview(gtk.EventBox):
         """Turn the live preview on and off.
 
         live -- True means start the live preview display
+
+        Frames are fetched and decoded in a background thread, so the GUI
+        never waits for the camera. Turning the preview off waits for the
+        thread to finish with the camera.
         """
-        if live and self.preview_timeout == 0:
-            logging.debug('starting timeout ..')
-            self.preview_timeout = glib.timeout_add(frame_timeout, 
-                            self.live_cb)
+        if live and self.grab_thread == None:
+            logging.debug('starting grab thread ..')
+            self.stopping.clear()
+            self.grab_thread = threading.Thread(target = self.grab_loop)
+            self.grab_thread.daemon = True
+            self.grab_thread.start()
             self.fps_timeout = glib.timeout_add(1000, self.fps_cb)
 
-        elif not live and self.preview_timeout != 0:
-            glib.source_remove(self.preview_timeout)
-            self.preview_timeout = 0
+        elif not live and self.grab_thread != None:
+            self.stopping.set()
+            self.grab_thread.join()
+            self.grab_thread = None
             glib.source_remove(self.fps_timeout)
             self.fps_timeout = 0
-
-        if live:
-            # grab a frame immediately so we can get an exception, if there
-            # are any
-            self.grab_frame()
-
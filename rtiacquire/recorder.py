@@ -0,0 +1,297 @@
+#!/usr/bin/python
+
+"""Record the live preview to an MJPEG AVI file.
+
+Recorder -- append preview jpegs to an AVI from a background thread
+Error -- the exception we can raise
+jpeg_size -- find the size of a jpeg image from its header
+
+The camera's preview frames are already jpegs, so we write them to the AVI
+as they are, with no decode or re-encode. Next to the AVI we write a text
+file with the time each frame was grabbed.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import threading
+import Queue
+import struct
+
+# the number of frames that can be waiting to be written ... if the disc
+# falls further behind than this, frames are dropped from the recording,
+# never from the preview
+max_pending = 32
+
+# the size of the write buffer on the AVI file
+buffer_size = 1024 * 1024
+
+# AVI 1.0 files can't be larger than this, we stop recording when we get
+# close
+max_size = 1024 * 1024 * 1024
+
+# the frame rate we write if there's only one frame
+default_fps = 20
+
+# the suffix of the frame time file
+times_suffix = '.times'
+
+# AVI flags
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+
+class Error(Exception):
+
+    """An error from the recorder.
+
+    message -- a high-level description of the error
+    detail -- a string with some detailed diagnostics
+    """
+
+    def __init__(self, message, detail):
+        self.message = message
+        self.detail = detail
+
+        logging.debug('recorder: %s', repr(self))
+
+    def __str__(self):
+        return '%s - %s' % (self.message, self.detail)
+
+def jpeg_size(data):
+    """Return (width, height) for a string containing a jpeg, or None."""
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != '\xff':
+            return None
+        marker = ord(data[offset + 1])
+        # SOF0 - SOF15, except DHT, JPG and DAC
+        if marker >= 0xc0 and marker <= 0xcf and \
+            marker not in [0xc4, 0xc8, 0xcc]:
+            (height, width) = struct.unpack('>HH',
+                                            data[offset + 5 : offset + 9])
+            return (width, height)
+        (length,) = struct.unpack('>H', data[offset + 2 : offset + 4])
+        offset += 2 + length
+
+    return None
+
+def chunk_header(fourcc, size):
+    return struct.pack('<4sI', fourcc, size)
+
+def avi_header(frames, usec_per_frame, max_frame, width, height):
+    """Make the AVI header, up to and including the start of the movi list.
+
+    It's always the same length, so we can rewrite it with the final frame
+    count when we close.
+    """
+    avih = struct.pack('<14I',
+                       usec_per_frame,
+                       0,                       # max bytes per second
+                       0,                       # padding granularity
+                       AVIF_HASINDEX,
+                       frames,
+                       0,                       # initial frames
+                       1,                       # streams
+                       max_frame,
+                       width, height,
+                       0, 0, 0, 0)
+    strh = struct.pack('<4s4sIHHIIIIIIiI4h',
+                       'vids', 'MJPG',
+                       0,                       # flags
+                       0, 0,                    # priority, language
+                       0,                       # initial frames
+                       usec_per_frame, 1000000, # scale, rate
+                       0,                       # start
+                       frames,
+                       max_frame,
+                       -1,                      # quality
+                       0,                       # sample size
+                       0, 0, width, height)
+    strf = struct.pack('<IiiHH4sIiiII',
+                       40, width, height, 1, 24, 'MJPG',
+                       width * height * 3, 0, 0, 0, 0)
+
+    strl = 'strl' + \
+        chunk_header('strh', len(strh)) + strh + \
+        chunk_header('strf', len(strf)) + strf
+    hdrl = 'hdrl' + \
+        chunk_header('avih', len(avih)) + avih + \
+        chunk_header('LIST', len(strl)) + strl
+
+    return chunk_header('LIST', len(hdrl)) + hdrl
+
+class Recorder:
+
+    """Append preview frames to an MJPEG AVI file.
+
+    add() queues a frame for a background thread to write, so it's quick,
+    and it never blocks: if the disc can't keep up, the
+    frame is dropped from the recording.
+
+    Call close() to finish the file. The AVI can't be played until then.
+    The first error stops recording and is raised by close(). Recording 
+    also stops when the file reaches max_size, see get_full(), but the AVI
+    is still finished by close().
+    """
+
+    def __init__(self, filename, pending = max_pending):
+        """Start recording to filename.
+
+        This method can raise recorder.Error.
+        """
+        self.filename = filename
+        self.queue = Queue.Queue(pending)
+        self.error = None
+
+        # set when we reach max_size ... we stop adding frames, but this is
+        # not an error
+        self.full = False
+
+        self.frames = 0
+        self.dropped = 0
+        self.first_time = None
+        self.last_time = None
+
+        # offset and size of each frame chunk, relative to the start of the
+        # movi list, for the index
+        self.index = []
+        self.size = 0
+        self.max_frame = 0
+        self.width = 0
+        self.height = 0
+
+        try:
+            self.f = open(filename, 'wb', buffer_size)
+        except IOError as e:
+            raise Error('Unable to start recording', str(e))
+        try:
+            self.times = open(filename + times_suffix, 'w')
+        except IOError as e:
+            self.f.close()
+            raise Error('Unable to start recording', str(e))
+
+        # space for the header, filled in on close
+        self.header_size = 12 + len(avi_header(0, 0, 0, 0, 0)) + 12
+        self.f.write('\0' * self.header_size)
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_frame(self, data, timestamp):
+        if self.width == 0:
+            size = jpeg_size(data)
+            if size:
+                (self.width, self.height) = size
+
+        # offsets in the index are from the 'movi' fourcc
+        offset = self.f.tell() - (self.header_size - 4)
+        self.f.write(chunk_header('00dc', len(data)))
+        self.f.write(data)
+        if len(data) & 1:
+            self.f.write('\0')
+
+        self.index.append((offset, len(data)))
+        self.max_frame = max(self.max_frame, len(data))
+        self.size = self.f.tell()
+
+        if self.first_time == None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        self.times.write('%d %.6f\n' % (self.frames, timestamp))
+        self.frames += 1
+
+    def finish(self):
+        movi_end = self.f.tell()
+        self.f.write(chunk_header('idx1', 16 * len(self.index)))
+        for (offset, size) in self.index:
+            self.f.write(struct.pack('<4sIII',
+                                     '00dc', AVIIF_KEYFRAME, offset, size))
+        riff_end = self.f.tell()
+
+        # players need a frame rate, guess if we can't measure one
+        usec_per_frame = 1000000 / default_fps
+        if self.frames > 1:
+            seconds = self.last_time - self.first_time
+            usec_per_frame = int(1000000 * seconds / (self.frames - 1))
+            usec_per_frame = max(1, usec_per_frame)
+
+        header = avi_header(self.frames, usec_per_frame,
+                            self.max_frame, self.width, self.height)
+        self.f.seek(0)
+        self.f.write(chunk_header('RIFF', riff_end - 8) + 'AVI ')
+        self.f.write(header)
+        self.f.write(chunk_header('LIST', movi_end - self.header_size + 4) +
+                     'movi')
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None:
+                    if self.error == None:
+                        self.finish()
+                elif self.error == None and not self.full:
+                    (data, timestamp) = item
+                    self.write_frame(data, timestamp)
+                    if self.size > max_size:
+                        logging.debug('recorder: AVI file size limit '
+                                      'reached')
+                        self.full = True
+            except (OSError, IOError) as e:
+                self.error = Error('Unable to write recording', str(e))
+            finally:
+                self.queue.task_done()
+
+            # always stop on close(), even if finish() failed
+            if item == None:
+                break
+
+    def add(self, frame, timestamp):
+        """Queue a frame for writing.
+
+        frame is a string containing a jpeg, timestamp is the time it was 
+        grabbed in seconds. 
+        """
+        if self.error != None or self.full:
+            return
+
+        try:
+            self.queue.put_nowait((frame, timestamp))
+        except Queue.Full:
+            self.dropped += 1
+
+    def get_frames(self):
+        """Return the number of frames written so far."""
+        return self.frames
+
+    def get_dropped(self):
+        """Return the number of frames dropped because the disc was busy."""
+        return self.dropped
+
+    def get_full(self):
+        """Return True if recording stopped at the AVI file size limit."""
+        return self.full
+
+    def close(self):
+        """Finish the recording.
+
+        This method can raise recorder.Error.
+        """
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+            # closing flushes, so this can fail too
+            for f in [self.f, self.times]:
+                try:
+                    f.close()
+                except (OSError, IOError) as e:
+                    if self.error == None:
+                        self.error = Error('Unable to write recording', 
+                                           str(e))
+        if self.error:
+            raise self.error
@@ -0,0 +1,779 @@
+#!/usr/bin/python
+
+"""Record camera and light controller I/O, and play it back.
+
+Session -- a session log being written
+RecordingCamera -- a camera backend which logs every call to libgphoto2
+RecordingSerial -- a serial backend which logs every call to pyserial
+Tape -- a session log loaded from disc
+Player -- hand out recorded calls in order
+ReplayCamera -- a camera backend which plays back a Tape
+ReplaySerial -- a serial backend which plays back a Tape
+record -- log all camera and serial I/O to a directory
+replay -- play all camera and serial I/O back from a directory
+Error -- the exception we can raise
+
+Record a session with real hardware, then replay it with no hardware
+attached to see how changes to the program affect timing. Each call gets
+back exactly what the hardware gave it, after the same delay, including
+failed previews, slow downloads and libgphoto2's error messages.
+
+A session is a directory. The file "session.log" has one JSON object per
+line, one for each call:
+
+    source -- "camera" or "serial"
+    call -- the function or method called
+    start -- seconds since the start of the session
+    duration -- seconds the call took
+    args -- the arguments ... outputs are {"out": value after the call}
+    result -- the return value
+    error -- for serial calls, [exception class name, message] if it raised
+    logs -- for camera calls, [level, domain, format] for each libgphoto2
+        log message during the call
+    payload -- for camera calls that fetch a file, the SHA1 of the data
+    event -- for camera events, the CameraFilePath or text they carried
+    port, open -- for serial calls, the port name and which time it was
+        opened
+
+Strings are stored as latin-1 so that any bytes survive. Each payload is
+saved once, in a file named by its SHA1.
+
+Replay matches calls by name, in order, so it can survive threads taking
+turns in a different order. If the program makes a call the session
+doesn't have, camera calls fail with GP_ERROR and serial ports time out.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import os
+import ctypes
+import threading
+import time
+import json
+import hashlib
+import collections
+
+import serial
+
+import camera
+import camsim
+import lights
+
+# the name of the call log in a session directory
+log_name = 'session.log'
+
+class Error(Exception):
+
+    """An error from record or replay.
+
+    message -- a high-level description of the error
+    detail -- a string with some detailed diagnostics
+    """
+
+    def __init__(self, message, detail):
+        self.message = message
+        self.detail = detail
+
+        logging.debug('replay: %s', repr(self))
+
+    def __str__(self):
+        return '%s - %s' % (self.message, self.detail)
+
+def encode(value):
+    """Make a value safe for JSON: strings can hold any bytes."""
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    if isinstance(value, (list, tuple)):
+        return [encode(x) for x in value]
+    if isinstance(value, dict):
+        return dict([(key, encode(x)) for (key, x) in value.items()])
+    return value
+
+def decode(value):
+    """Undo encode() on a value loaded from JSON."""
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [decode(x) for x in value]
+    if isinstance(value, dict):
+        return dict([(decode(key), decode(x)) for (key, x) in value.items()])
+    return value
+
+def argument(arg):
+    """The value of a ctypes argument after a call, for the log."""
+    # outputs are passed with byref()
+    if hasattr(arg, '_obj'):
+        obj = arg._obj
+        if isinstance(obj, camera.CameraFilePath):
+            return {'out': {'folder': obj.folder, 'name': obj.name}}
+        return {'out': obj.value}
+    if isinstance(arg, camera.LOGFUNC):
+        return None
+    if isinstance(arg, (ctypes.c_void_p, ctypes.c_char_p,
+                        ctypes.c_int, ctypes.c_float)):
+        return arg.value
+    return arg
+
+def set_output(obj, value):
+    if isinstance(value, dict):
+        for (name, x) in value.items():
+            setattr(obj, name, x)
+    else:
+        obj.value = value
+
+def file_handle(handle):
+    if isinstance(handle, ctypes.c_void_p):
+        return handle.value
+    return handle
+
+def write_fd(fd, data):
+    offset = 0
+    while offset < len(data):
+        offset += os.write(fd, buffer(data, offset))
+
+class Session:
+
+    """A session log being written.
+
+    The log is line-buffered, so it's complete up to the last call even if
+    we crash. This method can raise replay.Error.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.payloads = set()
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.log = open(os.path.join(directory, log_name), 'w', 1)
+        except (OSError, IOError) as e:
+            raise Error('Unable to start recording', str(e))
+
+        self.start = time.time()
+
+    def time(self):
+        """Return seconds since the start of the session."""
+        return time.time() - self.start
+
+    def add(self, record):
+        """Append a record to the log."""
+        line = json.dumps(encode(record), sort_keys = True) + '\n'
+        self.lock.acquire()
+        try:
+            self.log.write(line)
+        finally:
+            self.lock.release()
+
+    def add_payload(self, data):
+        """Save data, if we've not seen it before, and return its SHA1."""
+        digest = hashlib.sha1(data).hexdigest()
+        self.lock.acquire()
+        try:
+            if not digest in self.payloads:
+                f = open(os.path.join(self.directory, digest), 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+                self.payloads.add(digest)
+        finally:
+            self.lock.release()
+
+        return digest
+
+    def close(self):
+        self.log.close()
+
+class RecordingCamera:
+
+    """A camera backend which logs every call to another backend.
+
+    Files camera.py asks to have written to an fd are fetched to memory
+    instead, so we can log their contents, and then written to the fd by
+    us.
+    """
+
+    def __init__(self, backend, session):
+        self.backend = backend
+        self.session = session
+
+        # the file handles we made in place of fd files, and their fds
+        self.fds = {}
+
+        # keep our log functions alive
+        self.log_funcs = []
+
+        # the log messages for the call running on this thread
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        if not name.startswith('gp_'):
+            raise AttributeError(name)
+        func = getattr(self.backend, name)
+
+        def call(*args):
+            (result, record) = self.call(name, func, args)
+            self.session.add(record)
+            return result
+
+        return call
+
+    def call(self, name, func, args):
+        self.local.logs = []
+        start = self.session.time()
+        try:
+            result = func(*args)
+        finally:
+            duration = self.session.time() - start
+            logs = self.local.logs
+            self.local.logs = None
+
+        record = {'source': 'camera', 'call': name,
+                  'start': start, 'duration': duration,
+                  'args': [argument(arg) for arg in args],
+                  'result': result}
+        if len(logs) > 0:
+            record['logs'] = logs
+
+        return (result, record)
+
+    def file_data(self, cam_file):
+        data = ctypes.c_void_p()
+        length = ctypes.c_ulong()
+        retval = self.backend.gp_file_get_data_and_size(cam_file,
+                        ctypes.byref(data), ctypes.byref(length))
+        if retval != camera.GP_OK or not data.value:
+            return None
+        return ctypes.string_at(data, length.value)
+
+    def fetch(self, name, args, cam_file):
+        # a call which fills a file ... log the file's contents too
+        (result, record) = self.call(name, getattr(self.backend, name), args)
+        if result == camera.GP_OK:
+            data = self.file_data(cam_file)
+            if data != None:
+                record['payload'] = self.session.add_payload(data)
+                fd = self.fds.get(file_handle(cam_file))
+                if fd != None:
+                    write_fd(fd, data)
+        self.session.add(record)
+        return result
+
+    def gp_log_add_func(self, level, func, data):
+        def log(level, domain, fmt, args, data):
+            message = [level, domain, fmt]
+            logs = getattr(self.local, 'logs', None)
+            if logs != None:
+                logs.append(message)
+            else:
+                self.session.add({'source': 'camera', 'call': 'log',
+                                  'start': self.session.time(),
+                                  'duration': 0, 'args': message})
+            func(level, domain, fmt, args, data)
+
+        wrapper = camera.LOGFUNC(log)
+        self.log_funcs.append(wrapper)
+        return self.backend.gp_log_add_func(level, wrapper, data)
+
+    def gp_log_remove_func(self, log_id):
+        return self.backend.gp_log_remove_func(log_id)
+
+    def gp_file_new_from_fd(self, file_ref, fd):
+        (result, record) = self.call('gp_file_new', self.backend.gp_file_new,
+                                     (file_ref,))
+        record['call'] = 'gp_file_new_from_fd'
+        record['args'].append(fd)
+        if result == camera.GP_OK:
+            self.fds[file_ref._obj.value] = fd
+        self.session.add(record)
+        return result
+
+    def gp_file_unref(self, cam_file):
+        (result, record) = self.call('gp_file_unref',
+                                     self.backend.gp_file_unref, (cam_file,))
+        fd = self.fds.pop(file_handle(cam_file), None)
+        if fd != None:
+            os.close(fd)
+        self.session.add(record)
+        return result
+
+    def gp_camera_capture_preview(self, cam, cam_file, context):
+        return self.fetch('gp_camera_capture_preview',
+                          (cam, cam_file, context), cam_file)
+
+    def gp_camera_file_get(self, cam, folder, name, file_type, cam_file,
+                           context):
+        return self.fetch('gp_camera_file_get',
+                          (cam, folder, name, file_type, cam_file, context),
+                          cam_file)
+
+    def gp_camera_wait_for_event(self, cam, timeout, type_ref, data_ref,
+                                 context):
+        (result, record) = self.call('gp_camera_wait_for_event',
+                                     self.backend.gp_camera_wait_for_event,
+                                     (cam, timeout, type_ref, data_ref,
+                                      context))
+        data = data_ref._obj.value
+        if result == camera.GP_OK and data:
+            if type_ref._obj.value == camera.GP_EVENT_FILE_ADDED:
+                path = camera.CameraFilePath.from_buffer_copy(
+                    ctypes.string_at(data,
+                                     ctypes.sizeof(camera.CameraFilePath)))
+                record['event'] = {'folder': path.folder, 'name': path.name}
+            elif type_ref._obj.value == camera.GP_EVENT_UNKNOWN:
+                record['event'] = ctypes.string_at(data)
+        self.session.add(record)
+        return result
+
+class RecordingPort:
+
+    """A serial port which logs every call."""
+
+    def __init__(self, session, port, portname, number):
+        self.session = session
+        self.port = port
+        self.portname = portname
+        self.number = number
+
+    def call(self, name, *args):
+        record = {'source': 'serial', 'call': name,
+                  'port': self.portname, 'open': self.number,
+                  'start': self.session.time(), 'args': list(args)}
+        try:
+            result = getattr(self.port, name)(*args)
+        except lights.port_errors as e:
+            record['duration'] = self.session.time() - record['start']
+            record['error'] = [e.__class__.__name__, str(e)]
+            self.session.add(record)
+            raise
+        record['duration'] = self.session.time() - record['start']
+        record['result'] = result
+        self.session.add(record)
+        return result
+
+    def write(self, data):
+        return self.call('write', data)
+
+    def read(self, size = 1):
+        return self.call('read', size)
+
+    def readline(self):
+        return self.call('readline')
+
+    def inWaiting(self):
+        return self.call('inWaiting')
+
+    def flushInput(self):
+        return self.call('flushInput')
+
+    def close(self):
+        return self.call('close')
+
+class RecordingSerial:
+
+    """A serial backend which logs every call to pyserial."""
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.Lock()
+
+        # the number of times we've opened each port
+        self.opens = {}
+
+    def scan(self):
+        start = self.session.time()
+        result = lights.scanserial()
+        self.session.add({'source': 'serial', 'call': 'scan',
+                          'start': start,
+                          'duration': self.session.time() - start,
+                          'args': [], 'result': result})
+        return result
+
+    def open(self, portname, baudrate, timeout):
+        self.lock.acquire()
+        try:
+            number = self.opens.get(portname, 0)
+            self.opens[portname] = number + 1
+        finally:
+            self.lock.release()
+
+        record = {'source': 'serial', 'call': 'open',
+                  'port': portname, 'open': number,
+                  'start': self.session.time(),
+                  'args': [portname, baudrate, timeout]}
+        try:
+            port = serial.Serial(portname, baudrate, timeout = timeout)
+        except lights.port_errors as e:
+            record['duration'] = self.session.time() - record['start']
+            record['error'] = [e.__class__.__name__, str(e)]
+            self.session.add(record)
+            raise
+        record['duration'] = self.session.time() - record['start']
+        record['result'] = None
+        self.session.add(record)
+
+        return RecordingPort(self.session, port, portname, number)
+
+class Tape:
+
+    """A session log loaded from disc.
+
+    This method can raise replay.Error.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.records = []
+        self.images = {}
+
+        try:
+            f = open(os.path.join(directory, log_name), 'r')
+            try:
+                for line in f:
+                    self.records.append(decode(json.loads(line)))
+            finally:
+                f.close()
+        except (IOError, ValueError) as e:
+            raise Error('Unable to load session', str(e))
+
+    def queues(self, key):
+        """Sort records into a dict of deques, in order, grouped by key."""
+        queues = {}
+        for record in self.records:
+            k = key(record)
+            if k != None:
+                queues.setdefault(k, collections.deque()).append(record)
+        return queues
+
+    def get_image(self, digest):
+        """Return a payload as a camsim.Image."""
+        if not digest in self.images:
+            self.images[digest] = camsim.Image(camsim.load_jpeg(
+                                    os.path.join(self.directory, digest)))
+        return self.images[digest]
+
+    def get_duration(self):
+        """Return the length of the session in seconds."""
+        if len(self.records) == 0:
+            return 0
+        last = self.records[-1]
+        return last['start'] + last['duration']
+
+class Player:
+
+    """Hand out recorded calls in order, waiting as long as each took."""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.misses = 0
+
+    def pop(self, queue, name, skip = True):
+        # the next call to name from a queue ... with skip, drop calls in the
+        # way, otherwise give up
+        self.lock.acquire()
+        try:
+            if queue == None or len(queue) == 0:
+                if not skip:
+                    return None
+                self.misses += 1
+                logging.error('replay: no %s call left', name)
+                return None
+            if queue[0]['call'] != name:
+                if not skip:
+                    return None
+                dropped = 0
+                while len(queue) > 0 and queue[0]['call'] != name:
+                    queue.popleft()
+                    dropped += 1
+                self.misses += dropped
+                logging.error('replay: skipped %d calls to reach %s',
+                              dropped, name)
+                if len(queue) == 0:
+                    return None
+            return queue.popleft()
+        finally:
+            self.lock.release()
+
+    def wait(self, record):
+        seconds = record['duration'] * self.speed
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def get_misses(self):
+        """Return the number of calls which didn't match the session."""
+        return self.misses
+
+class ReplayCamera(Player):
+
+    """A camera backend which plays back the camera calls in a Tape.
+
+    speed -- scale recorded call times by this, 0 means don't wait at all
+    """
+
+    def __init__(self, tape, speed = 1.0):
+        Player.__init__(self, speed)
+        self.tape = tape
+        self.queues = tape.queues(lambda record:
+            record['source'] == 'camera' and record['call'] or None)
+
+        # log functions, by id
+        self.log_funcs = {}
+
+        # file handles, as recorded, to camsim.File
+        self.files = {}
+
+    def __getattr__(self, name):
+        if not name.startswith('gp_'):
+            raise AttributeError(name)
+
+        def call(*args):
+            (result, record) = self.call(name, args)
+            return result
+
+        return call
+
+    def call(self, name, args):
+        record = self.pop(self.queues.get(name), name)
+        if record == None:
+            return (camera.GP_ERROR, None)
+
+        self.wait(record)
+        for (arg, value) in zip(args, record['args']):
+            if isinstance(value, dict) and hasattr(arg, '_obj'):
+                set_output(arg._obj, value['out'])
+        for (level, domain, fmt) in record.get('logs', []):
+            for func in self.log_funcs.values():
+                func(level, domain, fmt, camera.VaList(), None)
+
+        return (record['result'], record)
+
+    def gp_context_new(self):
+        # contexts are never looked at, so any value will do, and we can 
+        # wrap a ReplayCamera in more backends
+        return 1
+
+    def gp_log_add_func(self, level, func, data):
+        log_id = len(self.log_funcs) + 1
+        self.log_funcs[log_id] = func
+        return log_id
+
+    def gp_log_remove_func(self, log_id):
+        self.log_funcs.pop(log_id, None)
+        return camera.GP_OK
+
+    def gp_file_new(self, file_ref):
+        (result, record) = self.call('gp_file_new', (file_ref,))
+        if result == camera.GP_OK:
+            self.files[file_ref._obj.value] = camsim.File()
+        return result
+
+    def gp_file_new_from_fd(self, file_ref, fd):
+        (result, record) = self.call('gp_file_new_from_fd', (file_ref, fd))
+        if result == camera.GP_OK:
+            self.files[file_ref._obj.value] = camsim.File(fd)
+        return result
+
+    def gp_file_unref(self, cam_file):
+        (result, record) = self.call('gp_file_unref', (cam_file,))
+        cam_file = self.files.pop(file_handle(cam_file), None)
+        if cam_file != None and cam_file.fd != None:
+            os.close(cam_file.fd)
+        return result
+
+    def fetch(self, name, args, cam_file):
+        (result, record) = self.call(name, args)
+        cam_file = self.files.get(file_handle(cam_file))
+        if result == camera.GP_OK and cam_file != None and \
+            'payload' in record:
+            cam_file.image = self.tape.get_image(record['payload'])
+            if cam_file.fd != None:
+                write_fd(cam_file.fd, cam_file.image.data)
+        return result
+
+    def gp_camera_capture_preview(self, cam, cam_file, context):
+        return self.fetch('gp_camera_capture_preview',
+                          (cam, cam_file, context), cam_file)
+
+    def gp_camera_file_get(self, cam, folder, name, file_type, cam_file,
+                           context):
+        return self.fetch('gp_camera_file_get',
+                          (cam, folder, name, file_type, cam_file, context),
+                          cam_file)
+
+    def gp_file_get_data_and_size(self, cam_file, data_ref, length_ref):
+        (result, record) = self.call('gp_file_get_data_and_size',
+                                     (cam_file, data_ref, length_ref))
+        cam_file = self.files.get(file_handle(cam_file))
+        data_ref._obj.value = None
+        length_ref._obj.value = 0
+        if result == camera.GP_OK and cam_file != None and \
+            cam_file.image != None:
+            data_ref._obj.value = ctypes.addressof(cam_file.image.buffer)
+            length_ref._obj.value = cam_file.image.length
+        return result
+
+    def gp_file_save(self, cam_file, filename):
+        (result, record) = self.call('gp_file_save', (cam_file, filename))
+        cam_file = self.files.get(file_handle(cam_file))
+        if result == camera.GP_OK and cam_file != None and \
+            cam_file.image != None:
+            f = open(filename, 'wb')
+            try:
+                f.write(cam_file.image.data)
+            finally:
+                f.close()
+        return result
+
+    def gp_camera_wait_for_event(self, cam, timeout, type_ref, data_ref,
+                                 context):
+        (result, record) = self.call('gp_camera_wait_for_event',
+                                     (cam, timeout, type_ref, data_ref,
+                                      context))
+        data_ref._obj.value = None
+        if record == None:
+            return result
+
+        # camera.py frees event data, so it must come from malloc()
+        event = record.get('event')
+        if isinstance(event, dict):
+            path = camera.CameraFilePath()
+            path.folder = event['folder']
+            path.name = event['name']
+            data = camsim.libc.malloc(ctypes.sizeof(path))
+            ctypes.memmove(data, ctypes.addressof(path), ctypes.sizeof(path))
+            data_ref._obj.value = data
+        elif event != None:
+            data = camsim.libc.malloc(len(event) + 1)
+            ctypes.memmove(data, event, len(event) + 1)
+            data_ref._obj.value = data
+
+        return result
+
+def port_error(name, message):
+    """Make an exception like the one a port raised."""
+    # port_errors has EnvironmentError, but sessions record the subclass
+    for error in lights.port_errors + (IOError, OSError):
+        if error.__name__ == name:
+            return error(message)
+    return serial.SerialException(message)
+
+class ReplayPort:
+
+    """A serial port which plays back the calls made on it in a Tape."""
+
+    def __init__(self, player, queue, timeout):
+        self.player = player
+        self.queue = queue
+        self.timeout = timeout
+
+    def call(self, name, *args):
+        # we may poll more or less often than the session did, so polls
+        # which don't match are answered with "nothing yet"
+        if name == 'inWaiting':
+            record = self.player.pop(self.queue, name, False)
+            if record == None:
+                return 0
+        else:
+            record = self.player.pop(self.queue, name)
+            if record == None:
+                if name in ['read', 'readline']:
+                    time.sleep(self.timeout * self.player.speed)
+                    return ''
+                return None
+
+        self.player.wait(record)
+        if 'error' in record:
+            raise port_error(*record['error'])
+        return record.get('result')
+
+    def write(self, data):
+        return self.call('write', data)
+
+    def read(self, size = 1):
+        return self.call('read', size)
+
+    def readline(self):
+        return self.call('readline')
+
+    def inWaiting(self):
+        return self.call('inWaiting')
+
+    def flushInput(self):
+        return self.call('flushInput')
+
+    def close(self):
+        return self.call('close')
+
+class ReplaySerial(Player):
+
+    """A serial backend which plays back the serial calls in a Tape.
+
+    speed -- scale recorded call times by this, 0 means don't wait at all
+    """
+
+    def __init__(self, tape, speed = 1.0):
+        Player.__init__(self, speed)
+
+        def key(record):
+            if record['source'] != 'serial':
+                return None
+            if record['call'] == 'scan':
+                return 'scan'
+            if record['call'] == 'open':
+                return ('open', record['port'])
+            return (record['port'], record['open'])
+
+        self.queues = tape.queues(key)
+
+    def scan(self):
+        record = self.pop(self.queues.get('scan'), 'scan')
+        if record == None:
+            return []
+        self.wait(record)
+        return record['result']
+
+    def open(self, portname, baudrate, timeout):
+        record = self.pop(self.queues.get(('open', portname)), 'open')
+        if record == None:
+            raise serial.SerialException('could not open port %s' % portname)
+        self.wait(record)
+        if 'error' in record:
+            raise port_error(*record['error'])
+
+        return ReplayPort(self, self.queues.get((portname, record['open'])),
+                          timeout)
+
+def record(directory):
+    """Log all camera and serial I/O to directory.
+
+    Return the Session. This function can raise replay.Error and
+    camera.Error.
+    """
+    session = Session(directory)
+    camera.set_backend(RecordingCamera(camera.get_backend(), session))
+    lights.set_backend(RecordingSerial(session))
+
+    return session
+
+def replay(directory, speed = 1.0):
+    """Play all camera and serial I/O back from directory, see record().
+
+    speed -- scale recorded call times by this, 0 means don't wait at all
+
+    Return (camera_backend, serial_backend), get_misses() on these tells
+    you if the program did anything the session didn't. This function can
+    raise replay.Error.
+    """
+    tape = Tape(directory)
+    camera_backend = ReplayCamera(tape, speed)
+    serial_backend = ReplaySerial(tape, speed)
+    camera.set_backend(camera_backend)
+    lights.set_backend(serial_backend)
+
+    return (camera_backend, serial_backend)
@@ -28,11 +28,18 @@ import glib
 
 import preview 
 import camera 
+import camsim 
+import replay 
 import info 
 import progress 
 import ledmap 
 import lights 
 import config 
+import writer 
+import focus 
+import exposure 
+import recorder 
+import streamer 
 
 # get the directory this source is in
 source_dir = os.path.dirname(__file__)
@@ -44,6 +51,9 @@ preview_timeout = 5000
 # hop the lights after this many ms of no light actions -- prevents burnout
 lights_timeout = 3500
 
+# retry failed deferred camera deletes every this many ms
+delete_timeout = 10000
+
 # the width of the camera preview
 # the Nikon has a 640 x 426 preview, I don't know what other cameras have,
 # of whether libgphoto2 has an easy way to find this out
@@ -59,6 +69,14 @@ class MainWindow(gtk.Window):
             self.config_window.destroy()
             self.config_window = None
 
+        self.record_stop()
+        if self.streamer:
+            self.preview.remove_sink(self.streamer)
+            self.streamer.close()
+            self.streamer = None
+
+        # last chance to clean up the camera card
+        self.camera.delete_pending()
         self.camera.release()
         self.lights.release()
 
@@ -112,11 +130,75 @@ class MainWindow(gtk.Window):
         focus.set_value(1)
         config.set_config()
 
+    def loupe_cb(self, widget, data = None):
+        self.preview.set_loupe(widget.get_active())
+
+    def peaking_cb(self, widget, data = None):
+        self.preview.set_peaking(widget.get_active())
+
+    def exposure_cb(self, widget, data = None):
+        self.preview.set_exposure(widget.get_active())
+
+    def record_start(self):
+        filename = os.path.join(options.outdir, 
+                                time.strftime('preview-%Y%m%d-%H%M%S.avi'))
+        try:
+            self.recording = recorder.Recorder(filename)
+        except recorder.Error as e:
+            self.info.err(e.message, e.detail)
+            return False
+        self.preview.add_sink(self.recording)
+        self.info.msg('Recording preview', filename)
+
+        return True
+
+    def record_stop(self):
+        if not self.recording:
+            return
+
+        self.preview.remove_sink(self.recording)
+        recording = self.recording
+        self.recording = None
+        try:
+            recording.close()
+        except recorder.Error as e:
+            self.info.err(e.message, e.detail)
+        else:
+            message = 'Recorded %d frames' % recording.get_frames()
+            if recording.get_full():
+                message += ', file size limit reached'
+            self.info.msg(message, 
+                          '%d dropped, saved to %s' % 
+                          (recording.get_dropped(), recording.filename))
+
+    def stream_start(self, port, lan):
+        if lan:
+            address = ''
+        else:
+            address = 'localhost'
+        try:
+            self.streamer = streamer.Streamer(port, address)
+        except streamer.Error as e:
+            self.info.err(e.message, e.detail)
+        else:
+            self.preview.add_sink(self.streamer)
+            logging.debug('serving preview on port %d', port)
+
+    def record_cb(self, widget, data = None):
+        if widget.get_active() and not self.recording:
+            if not self.record_start():
+                widget.set_active(False)
+        elif not widget.get_active():
+            self.record_stop()
+
     def photo_cb(self, widget, data = None):
         live = self.preview.get_live()
         self.set_live(False)
         if self.dome_controls:
-            self.light_hop_cb()
+            try:
+                self.light_hop().wait()
+            except lights.Error as e:
+                self.info.err(e.message, e.detail)
         try:
             full_filename = self.camera.capture_to_file(preview_filename())
         except camera.Error as e:
@@ -126,7 +208,6 @@ class MainWindow(gtk.Window):
                 os.system('open "%s"' % full_filename)
             else:
                 os.system('xdg-open "%s"' % full_filename)
-        self.camera.release()
         self.set_live(live)
 
     def get_lights(self):
@@ -135,12 +216,16 @@ class MainWindow(gtk.Window):
 
         return self.leds.get_bytes(name)
 
-    def light_hop_cb(self):
+    def light_hop(self):
         nlights = len(self.get_lights())
-        self.set_lights((self.last_light + 1) % nlights)
+        return self.set_lights((self.last_light + 1) % nlights)
+
+    def light_hop_cb(self):
+        self.light_hop()
         return False
 
-    def set_lights(self, i):
+    # returns a lights.Request, wait on it to be sure the light is on
+    def set_lights(self, i, force = False):
         if self.light_hop_timeout:
             glib.source_remove(self.light_hop_timeout)
             self.light_hop_timeout = 0
@@ -148,15 +233,19 @@ class MainWindow(gtk.Window):
             self.light_hop_cb)
 
         self.last_light = i
-        self.lights.set_triple(self.get_lights()[i])
+        request = self.lights.set_triple(self.get_lights()[i], force)
 
         light = self.light_picker.get_value_as_int() - 1
         if light != i:
             self.light_picker.set_value(i + 1)
 
+        return request
+
+    # the user has asked for this light, so always send it, the controller
+    # may have been reset behind our back
     def lights_refresh(self):
         light = self.light_picker.get_value_as_int() - 1
-        self.set_lights(light)
+        self.set_lights(light, True)
 
     def dome_picker_cb(self, widget, data = None):
         self.light_picker_refresh()
@@ -212,17 +301,20 @@ class MainWindow(gtk.Window):
 
     def rti_preview(self):
         nlights = len(self.get_lights())
-        for i in range(0, nlights):
-            if self.progress.progress(i / float(nlights)):
-                return False
-            self.set_lights(i)
-
-            # we need to wait to make sure we get a fresh preview frame
-            time.sleep(0.1)
-
-            self.camera.preview_to_file(os.path.join(options.tempdir, 
-                'rti_preview_%d.jpg' % i))
-        self.camera.release()
+        self.camera.start_session()
+        try:
+            for i in range(0, nlights):
+                if self.progress.progress(i / float(nlights)):
+                    return False
+                self.set_lights(i).wait()
+
+                # we need to wait to make sure we get a fresh preview frame
+                time.sleep(camera.preview_settle)
+
+                self.camera.preview_to_file(os.path.join(options.tempdir, 
+                    'rti_preview_%d.jpg' % i))
+        finally:
+            self.camera.end_session()
         return True
 
     def rti_preview_ptm(self):
@@ -269,25 +361,70 @@ class MainWindow(gtk.Window):
         start = time.time()
         nlights = len(self.get_lights())
 
-        for i in range(0, nlights):
-            if self.progress.progress(i / float(nlights)):
-                return False
-            self.set_lights(i)
+        # optionally write files from a background thread
+        output = None
+        if options.write_behind > 0:
+            output = writer.Writer(options.write_behind)
 
-            self.camera.capture_to_file(os.path.join(self.target, '%d' % i))
-            
-            # stops the camera locking up
-            time.sleep(0.1)
-            
-            # unless you preview between captures, the Nikon D3X will 
-            # autofocus in AF-S mode
-            #self.camera.preview()
-            # removed to fix issue with d800 needs testing with D3
+        # keep a single camera connection for the whole sequence, and 
+        # optionally delete from the camera in one go at the end
+        self.camera.start_session()
+        self.camera.set_defer_delete(options.defer_delete)
+        try:
+            # each frame downloads while the next one is exposing
+            sequence = camera.Sequence(self.camera, output)
+            for i in range(0, nlights):
+                # on cancel, we still need to fetch the last shot we took
+                if self.progress.progress(i / float(nlights)):
+                    break
+                self.set_lights(i).wait()
+
+                sequence.capture(os.path.join(self.target, '%d' % i))
+                
+                # stops the camera locking up
+                time.sleep(camera.capture_settle)
+                
+                # unless you preview between captures, the Nikon D3X will 
+                # autofocus in AF-S mode
+                #self.camera.preview()
+                # removed to fix issue with d800 needs testing with D3
+            sequence.finish()
+        finally:
+            self.camera.set_defer_delete(False)
+
+            # files are only safe to delete from the camera once they are
+            # on disc
+            try:
+                if output:
+                    output.close()
+            except writer.Error:
+                self.camera.keep_pending()
+                raise
+            finally:
+                if self.camera.delete_pending() > 0:
+                    self.delete_queue()
+                self.camera.end_session()
+
+        logging.debug('capture done in %fs, %d reconnects', 
+                      time.time() - start, self.camera.get_reconnects())
 
-        logging.debug('capture done in %fs', time.time() - start)
+        return False
 
+    def delete_cb(self):
+        # wait for any long action to finish
+        if self.busy:
+            return True
+        if self.camera.delete_pending() > 0:
+            return True
+        self.delete_timeout = 0
         return False
 
+    # retry failed camera deletes in the background
+    def delete_queue(self):
+        if not self.delete_timeout:
+            self.delete_timeout = glib.timeout_add(delete_timeout, 
+                                                   self.delete_cb)
+
     def rti_capture_cb(self, widget, data = None):
         chooser = gtk.FileChooserDialog('Select output folder', self, 
                 gtk.FILE_CHOOSER_ACTION_CREATE_FOLDER, 
@@ -345,7 +482,7 @@ class MainWindow(gtk.Window):
                 f.write('Selection "%d %d %d %d"\n' % \
                     (rect.left, rect.top, rect.width, rect.height))
             config = camera.Config(self.camera) 
-            config.prettyprint(f, config.get_root_widget())
+            config.prettyprint(f)
             f.close()
         except Exception as e:
             self.info.err('Unable to create camsettings.txt', 
@@ -365,7 +502,10 @@ class MainWindow(gtk.Window):
         self.config_window = None
         self.live_hide_timeout = 0
         self.light_hop_timeout = 0
+        self.delete_timeout = 0
         self.busy = False
+        self.recording = None
+        self.streamer = None
 
         self.leds = ledmap.Ledmap(os.path.join(source_dir, 'data', 
                                                'led-maps.txt'))
@@ -378,13 +518,15 @@ class MainWindow(gtk.Window):
         # where project directories get written, see RTI cap above
         self.outdir = options.outdir
 
-        self.lights = lights.Lights()
+        # all serial I/O happens in the background
+        self.lights = lights.LightsThread(
+                lights.Lights(os.path.join(options.tempdir, 'lights-port')))
 
         # try to reset the lights ... if this fails, disable dome controls
         try:
             self.dome_controls = True
             name = self.leds.get_names()[0]
-            self.lights.set_triple(self.leds.get_bytes(name)[0])
+            self.lights.set_triple(self.leds.get_bytes(name)[0]).wait()
         except lights.Error as e:
             logging.debug('no lights found, disabling dome controls')
             self.dome_controls = False
@@ -399,6 +541,7 @@ class MainWindow(gtk.Window):
 
         self.camera = camera.Camera()
         self.preview = preview.Preview(self.camera)
+        self.preview.set_fast_decode(options.fast_preview)
         fixed.put(self.preview, 0, 0)
         self.preview.show()
         self.preview.connect('motion_notify_event', self.preview_motion_cb)
@@ -406,7 +549,7 @@ class MainWindow(gtk.Window):
         if options.verbose:
             try:
                 config = camera.Config(self.camera) 
-                config.prettyprint(sys.stdout, config.get_root_widget())
+                config.prettyprint(sys.stdout)
             except:
                 logging.debug("No Camera detected: unable to print config")
         eb = gtk.EventBox()
@@ -492,6 +635,34 @@ class MainWindow(gtk.Window):
         self.toolbar.pack_start(button, False, False)
         button.show()
 
+        button = gtk.ToggleButton('Loupe')
+        button.set_tooltip_text("Magnify the selected area for focusing")
+        button.connect('toggled', self.loupe_cb, None)
+        self.toolbar.pack_start(button, False, False)
+        button.show()
+
+        if focus.supported():
+            button = gtk.ToggleButton('Peaking')
+            button.set_tooltip_text("Highlight sharp edges and show a "
+                                    "sharpness score")
+            button.connect('toggled', self.peaking_cb, None)
+            self.toolbar.pack_start(button, False, False)
+            button.show()
+
+        if exposure.supported():
+            button = gtk.ToggleButton('Exposure')
+            button.set_tooltip_text("Show a histogram and mark blown "
+                                    "highlights and crushed shadows")
+            button.connect('toggled', self.exposure_cb, None)
+            self.toolbar.pack_start(button, False, False)
+            button.show()
+
+        button = gtk.ToggleButton('Record')
+        button.set_tooltip_text("Record the live preview to a movie")
+        button.connect('toggled', self.record_cb, None)
+        self.toolbar.pack_start(button, False, False)
+        button.show()
+
         photo_image = gtk.image_new_from_file(
                 os.path.join(source_dir, 'data', 'camera_24.png'))
         photo = gtk.Button()
@@ -516,6 +687,9 @@ class MainWindow(gtk.Window):
 
         self.info.msg('Welcome to RTI Acquire', 'v1.3, March 2014')
 
+        if options.stream > 0:
+            self.stream_start(options.stream, options.stream_lan)
+
         self.show()
 
     def main(self):
@@ -539,6 +713,37 @@ def main():
     parser.add_option("-o", "--outdir", 
                     dest = "outdir", default = home, metavar = "DIR",
                     help = "set output directory to DIR")
+    parser.add_option("-w", "--write-behind", 
+                    type = "int", dest = "write_behind", default = 0, 
+                    metavar = "N",
+                    help = "write up to N captured files in the background")
+    parser.add_option("-x", "--defer-delete", 
+                    action = "store_true", dest = "defer_delete", 
+                    default = False, 
+                    help = "delete RTI captures from the camera at the end")
+    parser.add_option("-f", "--fast-preview", 
+                    action = "store_true", dest = "fast_preview", 
+                    default = False, 
+                    help = "faster, lower quality preview decode")
+    parser.add_option("-s", "--stream", 
+                    type = "int", dest = "stream", default = 0, 
+                    metavar = "PORT",
+                    help = "serve the live preview over HTTP on PORT")
+    parser.add_option("-l", "--stream-lan", 
+                    action = "store_true", dest = "stream_lan", 
+                    default = False, 
+                    help = "serve the preview to the network, not just "
+                        "this machine")
+    parser.add_option("-c", "--camsim", 
+                    action = "store_true", dest = "camsim", 
+                    default = False, 
+                    help = "use a simulated camera, see camsim.py")
+    parser.add_option("-r", "--record", 
+                    dest = "record", default = None, metavar = "DIR",
+                    help = "log all camera and light I/O to DIR")
+    parser.add_option("-p", "--replay", 
+                    dest = "replay", default = None, metavar = "DIR",
+                    help = "replay camera and light I/O logged to DIR")
     options, args = parser.parse_args()
 
     if options.verbose:
@@ -556,6 +761,20 @@ def main():
     logging.debug('tempdir set to %s', options.tempdir)
     logging.debug('outdir set to %s', options.outdir)
 
+    try:
+        if options.camsim:
+            camera.set_backend(camsim.Simulator())
+        if options.replay:
+            replay.replay(options.replay)
+        elif options.record:
+            replay.record(options.record)
+    except (camsim.Error, replay.Error, camera.Error) as e:
+        logging.error('%s', str(e))
+        return
+
+    # we have background threads for the camera and disc
+    gobject.threads_init()
+
     window = MainWindow()
     window.main()
 
@@ -0,0 +1,244 @@
+#!/usr/bin/python
+
+"""Serve the live preview over HTTP.
+
+Streamer -- an HTTP server sending preview jpegs to any number of viewers
+Error -- the exception we can raise
+
+Point a web browser at http://host:port/ to watch. /stream is the bare
+multipart MJPEG stream, /frame.jpg is the most recent frame.
+
+The camera's jpegs are sent as they are, there's no decode or re-encode.
+Each viewer has its own thread which always sends the newest frame, so a
+slow viewer just sees fewer frames and can't hold up anyone else.
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import threading
+import socket
+import time
+import BaseHTTPServer
+import SocketServer
+
+# the most viewers we serve at once
+max_clients = 8
+
+# each viewer gets at most this many frames a second, to limit the load on
+# the capture machine
+client_fps = 10
+
+# drop viewers who don't accept data for this long, in seconds
+client_timeout = 10
+
+# the multipart boundary
+boundary = 'rtiacquireframe'
+
+page = """<html>
+<head><title>RTI Acquire</title></head>
+<body style="background: black; margin: 0">
+<img src="/stream" style="display: block; margin: auto">
+</body>
+</html>
+"""
+
+class Error(Exception):
+
+    """An error from the streamer.
+
+    message -- a high-level description of the error
+    detail -- a string with some detailed diagnostics
+    """
+
+    def __init__(self, message, detail):
+        self.message = message
+        self.detail = detail
+
+        logging.debug('streamer: %s', repr(self))
+
+    def __str__(self):
+        return '%s - %s' % (self.message, self.detail)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    timeout = client_timeout
+
+    def log_message(self, format, *args):
+        logging.debug('streamer: %s %s', self.address_string(), format % args)
+
+    def send_page(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def send_frame(self):
+        frame = self.server.streamer.latest()
+        if frame == None:
+            self.send_error(503, 'No preview running')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(frame)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(frame)
+
+    def send_stream(self):
+        streamer = self.server.streamer
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'multipart/x-mixed-replace; boundary=%s' % boundary)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        sequence = 0
+        while True:
+            start = time.time()
+            (frame, sequence) = streamer.next_frame(sequence)
+            if frame == None:
+                break
+
+            self.wfile.write('--%s\r\n' % boundary)
+            self.wfile.write('Content-Type: image/jpeg\r\n')
+            self.wfile.write('Content-Length: %d\r\n\r\n' % len(frame))
+            self.wfile.write(frame)
+            self.wfile.write('\r\n')
+            self.wfile.flush()
+
+            wait = 1.0 / client_fps - (time.time() - start)
+            if wait > 0 and streamer.stopping.wait(wait):
+                break
+
+    def do_GET(self):
+        streamer = self.server.streamer
+        if not streamer.client_start():
+            self.send_error(503, 'Too many viewers')
+            return
+
+        try:
+            if self.path == '/':
+                self.send_page()
+            elif self.path == '/frame.jpg':
+                self.send_frame()
+            elif self.path == '/stream':
+                self.send_stream()
+            else:
+                self.send_error(404)
+        except (socket.error, socket.timeout) as e:
+            # the viewer went away
+            logging.debug('streamer: viewer %s: %s',
+                          self.address_string(), str(e))
+        finally:
+            streamer.client_stop()
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Streamer:
+
+    """Serve preview frames over HTTP.
+
+    add() makes a frame the newest one, it's cheap and never blocks.
+    Viewer threads pick it up from there.
+    """
+
+    def __init__(self, port, address = 'localhost'):
+        """Start serving on port.
+
+        address -- the interface to listen on, '' for all of them
+
+        This method can raise streamer.Error.
+        """
+        self.stopping = threading.Event()
+
+        # the newest frame and its sequence number, viewers wait on
+        # condition for a sequence number larger than the one they have
+        self.condition = threading.Condition()
+        self.frame = None
+        self.sequence = 0
+        self.clients = 0
+
+        try:
+            self.server = Server((address, port), Handler)
+        except socket.error as e:
+            raise Error('Unable to start preview server', str(e))
+        self.server.streamer = self
+
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def client_start(self):
+        self.condition.acquire()
+        try:
+            if self.clients >= max_clients:
+                return False
+            self.clients += 1
+            return True
+        finally:
+            self.condition.release()
+
+    def client_stop(self):
+        self.condition.acquire()
+        try:
+            self.clients -= 1
+        finally:
+            self.condition.release()
+
+    def next_frame(self, sequence):
+        """Wait for a frame newer than sequence. Return (frame, sequence),
+        or (None, sequence) if we're shutting down.
+        """
+        self.condition.acquire()
+        try:
+            while not self.stopping.is_set() and \
+                (self.frame == None or self.sequence <= sequence):
+                # a wait with no timeout can't be interrupted
+                self.condition.wait(client_timeout)
+            if self.stopping.is_set():
+                return (None, sequence)
+            return (self.frame, self.sequence)
+        finally:
+            self.condition.release()
+
+    def latest(self):
+        """Return the newest frame, or None."""
+        return self.frame
+
+    def add(self, frame, timestamp):
+        """Make frame, a string containing a jpeg, the newest frame."""
+        self.condition.acquire()
+        try:
+            self.frame = frame
+            self.sequence += 1
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def get_clients(self):
+        """Return the number of viewers."""
+        return self.clients
+
+    def get_address(self):
+        """Return the (address, port) we are listening on."""
+        return self.server.server_address
+
+    def close(self):
+        """Stop serving and disconnect all viewers."""
+        if self.thread:
+            self.condition.acquire()
+            try:
+                self.stopping.set()
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+"""Write files in the background.
+
+Writer -- a bounded queue of files being written by a background thread
+Error -- the exception we can raise
+
+Author: J.Cupitt
+Created as part of the AHRC RTI project in 2011
+GNU LESSER GENERAL PUBLIC LICENSE
+"""
+
+import logging
+import os
+import threading
+import Queue
+import ctypes
+import ctypes.util
+
+# the number of files that can be waiting to be written before write() blocks
+max_pending = 4
+
+# fsync() and rename files into place in batches of this size, or whenever
+# the queue empties
+fsync_batch = 8
+
+# written files have this suffix until they are synced and renamed into
+# place
+temp_suffix = '.part'
+
+# os.posix_fallocate() is python3 only, find it in libc ourselves ... use
+# the 64-bit version so we can preallocate big files on 32-bit machines
+# like the Pi, OS X has neither
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    fallocate = libc.posix_fallocate64
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, TypeError, AttributeError):
+    fallocate = None
+
+class Error(Exception):
+
+    """An error from the writer.
+
+    message -- a high-level description of the error
+    detail -- a string with some detailed diagnostics
+    """
+
+    def __init__(self, message, detail):
+        self.message = message
+        self.detail = detail
+
+        logging.debug('writer: %s', repr(self))
+
+    def __str__(self):
+        return '%s - %s' % (self.message, self.detail)
+
+class Writer:
+
+    """Write files from a background thread.
+
+    write() queues a filename and a string of bytes and returns at once,
+    unless the queue is full, in which case it blocks until there's space.
+    Each file is written to a temporary, preallocated file, then synced and
+    renamed into place in batches, so a half-written file never appears under
+    its final name.
+
+    The first error stops the writer. It's raised by the next call to
+    write() or flush().
+    """
+
+    def __init__(self, pending=max_pending, batch=fsync_batch):
+        """Start the writer thread.
+
+        pending -- the number of files which can be in flight at once
+        batch -- the number of files to fsync and rename together
+        """
+        self.batch = batch
+        self.queue = Queue.Queue(pending)
+        self.error = None
+
+        # files we've written but not yet synced, as (fd, temp, filename)
+        self.unsynced = []
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_file(self, filename, data):
+        temp = filename + temp_suffix
+        fd = os.open(temp, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0666)
+        self.unsynced.append((fd, temp, filename))
+
+        if fallocate and len(data) > 0:
+            # this can fail on network shares, it's only an optimisation
+            fallocate(fd, 0, len(data))
+
+        offset = 0
+        while offset < len(data):
+            offset += os.write(fd, buffer(data, offset))
+
+    def sync(self):
+        directories = set()
+        try:
+            for fd, temp, filename in self.unsynced:
+                os.fsync(fd)
+            for fd, temp, filename in self.unsynced:
+                os.rename(temp, filename)
+                directories.add(os.path.dirname(os.path.abspath(filename)))
+        finally:
+            for fd, temp, filename in self.unsynced:
+                os.close(fd)
+            self.unsynced = []
+
+        # make the renames durable too ... not all platforms let you fsync a
+        # directory
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+    def discard(self):
+        for fd, temp, filename in self.unsynced:
+            try:
+                os.close(fd)
+                os.unlink(temp)
+            except OSError:
+                pass
+        self.unsynced = []
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None:
+                    # close() ... make sure the last files get renamed
+                    if self.error == None:
+                        self.sync()
+                elif self.error == None:
+                    filename, data = item
+                    logging.debug('writer: writing %s', filename)
+                    self.write_file(filename, data)
+                    if len(self.unsynced) >= self.batch or \
+                        self.queue.empty():
+                        self.sync()
+            except (OSError, IOError) as e:
+                self.error = Error('Unable to write file', str(e))
+                self.discard()
+            finally:
+                self.queue.task_done()
+
+            # always stop on close(), even if the last sync failed ... 
+            # check() raises the error
+            if item == None:
+                break
+
+    def check(self):
+        if self.error:
+            raise self.error
+
+    def write(self, filename, data):
+        """Queue data to be written to filename.
+
+        Blocks if there are already too many files in flight. This method can
+        raise writer.Error for an earlier failed write.
+        """
+        self.check()
+        self.queue.put((filename, data))
+
+    def flush(self):
+        """Wait for all queued files to be written, synced and renamed.
+
+        This method can raise writer.Error.
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """Flush and stop the writer thread.
+
+        This method can raise writer.Error.
+        """
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check()
@@ -3,8 +3,22 @@
 # will make the tarball. This can be unpacked then:
 # python setup.py install --prefix=/usr/local/bin
 
+import subprocess
+
 from distutils.core import setup, Extension
 
+# dejpeg.c needs the pygobject and gdk-pixbuf headers
+def pkgconfig(flag, *packages):
+    try:
+        process = subprocess.Popen(['pkg-config', flag] + list(packages),
+                                   stdout = subprocess.PIPE)
+        (out, err) = process.communicate()
+    except OSError:
+        return []
+    return [x[2:] for x in out.split()]
+
+dejpeg_packages = ['pygobject-2.0', 'gdk-pixbuf-2.0']
+
 setup(name='RTIAcquire',
     version='1.2dev',
     packages=['rtiacquire'],
@@ -13,8 +27,11 @@ setup(name='RTIAcquire',
     author_email='jcupitt@gmail.com',
     license='LICENSE.txt',
     description='Remote-control of digital cameras', 
-    ext_modules=[Extension('rtiacquire.dejpeg', ['rtiacquire/dejpeg.c'], 
-        libraries=['jpeg'])],
+    ext_modules=[Extension('rtiacquire.dejpeg', ['rtiacquire/dejpeg.c'],
+        include_dirs=pkgconfig('--cflags-only-I', *dejpeg_packages),
+        library_dirs=pkgconfig('--libs-only-L', *dejpeg_packages),
+        libraries=['jpeg', 'pthread'] +
+            pkgconfig('--libs-only-l', *dejpeg_packages))],
     package_data={'rtiacquire': ['data/*']},
     requires=['pyserial'],
     long_description=open('README.md').read(),